@@ -0,0 +1,82 @@
+'''
+Vectorized OHLC aggregation of sorted int64 timestamps. Bars are handled in a
+sparse form (bins,close,high,low) holding only bins with at least one tick,
+where bins are bin numbers counted from an origin. fill converts them into
+contiguous candles.
+'''
+import numpy as np
+from fractions import gcd
+
+def ohlc(ts,price,step,origin=0):
+    '''
+    Aggregate ticks into bars of duration step in a single pass.
+    :param np.ndarray ts:   sorted int64 timestamps
+    :param np.ndarray price:    prices of the ticks
+    :param int step:    duration of a bar in units of ts
+    :param int origin:  bars are aligned to origin
+    @return:    sparse bars (bins,close,high,low)
+    '''
+    return _reduce((ts-origin)//step,price,price,price)
+
+def rollup(bins,close,high,low,factor):
+    '''
+    Aggregate sparse bars into bars factor times as long.
+    '''
+    return _reduce(bins//factor,close,high,low)
+
+def _reduce(b,close,high,low):
+    if not len(b): return b,close,high,low
+    ends=np.flatnonzero(b[1:]!=b[:-1])
+    starts=np.r_[0,ends+1]
+    ends=np.r_[ends,len(b)-1]
+    return b[starts],close[ends],np.maximum.reduceat(high,starts),np.minimum.reduceat(low,starts)
+
+def multi_ohlc(ts,price,steps,origin=0):
+    '''
+    Aggregate ticks into bars of several durations. Each duration is built from
+    the longest finer duration dividing it, only the finest ones from the ticks.
+    :param list steps:  durations in units of ts
+    @return:    dict of sparse bars by step
+    '''
+    ret={}
+    for step in sorted(set(steps)):
+        finer=[s for s in ret if step%s==0]
+        if finer:
+            s=max(finer)
+            ret[step]=rollup(*ret[s]+(step//s,))
+        else:
+            ret[step]=ohlc(ts,price,step,origin)
+    return ret
+
+def fill(bins,close,high,low,prev=None,start=None,stop=None):
+    '''
+    Convert sparse bars into contiguous candles like
+    DataFrame.fillna(method='pad'): empty bins repeat the preceding bar,
+    open is the close of the preceding candle, high and low include the open.
+    :param tuple prev:  (close,high,low) of the last bar before start or None
+    :param int start:   first bin, defaults to bins[0]. Bins before bins[0]
+                        repeat prev
+    :param int stop:    fill up to (excluding) bin stop, defaults to the last bin
+    @return:    (bins,open,close,high,low) of all bins from start to stop
+    '''
+    if start is None: start=bins[0]
+    if stop is None: stop=bins[-1]+1
+    if prev is not None:
+        start-=1
+        bins,close,high,low=[np.r_[a,b] for a,b in zip((start,)+tuple(prev),(bins,close,high,low))]
+    pos=np.full(stop-start,-1,dtype=np.int64)
+    pos[bins-start]=np.arange(len(bins))
+    pos=np.maximum.accumulate(pos)
+    close,high,low=close[pos],high[pos],low[pos]
+    open_=np.empty_like(close)
+    open_[0]=np.nan
+    open_[1:]=close[:-1]
+    ret=np.arange(start,stop),open_,close,np.fmax(high,open_),np.fmin(low,open_)
+    if prev is not None: ret=tuple(a[1:] for a in ret)
+    return ret
+
+def lcm(steps):
+    '''
+    least common multiple of integer durations
+    '''
+    return reduce(lambda a,b: a*b//gcd(a,b),steps)
@@ -0,0 +1,122 @@
+import os,zipfile,hashlib,threading
+from io import BytesIO
+
+CHUNKSIZE=2**20
+
+class ArchiveCache(object):
+    '''
+    On-disk cache of the raw zip archives of histdata.com keyed by
+    pair, year and month. Every archive is stored together with its sha1
+    digest, a corrupt or truncated file is dropped on read.
+    If the cache grows beyond max_size bytes, the least recently used
+    archives are deleted.
+    '''
+    def __init__(self,path,max_size=2**32):
+        '''
+        :param str path:    cache directory
+        :param int max_size: max size of all cached archives in bytes
+        '''
+        self.path=path
+        self.max_size=max_size
+        self._lock=threading.Lock()
+        if not os.path.isdir(path): os.makedirs(path)
+
+    def _path(self,pair,year,month):
+        pair=pair.upper()
+        return os.path.join(self.path,pair,"%s_%d%02d.zip"%(pair,year,month))
+
+    def __contains__(self,key):
+        return os.path.exists(self._path(*key))
+
+    def open(self,pair,year,month):
+        '''
+        Return the cached archive as open file or None if missing or corrupt.
+        The digest is checked in chunks, so the archive is never read into memory.
+        '''
+        p=self._path(pair,year,month)
+        try:
+            f=open(p,'rb')
+            with open(p+'.sha1') as d: digest=d.read().strip()
+        except IOError: return None
+        h=hashlib.sha1()
+        for chunk in iter(lambda: f.read(CHUNKSIZE),''): h.update(chunk)
+        if h.hexdigest()!=digest:
+            f.close()
+            self.remove(pair,year,month)
+            return None
+        f.seek(0)
+        #mark as recently used
+        os.utime(p,None)
+        return f
+
+    def get(self,pair,year,month):
+        '''
+        Return the cached archive as string or None if missing or corrupt.
+        '''
+        f=self.open(pair,year,month)
+        if f is None: return None
+        with f: return f.read()
+
+    def put(self,pair,year,month,raw,verify=True):
+        '''
+        Save an archive to the cache and evict old ones if necessary.
+        :param raw: the zip archive as string or seekable file object
+        :param bool verify: check the crc of every member, which inflates
+                            the whole archive
+        '''
+        if isinstance(raw,basestring): raw=BytesIO(raw)
+        raw.seek(0)
+        if verify and zipfile.ZipFile(raw).testzip() is not None:
+            raise ValueError("corrupt archive %s %d-%02d"%(pair,year,month))
+        raw.seek(0)
+        p=self._path(pair,year,month)
+        d=os.path.dirname(p)
+        tmp="%s.%d.tmp"%(p,threading.current_thread().ident)
+        h=hashlib.sha1()
+        with self._lock:
+            if not os.path.isdir(d): os.makedirs(d)
+            with open(tmp,'wb') as f:
+                for chunk in iter(lambda: raw.read(CHUNKSIZE),''):
+                    h.update(chunk)
+                    f.write(chunk)
+            with open(tmp+'.sha1','w') as f: f.write(h.hexdigest())
+            os.rename(tmp+'.sha1',p+'.sha1')
+            os.rename(tmp,p)
+        raw.seek(0)
+        self.evict()
+
+    def remove(self,pair,year,month):
+        p=self._path(pair,year,month)
+        for name in (p,p+'.sha1'):
+            try: os.remove(name)
+            except OSError: pass
+
+    def entries(self):
+        '''
+        List (mtime,size,path) of all cached archives
+        '''
+        ret=[]
+        for root,_,files in os.walk(self.path):
+            for name in files:
+                if not name.endswith('.zip'): continue
+                p=os.path.join(root,name)
+                st=os.stat(p)
+                ret.append((st.st_mtime,st.st_size,p))
+        return ret
+
+    @property
+    def size(self): return sum(e[1] for e in self.entries())
+
+    def evict(self):
+        '''
+        Delete least recently used archives until the cache fits max_size
+        '''
+        with self._lock:
+            entries=sorted(self.entries())
+            total=sum(e[1] for e in entries)
+            for _,size,p in entries:
+                if total<=self.max_size: break
+                for name in (p,p+'.sha1'):
+                    try: os.remove(name)
+                    except OSError: pass
+                total-=size
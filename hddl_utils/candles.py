@@ -6,8 +6,15 @@ Created on 12.02.2017
 from datetime import datetime as dt, datetime
 import pandas as pd,numpy as np
 import sqlite3
+#date strings are parsed with time.strptime, whose lazy import of
+#_strptime fails in concurrent first calls from several threads
+import _strptime
 from threading import current_thread
 import threading
+from connections import ConnectionPool
+from timestamps import S,to_ns,from_ns
+from dateutil.tz import tzlocal
+from stats import instrument
 
 class Candle(object):
     '''
@@ -33,13 +40,13 @@ class Candle(object):
         :param float value:
         :param int timestamp:
         '''
-        time=dt.fromtimestamp(timestamp)
+        time=dt.utcfromtimestamp(timestamp)
         self.value=value
         if not self.open and time.second%self.duration==0:
             self.open=value
             self.high=value
             self.low=value
-            self.start_time=dt.fromtimestamp(timestamp)
+            self.start_time=dt.utcfromtimestamp(timestamp)
         self.high=max(self.high,value)
         self.low=min(self.low,value)
         self.last_val=(value,timestamp)
@@ -50,6 +57,223 @@ class Candle(object):
             return False
         return True
     
+class CandleAggregator(object):
+    '''
+    Aggregates batches of ticks of many symbols into candles of many
+    durations at once. The running open, high, low and close of every
+    (symbol,duration) are kept in arrays, closed candles are returned as one
+    structured array per batch instead of one callback per candle.
+    Candles start at multiples of their duration, a candle is closed by the
+    first tick of a later candle of the same symbol.
+    '''
+    dtype=np.dtype([('symbol',np.int64),('duration',np.int64),('date',np.int64),
+                    ('open',np.float64),('high',np.float64),('low',np.float64),('close',np.float64),
+                    ('closed_by',np.int64)])
+    def __init__(self,symbols,durations=(10,)):
+        '''
+        :param list symbols:    names of the symbols, ticks refer to them by index
+        :param list durations:  candle durations in seconds
+        '''
+        self.symbols=list(symbols)
+        self.durations=np.asarray(durations,dtype=np.int64)
+        shape=(len(self.symbols),len(self.durations))
+        self.start=np.full(shape,-1,dtype=np.int64)
+        self.open=np.full(shape,np.nan)
+        self.high=np.full(shape,np.nan)
+        self.low=np.full(shape,np.nan)
+        self.close=np.full(shape,np.nan)
+
+    def index(self,names):
+        '''
+        convert symbol names to the indices add expects
+        '''
+        lookup=dict((n,i) for i,n in enumerate(self.symbols))
+        return np.array([lookup[n] for n in names],dtype=np.int64)
+
+    def add(self,symbol,timestamp,value,onclose=None):
+        '''
+        Add a batch of ticks. Timestamps of a symbol must not decrease, within
+        a batch and across batches.
+        :param np.ndarray symbol:   symbol index of each tick
+        :param np.ndarray timestamp: unix timestamp of each tick
+        :param np.ndarray value:    price of each tick
+        :param callable onclose:    if given, called like Candle.onclose for
+                                    every closed candle, see emit
+        @return:    structured array (dtype) of the closed candles in the order
+                    they were closed. closed_by is the index of the closing tick
+        '''
+        symbol=np.asarray(symbol,dtype=np.int64)
+        timestamp=np.asarray(timestamp)
+        value=np.asarray(value,dtype=np.float64)
+        if not len(symbol): return np.empty(0,self.dtype)
+        order=np.argsort(symbol,kind='mergesort')
+        s,t,p=symbol[order],timestamp[order],value[order]
+        blocks=[]
+        for j,d in enumerate(self.durations):
+            b=(t//d).astype(np.int64)
+            starts=np.flatnonzero(np.r_[True,(s[1:]!=s[:-1])|(b[1:]!=b[:-1])])
+            gs,gb=s[starts],b[starts]
+            go,gc=p[starts],p[np.r_[starts[1:],len(s)]-1]
+            gh,gl=np.maximum.reduceat(p,starts),np.minimum.reduceat(p,starts)
+            first=np.r_[True,gs[1:]!=gs[:-1]]
+            last=np.r_[gs[1:]!=gs[:-1],True]
+            #continue the running candles of the state
+            st=self.start[gs,j]
+            if (first&(st>gb)).any(): raise ValueError("timestamps must not decrease")
+            merge=first&(st==gb)
+            m=gs[merge]
+            go[merge]=self.open[m,j]
+            gh[merge]=np.fmax(gh[merge],self.high[m,j])
+            gl[merge]=np.fmin(gl[merge],self.low[m,j])
+            #running candles closed by the batch
+            flush=first&(st>=0)&(st<gb)
+            f=gs[flush]
+            blocks.append(self._block(f,d,st[flush]*d,self.open[f,j],self.high[f,j],self.low[f,j],self.close[f,j],order[starts[flush]]))
+            #candles of the batch closed by a later one
+            done=np.flatnonzero(~last)
+            blocks.append(self._block(gs[done],d,gb[done]*d,go[done],gh[done],gl[done],gc[done],order[starts[done+1]]))
+            l=gs[last]
+            self.start[l,j]=gb[last]
+            self.open[l,j],self.high[l,j],self.low[l,j],self.close[l,j]=go[last],gh[last],gl[last],gc[last]
+        ret=np.concatenate(blocks)
+        ret=ret[np.lexsort((ret['duration'],ret['closed_by']))]
+        if onclose is not None: self.emit(ret,onclose,value,timestamp)
+        return ret
+
+    def _block(self,symbol,duration,date,o,h,l,c,closed_by):
+        ret=np.empty(len(symbol),self.dtype)
+        ret['symbol'],ret['duration'],ret['date']=symbol,duration,date
+        ret['open'],ret['high'],ret['low'],ret['close']=o,h,l,c
+        ret['closed_by']=closed_by
+        return ret
+
+    def flush(self):
+        '''
+        Close and return all running candles, e.g. at the end of a stream.
+        closed_by is -1.
+        '''
+        i,j=np.nonzero(self.start>=0)
+        ret=self._block(i,self.durations[j],self.start[i,j]*self.durations[j],
+                        self.open[i,j],self.high[i,j],self.low[i,j],self.close[i,j],np.full(len(i),-1))
+        self.start[:]=-1
+        return ret
+
+    @staticmethod
+    def emit(closed,onclose,value,timestamp):
+        '''
+        Compatibility with Candle: call onclose(candle,(value,timestamp)) for
+        every closed candle, where candle is a Candle with open, close, high,
+        low, start_time and duration set and (value,timestamp) is the tick
+        which closed it.
+        '''
+        for c in closed:
+            candle=Candle(onclose,int(c['duration']))
+            candle.open,candle.close,candle.high,candle.low=c['open'],c['close'],c['high'],c['low']
+            candle.start_time=dt.utcfromtimestamp(c['date'])
+            k=c['closed_by']
+            candle.value=value[k]
+            candle.last_val=(value[k],timestamp[k])
+            onclose(candle,candle.last_val)
+
+class CandleBuffer(object):
+    '''
+    In-memory columns of CandleStorage, one preallocated numpy array per
+    column holding int64 dates and float64 prices. Rows live between start
+    and stop and are kept sorted by unique dates. Appending writes behind
+    stop and dropping the oldest rows advances start, both amortized O(1).
+    When stop reaches the end of the arrays, the rows are moved to the front
+    or the arrays are doubled.
+    '''
+    def __init__(self,cols,capacity=1024):
+        '''
+        :param list cols: column names, the first one holds the dates
+        :param int capacity: initial number of rows
+        '''
+        self.cols=cols
+        self.arrays=[np.empty(capacity,np.int64)]+[np.empty(capacity,np.float64) for _ in cols[1:]]
+        self.start=0
+        self.stop=0
+        
+    def __len__(self): return self.stop-self.start
+    
+    @property
+    def dates(self): return self.arrays[0][self.start:self.stop]
+    
+    def _reserve(self,n):
+        cap=len(self.arrays[0])
+        if self.stop+n<=cap: return
+        size=len(self)
+        if size+n>cap//2:
+            cap=max(2*cap,2*(size+n))
+            arrays=[np.empty(cap,a.dtype) for a in self.arrays]
+            for new,old in zip(arrays,self.arrays): new[:size]=old[self.start:self.stop]
+            self.arrays=arrays
+        else:
+            for a in self.arrays: a[:size]=a[self.start:self.stop].copy()
+        self.start,self.stop=0,size
+        
+    def insert(self,date,values,sort=True):
+        '''
+        Insert rows. Rows with a date already present are dropped, as are
+        repeated dates within date except the first.
+        :param np.ndarray date: int64 dates
+        :param list values: arrays of the other columns
+        :param bool sort: insert rows at their date, otherwise they are
+                          appended in the given order
+        @return: number of inserted rows
+        '''
+        if len(date)==1:
+            keep=np.ones(1,bool)
+        elif sort:
+            order=np.argsort(date,kind='mergesort')
+            date,values=date[order],[v[order] for v in values]
+            keep=np.concatenate(([True],date[1:]!=date[:-1]))
+        else:
+            keep=np.zeros(len(date),bool)
+            keep[np.unique(date,return_index=True)[1]]=True
+        dates=self.dates
+        tail=not len(dates) or (sort and date[0]>dates[-1])
+        if not tail: keep&=~np.in1d(date,dates)
+        date,values=date[keep],[v[keep] for v in values]
+        n=len(date)
+        if not n: return 0
+        if tail or not sort or date[0]>dates[-1]:
+            self._reserve(n)
+            for a,v in zip(self.arrays,[date]+values): a[self.stop:self.stop+n]=v
+        else:
+            pos=np.searchsorted(dates,date)
+            merged=[np.insert(a[self.start:self.stop],pos,v) for a,v in zip(self.arrays,[date]+values)]
+            self._reserve(n)
+            for a,v in zip(self.arrays,merged): a[self.start:self.start+len(v)]=v
+        self.stop+=n
+        return n
+    
+    def columns(self,a=0,b=None):
+        '''
+        Views of the rows a to b, valid until the next insert
+        '''
+        a,b,_=slice(a,b).indices(len(self))
+        return [x[self.start+a:self.start+max(a,b)] for x in self.arrays]
+    
+    def drop(self,n):
+        '''
+        Drop the n oldest rows
+        '''
+        self.start=min(self.stop,self.start+n)
+        if self.start==self.stop: self.start=self.stop=0
+        
+    def frame(self,a=0,b=None,offset=None):
+        '''
+        Copy the rows a to b into a DataFrame
+        :param int offset: index of row 0, defaults to a RangeIndex
+        '''
+        a,b,_=slice(a,b).indices(len(self))
+        cols=self.columns(a,b)
+        df=pd.DataFrame(dict(zip(self.cols[1:],[c.copy() for c in cols[1:]])),columns=self.cols)
+        df['date']=cols[0].copy().view('M8[ns]')
+        if offset is not None: df.index=np.arange(offset+a,offset+a+len(df))
+        return df
+
 class CandleStorage(object):
     '''
     The candlestorage manages all candles inside a dataframe. Its respnsible
@@ -58,124 +282,125 @@ class CandleStorage(object):
     be saved inside an sqlite file
     if more then the available data is requested, a sql query will fetch the
     remaining part.
-    
+    The candles in memory are held in a CandleBuffer.
     '''
     cols=['date','open','close','high','low']
-    def __init__(self,data=None,max_size=5000,min_size=2000,name='test.db',tablename='stock'):
+    def __init__(self,data=None,max_size=5000,min_size=2000,name='test.db',tablename='stock',
+                 journal_mode='WAL',synchronous=None):
         '''
         :param pd.DataFrame data:
         :param max_size: max amount af data to save in memory.
         :param min_size: min amount of data to save in memory
+        :param journal_mode: sqlite journal_mode pragma, e.g. WAL, OFF, DELETE
+        :param synchronous: sqlite synchronous pragma, None keeps the sqlite default
         '''
-        self.data = data or pd.DataFrame(columns=self.cols)
-        self.idx=self.data.index.max() if data is not None else -1
+        self.buffer=CandleBuffer(self.cols,2*(max_size+1))
         self.name=name
         self.tablename=tablename
-        self._conn=sqlite3.connect(name)
         self._name=name
-        self.tid=threading.current_thread().ident
+        self.pool=ConnectionPool(name,journal_mode,synchronous)
         self.max_size=max_size
         self.min_size=min_size
         self.last_saved_idx=-1
         self.create_table()
-        self.len=len(self.data)
-        self._conns={}
+        self.len=0
+        if data is not None: self.append(data)
+    
+    @property
+    def data(self):
+        '''
+        The candles in memory as DataFrame indexed by idx
+        '''
+        return self.buffer.frame(offset=self.last_saved_idx+1)
+    
+    @property
+    def idx(self): return self.last_saved_idx+len(self.buffer)
     
     @property
     def conn(self):
-        tid=threading.current_thread().ident
-        if self.tid==tid: return self._conn
-        con=self._conns.get(tid,sqlite3.connect(self._name))
-        self._conns[tid]=con
-        return con
+        '''
+        returns the sqlite connection of the calling thread
+        '''
+        return self.pool.conn
+    
+    def close(self):
+        '''
+        Finish pending writes and close all connections
+        '''
+        self.pool.close()
+        
     def append(self,candles,sort_date=True):
         '''
         append a candle
         :param list candles: a list of :class: Candle
         :param bool sort_date (optional): Wether to sort by date. Default = True
         :type candle:Candle
+        Candles with a date already in memory are dropped.
         '''
-        dlen=len(self.data)
-        
+        if not len(candles): return
         if isinstance(candles,np.ndarray):
             candles=pd.DataFrame(candles)
             candles.columns=self.cols
-        if type(candles)==list and type(candles[0])==Candle:
-            for candle in candles:
-                self.data.loc[self.idx+1]=(candle.start_time,candle.open,candle.close,candle.high,candle.low)
-                self.idx+=1
-        elif type(candles)==pd.DataFrame:
-            #reindex
-            candles.index=np.arange(self.idx+1,self.idx+1+len(candles))
-            self.data=self.data.append(candles)
-            self.idx=self.idx+1+len(candles)
+        if type(candles)==pd.DataFrame:
+            date=to_ns(candles.date)
+            values=[candles[c].values.astype(np.float64) for c in self.cols[1:]]
         else:
-            candles=np.array(candles)
-            for candle in candles:
-                self.data.loc[self.idx+1]=tuple(candle)
-                self.idx+=1
-        self.data=self.data.drop_duplicates('date')
-        self.len+=len(self.data)-dlen  
-        
-        if sort_date: 
-            self.data=self.data.sort_values('date')
-        self.data.set_index(np.arange(len(self.data))+self.last_saved_idx+1)
-        
+            #few candles at a time, avoid building a DataFrame
+            if type(candles[0])==Candle: candles=[(c.start_time,c.open,c.close,c.high,c.low) for c in candles]
+            date=np.array([pd.Timestamp(c[0]).value for c in candles],dtype=np.int64)
+            values=list(np.array([tuple(c)[1:] for c in candles],dtype=np.float64).T)
+        self.len+=self.buffer.insert(date,values,sort_date)
         self.free()
         
     def free(self):
-        if len(self.data)>self.max_size:
-            df=self.data.iloc[:-self.min_size]
-            self.data=self.data.iloc[-self.min_size:]
-            #save df to sql
-            c=self.conn.cursor()
-            idx=df.index
-            self.last_saved_idx=idx[-1]
-            date=df.date.map(dt_to_int)
-            vals=np.array([idx,date,df.open,df.close,df.high,df.low]).T
-            c.executemany("replace into {tn}  values (?,?,?,?,?,?)".format(tn=self.tablename), vals)
-            self.conn.commit()
-        
+        '''
+        Save the oldest candles in one block to sql if more than max_size are
+        held in memory, keeping min_size
+        '''
+        if len(self.buffer)>self.max_size:
+            n=len(self.buffer)-self.min_size
+            cols=self.buffer.columns(0,n)
+            idx=np.arange(self.last_saved_idx+1,self.last_saved_idx+1+n)
+            vals=zip(idx.tolist(),(cols[0]//S).tolist(),*[c.tolist() for c in cols[1:]])
+            self.pool.write(lambda conn: conn.executemany("replace into {tn}  values (?,?,?,?,?,?)".format(tn=self.tablename), vals))
+            self.buffer.drop(n)
+            self.last_saved_idx=int(idx[-1])
     
+    def _read_sql(self,col,a,b):
+        r=pd.read_sql("select * from {tn} where {col}>=? and {col}<?".format(tn=self.tablename,col=col),
+                      self.conn,
+                      index_col='idx',
+                      params=(a,b),
+                      )
+        r['date']=ints_to_dates(r.date.values)
+        return r
+        
     def __getslice__(self,i,j):
 
         if isinstance(i,(str,datetime)): return self._get_date_slice(i,j)
+        if i is None: i=0
+        if j is None: j=self.__len__()
         i=max(0,self.__len__()+i) if i<0 else i
         j=j%self.__len__() if j<0 else j
-        if i<self.last_saved_idx or j<self.last_saved_idx:
-            isql=min(i,self.last_saved_idx)
-            jsql=min(j,self.last_saved_idx+1)
-            print jsql,isql
-            
-            r=pd.read_sql("select * from {tn} where idx>=? and idx<?".format(tn=self.tablename),
-                          self.conn,
-                          index_col='idx',
-                          params=(isql,jsql),
-                          #parse_dates={'date':'s'}
-                          )
-            r['date']=r.date.map(ts_to_dt)
-            return r.append(self.data.loc[self.last_saved_idx:j-1])#.sort_index()
-        return self.data.loc[i:j]
+        saved=self.last_saved_idx
+        if i<saved or j<saved:
+            r=self._read_sql('idx',min(i,saved),min(j,saved+1))
+            return r.append(self.buffer.frame(0,max(0,j-1-saved),saved+1))
+        return self.buffer.frame(max(0,i-saved-1),max(0,j-saved),saved+1)
     
     def _get_date_slice(self,i,j):
         i=pd.to_datetime(i) if i else dt(year=1971,month=1,day=1)
         j=pd.to_datetime(j) if j else dt(year=2200,month=1,day=1)
-        last_saved_date=self.data.loc[self.last_saved_idx+1].date
+        dates=self.buffer.dates
+        if not len(dates): return self._read_sql('date',dt_to_int(i),dt_to_int(j))
+        last_saved_date=pd.Timestamp(dates[0])
+        b=dates.searchsorted(pd.Timestamp(j).value,'right')
         if i<last_saved_date or j<last_saved_date:
             isql=min(i,last_saved_date)
             jsql=min(j,last_saved_date)
-            print jsql,isql
-            
-            r=pd.read_sql("select * from {tn} where date>=? and date<?".format(tn=self.tablename),
-                          self.conn,
-                          index_col='idx',
-                          params=(dt_to_int(isql),dt_to_int(jsql)),
-                          #parse_dates={'date':'s'}
-                          )
-            #idx=self.data.index
-            r['date']=r.date.map(ts_to_dt)
-            return r.append(self.data.set_index('date')[last_saved_date:j].reset_index())#.sort_index()
-        return self.data.set_index('date')[i:j].reset_index()        
+            r=self._read_sql('date',dt_to_int(isql),dt_to_int(jsql))
+            return r.append(self.buffer.frame(0,b))
+        return self.buffer.frame(dates.searchsorted(pd.Timestamp(i).value),b)
     
     def __getitem__(self,key):
         if self.len==0: return self.data
@@ -191,18 +416,28 @@ class CandleStorage(object):
             return self.__getslice__(start,end)
         
         elif isinstance(key,datetime):
-            return pd.read_sql("select * from {tn} where date=?".format(tn=self.tablename),
-              self.conn,
-              index_col='idx',
-              params=(dt_to_int(key)),
-              parse_dates={'date':'s'}
-              ).iloc[0]
+            dates=self.buffer.dates
+            k=dates.searchsorted(pd.Timestamp(key).value)
+            if k<len(dates) and dates[k]==pd.Timestamp(key).value:
+                return self.buffer.frame(k,k+1,self.last_saved_idx+1).iloc[0]
+            t=dt_to_int(key)
+            return self._read_sql('date',t,t+1).iloc[0]
     def __setslice__(self,i,j,seq):
-        
-        self.data[i:j]=seq
+        df=self.data
+        df[i:j]=seq
+        self._reset(df)
     
     def __delslice__(self,i,j):
-        return self.data.__delslice__(i,j)
+        df=self.data
+        self._reset(df.drop(df.index[i:j]))
+        
+    def _reset(self,df):
+        '''
+        Replace the candles in memory by df
+        '''
+        self.len-=len(self.buffer)
+        self.buffer=CandleBuffer(self.cols,len(self.buffer.arrays[0]))
+        self.len+=self.buffer.insert(to_ns(df.date),[df[c].values.astype(np.float64) for c in self.cols[1:]])
     
     def __len__(self): 
         #c=self.conn.cursor()
@@ -210,10 +445,10 @@ class CandleStorage(object):
         return self.len#c.fetchone()[0]+len(self.data)
     
     def create_table(self):
-        c=self.conn.cursor()
-        c.execute("PRAGMA journal_mode=OFF;")
+        self.pool.write(self._create_table)
         
-        self.conn.commit()
+    def _create_table(self,conn):
+        c=conn.cursor()
         c.executescript("""
         create table if not exists {tn}(
                     idx INTEGER PRIMARY KEY,
@@ -225,58 +460,150 @@ class CandleStorage(object):
                     );
         """.format(tn=self.tablename))
         c.execute("CREATE UNIQUE INDEX IF NOT EXISTS {tn}_index on {tn} (date)".format(tn=self.tablename))
-        self.conn.commit()
         
     def clear(self):
-        self.conn.execute("drop table if exists {tn}".format(tn=self.tablename))
+        self.pool.write(lambda conn: conn.execute("drop table if exists {tn}".format(tn=self.tablename)))
         self.create_table()
-        self.conn.commit()
         
-from time import mktime
 from datetime import datetime as DT
+from collections import OrderedDict
+from itertools import chain
+from pandas.tseries.frequencies import to_offset
+from Queue import Queue,Full
+import sys
+
+class RangeCache(object):
+    '''
+    LRU cache of the DataFrames CandleStorage2 read for [start,stop) ranges of
+    date or rowid. A date range contained in a cached one is sliced out of it.
+    The least recently used ranges are dropped if the cache grows beyond
+    max_bytes.
+    generation counts invalidations; a frame read before an invalidation is
+    not cached, since it may miss the write of another thread.
+    '''
+    def __init__(self,max_bytes=2**26):
+        '''
+        :param int max_bytes: max size of all cached frames in bytes
+        '''
+        self.max_bytes=max_bytes
+        self.bytes=0
+        self.generation=0
+        self.entries=OrderedDict()
+        self._lock=threading.Lock()
+
+    def get(self,col,a,b):
+        '''
+        Return a copy of the cached frame of col in [a,b) or None
+        '''
+        with self._lock:
+            key=(col,a,b)
+            if key not in self.entries and col=='date':
+                key=next((k for k in reversed(self.entries) if k[0]=='date' and k[1]<=a and b<=k[2]),None)
+            if key is None or key not in self.entries: return None
+            dates,df,size=self.entries.pop(key)
+            self.entries[key]=(dates,df,size)
+        if key!=(col,a,b):
+            i,j=dates.searchsorted([a,b])
+            return df.iloc[i:j].reset_index(drop=True)
+        return df.copy()
+
+    def put(self,col,a,b,dates,df,generation=None):
+        '''
+        :param np.ndarray dates: the int dates of df, used to slice subranges
+        :param int generation: the generation before df was read
+        '''
+        size=dates.nbytes+int(df.memory_usage(index=True).sum())
+        if size>self.max_bytes: return
+        with self._lock:
+            if generation is not None and generation!=self.generation: return
+            old=self.entries.pop((col,a,b),None)
+            if old: self.bytes-=old[2]
+            self.entries[(col,a,b)]=(dates,df,size)
+            self.bytes+=size
+            while self.bytes>self.max_bytes:
+                self.bytes-=self.entries.popitem(last=False)[1][2]
+
+    def invalidate(self,a=None,b=None):
+        '''
+        Drop date ranges overlapping the dates [a,b] and all rowid ranges,
+        since replacing rows changes their rowids. Without arguments
+        everything is dropped.
+        '''
+        with self._lock:
+            self.generation+=1
+            for k in list(self.entries):
+                if a is None or k[0]!='date' or (k[1]<=b and a<k[2]):
+                    self.bytes-=self.entries.pop(k)[2]
 
 
 class CandleStorage2():
     cols=['date','open','close','high','low']
-    def __init__(self,data=None,max_size=5000,min_size=2000,name='test.db',tablename='stock'):
+    #a NaN is saved as NULL
+    select="date,ifnull(open,'nan'),ifnull(close,'nan'),ifnull(high,'nan'),ifnull(low,'nan')"
+    def __init__(self,data=None,max_size=5000,min_size=2000,name='test.db',tablename='stock',
+                 journal_mode='WAL',synchronous=None,cache_size=2**26,rollups=(),gaps=None):
         '''
         :param pd.DataFrame data:
         :param max_size: max amount af data to save in memory.
         :param min_size: min amount of data to save in memory
         :param name: db filename
         :param tablename: tablename 
+        :param journal_mode: sqlite journal_mode pragma, e.g. OFF, WAL, DELETE
+        :param synchronous: sqlite synchronous pragma, e.g. OFF, NORMAL, FULL.
+                            None keeps the sqlite default
+        :param cache_size: bytes of recently read ranges kept in memory,
+                           0 disables the cache. It is dropped whenever
+                           another connection or process changed the db
+        :param rollups: timeframes to keep rollup tables for, see add_rollup
+        :param gaps: timeframe of the candles to keep a gap index for, see add_gap_index
         '''
         self.data = data or pd.DataFrame(columns=self.cols)
         self.idx=self.data.index.max() if data is not None else -1
         self.name=name
-        self._conn=sqlite3.connect(name)
         self._name=name
-        self.tid=threading.current_thread().ident
+        self.pool=ConnectionPool(name,journal_mode,synchronous)
         self.max_size=max_size
         self.min_size=min_size
         self.last_saved_idx=-1
         self.len=0
         self.tablename=tablename
+        self.journal_mode=journal_mode
+        self.synchronous=synchronous
+        self.cache=RangeCache(cache_size) if cache_size else None
+        self._version=None
+        self._version_lock=threading.Lock()
+        self.rollups=set()
+        self.gap_step=None
         self.create_table()
+        for freq in rollups: self.add_rollup(freq)
+        if gaps is not None: self.add_gap_index(gaps)
         if len(self.data): self.append(self.data)
         
     @property
     def conn(self):
         '''
-        returns the sqlite connection. If called from another thread this property
-        returns a new sqlite connection
+        returns the sqlite connection of the calling thread. Writes go through
+        self.pool.write
+        '''
+        return self.pool.conn
+    
+    def close(self):
         '''
-        if self.tid==threading.current_thread().ident: return self._conn
-        return sqlite3.connect(self._name)
-    def append(self,df,update=True):
+        Finish pending writes and close all connections
+        '''
+        self.pool.close()
+        with self._version_lock:
+            if self._version: self._version[0].close()
+            self._version=None
+        
+    def append(self,df,update=True,batchsize=None):
         '''
         :param pd.DataFrame df: a Pandas Datafram to append
+        :param bool update: replace rows with equal dates
+        :param int batchsize: commit after every batchsize rows, defaults to
+                              a single commit
         '''
         if len(df)==0:return 0
-        conn=self.conn
-        c=conn.cursor()
-        #idx=df.index
-        #self.last_saved_idx=idx[-1]
         op='insert'
         if update: op='replace'
         if not isinstance(df, pd.DataFrame):
@@ -284,20 +611,83 @@ class CandleStorage2():
             df=(df.set_index('date')*1e-6).reset_index()
             df['ddate']=df.date.map(ts_to_dt)
             print df
-        date=df.date
-        if isinstance(df.date.iloc[0],dt): date=df.date.map(dt_to_int)
-        vals=np.array([date,df.open,df.close,df.high,df.low]).T
-        c.executemany(op+" into {tn}  values (?,?,?,?,?)".format(tn=self.tablename), vals)
+        lo,hi=self.pool.write(self._append,df,op,batchsize)
+        if self.cache: self.cache.invalidate(lo,hi)
         self.len+=len(df)
+        
+    def _append(self,conn,df,op,batchsize=None):
+        lo,hi=self._insert(conn,df,op,batchsize)
+        self._update_rollups(conn,lo,hi)
+        self._update_gaps(conn,lo,hi)
+        return lo,hi
+        
+    def _insert(self,conn,df,op,batchsize=None):
+        '''
+        insert df with executemany, committing every batchsize rows
+        @return: first and last inserted date
+        '''
+        date=df.date.values
+        if isinstance(df.date.iloc[0],dt): date=dates_to_int(df.date)
+        date=np.asarray(date,dtype=np.int64)
+        cols=[date.tolist()]+[df[c].values.astype(np.float64).tolist() for c in self.cols[1:]]
+        sql=op+" into {tn}  values (?,?,?,?,?)".format(tn=self.tablename)
+        batchsize=batchsize or len(df)
+        for i in range(0,len(df),batchsize):
+            conn.executemany(sql,zip(*[c[i:i+batchsize] for c in cols]))
+            if i+batchsize<len(df): conn.commit()
+        return date.min(),date.max()
+        
+    def bulk_load(self,frames,batchsize=2**16,defer_index=True):
+        '''
+        Load many DataFrames, committing every batchsize rows.
+        If defer_index is set, the unique date index is dropped during the
+        load and rebuilt afterwards. Of rows with equal dates the one loaded
+        last is kept, like append(update=True).
+        :param frames: a DataFrame or an iterable of DataFrames
+        @return: number of loaded rows
+        '''
+        try: return self.pool.write(self._bulk_load,frames,batchsize,defer_index)
+        finally:
+            if self.cache: self.cache.invalidate()
+    
+    def _bulk_load(self,conn,frames,batchsize,defer_index):
+        if isinstance(frames,pd.DataFrame): frames=[frames]
+        if defer_index: conn.execute("DROP INDEX IF EXISTS {tn}_index".format(tn=self.tablename))
+        n=0
+        lo,hi=[],[]
+        try:
+            for df in frames:
+                if not len(df): continue
+                a,b=self._insert(conn,df,'insert' if defer_index else 'replace',batchsize)
+                lo.append(a)
+                hi.append(b)
+                n+=len(df)
+            conn.commit()
+        finally:
+            if defer_index:
+                #a failing create index can not be rolled back with journal_mode=OFF
+                tn=self.tablename
+                if conn.execute("select count(*)-count(distinct date) from {tn}".format(tn=tn)).fetchone()[0]:
+                    conn.execute("delete from {tn} where rowid not in (select max(rowid) from {tn} group by date)".format(tn=tn))
+                self._create_index(conn)
+            self.len=conn.execute("select count(*) from {tn}".format(tn=self.tablename)).fetchone()[0]
+        if n:
+            self._update_rollups(conn,min(lo),max(hi))
+            self._update_gaps(conn,min(lo),max(hi))
+        return n
+        
+    def _create_index(self,conn):
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS {tn}_index on {tn} (date)".format(tn=self.tablename))
         conn.commit()
+        
     def create_table(self):
         '''
         Create the initial sqlite-table if not exists
         '''
-        c=self.conn.cursor()
-        c.execute("PRAGMA journal_mode=OFF;")
+        self.pool.write(self._create_table)
         
-        self.conn.commit()
+    def _create_table(self,conn):
+        c=conn.cursor()
         c.executescript("""
         create table if not exists {tn}(
                     date INTEGER,
@@ -307,17 +697,228 @@ class CandleStorage2():
                     low FLOAT
                     );
         """.format(tn=self.tablename))
-        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS {tn}_index on {tn} (date)".format(tn=self.tablename))
-        self.conn.commit()
+        self._create_index(conn)
         self.len=c.execute("select count(*) from {tn}".format(tn=self.tablename)).fetchone()[0]
+        prefix=self._rollup_table('')
+        for name, in c.execute("select name from sqlite_master where type='table' and substr(name,1,?)=?",(len(prefix),prefix)):
+            self.rollups.add(int(name[len(prefix):]))
+        prefix=self._gap_table('')
+        for name, in c.execute("select name from sqlite_master where type='table' and substr(name,1,?)=?",(len(prefix),prefix)):
+            self.gap_step=int(name[len(prefix):])
         
     def clear(self):
         '''
         Clear the database
         '''
-        self.conn.execute("drop table if exists {tn}".format(tn=self.tablename))
+        def clear(conn):
+            conn.execute("drop table if exists {tn}".format(tn=self.tablename))
+            for step in self.rollups: conn.execute("delete from {rt}".format(rt=self._rollup_table(step)))
+            if self.gap_step: conn.execute("delete from {gt}".format(gt=self._gap_table(self.gap_step)))
+        self.pool.write(clear)
+        if self.cache: self.cache.invalidate()
         self.create_table()
-        self.conn.commit()
+        
+    def dates_from_local(self,tz=None,days=30):
+        '''
+        Migrate a table written before dates were UTC on a machine in time
+        zone tz. Its dates hold the unix time of the local clock (mktime)
+        and are read back shifted by the offset of the zone. They are
+        rewritten to the same clock time taken as UTC, as naive datetimes
+        are saved now. Run it once per table.
+        The rows are copied in chunks of days into a new table, which
+        replaces the table in the same transaction, so the table is left
+        untouched if the migration fails.
+        :param tz: zone name like 'Europe/Berlin', defaults to the local zone
+        :param days: days of dates per chunk
+        @return: number of rows
+        '''
+        try: return self.pool.write(self._dates_from_local,tz or tzlocal(),days*86400)
+        finally:
+            if self.cache: self.cache.invalidate()
+
+    def _dates_from_local(self,conn,tz,chunk):
+        tn=self.tablename
+        tmp=tn+'_migrate'
+        #the sqlite3 module commits before create, drop and alter unless
+        #isolation_level is None
+        isolation_level=conn.isolation_level
+        conn.isolation_level=None
+        try:
+            conn.execute("BEGIN")
+            conn.execute("drop table if exists {tmp}".format(tmp=tmp))
+            conn.execute("create table {tmp} (date INTEGER,open FLOAT,close FLOAT,high FLOAT,low FLOAT)".format(tmp=tmp))
+            lo,hi=conn.execute("select min(date),max(date) from {tn}".format(tn=tn)).fetchone()
+            for a in range(lo,hi+1,chunk) if lo is not None else []:
+                rows=conn.execute("select date,open,close,high,low from {tn} where date>=? and date<? order by date".format(tn=tn),
+                                  (a,a+chunk)).fetchall()
+                if not rows: continue
+                date=np.array([r[0] for r in rows],dtype=np.int64)*S
+                local=pd.DatetimeIndex(date).tz_localize('UTC').tz_convert(tz).tz_localize(None).asi8//S
+                conn.executemany("insert into {tmp} values (?,?,?,?,?)".format(tmp=tmp),
+                                 ((d,)+r[1:] for d,r in zip(local.tolist(),rows)))
+            conn.execute("drop table {tn}".format(tn=tn))
+            conn.execute("alter table {tmp} rename to {tn}".format(tmp=tmp,tn=tn))
+            #of the clock times repeated when dst ends the later one is kept
+            conn.execute("delete from {tn} where rowid not in (select max(rowid) from {tn} group by date)".format(tn=tn))
+            conn.execute("create unique index {tn}_index on {tn} (date)".format(tn=tn))
+            for step in self.rollups:
+                conn.execute("delete from {rt}".format(rt=self._rollup_table(step)))
+                conn.execute("insert into {rt} ".format(rt=self._rollup_table(step))+self._resample_sql(step),(0,2**62))
+            if self.gap_step:
+                conn.execute("delete from {gt}".format(gt=self._gap_table(self.gap_step)))
+                conn.execute("insert into {gt} ".format(gt=self._gap_table(self.gap_step))+self._holes_sql(self.gap_step),(0,2**62))
+            self.len=conn.execute("select count(*) from {tn}".format(tn=tn)).fetchone()[0]
+            return self.len
+        finally: conn.isolation_level=isolation_level
+
+    def _rollup_table(self,step): return "{tn}_rollup_{step}".format(tn=self.tablename,step=step)
+    
+    def _resample_sql(self,step,select='date,open,close,high,low'):
+        '''
+        select candles of step seconds aggregated from the rows with ?<=date<?.
+        Open and close are those of the first and last row in a bucket.
+        '''
+        return '''select {sel} from
+            (select g.bucket*{step} as date,o.open as open,c.close as close,g.high as high,g.low as low from
+            (select date/{step} as bucket,min(date) as first,max(date) as last,max(high) as high,min(low) as low
+             from {tn} where date>=? and date<? group by bucket) g
+            join {tn} o on o.date=g.first join {tn} c on c.date=g.last)
+            order by date'''.format(sel=select,tn=self.tablename,step=step)
+    
+    def add_rollup(self,freq):
+        '''
+        Keep a table with the candles of timeframe freq, filled from the saved
+        candles and updated with every append. resample then reads from it.
+        Rollup tables are found again when the database is opened.
+        :param freq: a fixed frequency like '1h' or seconds
+        '''
+        step=freq_seconds(freq)
+        if step not in self.rollups: self.pool.write(self._add_rollup,step)
+        
+    def _add_rollup(self,conn,step):
+        conn.executescript('''
+        create table if not exists {rt}(
+                    date INTEGER,
+                    open FLOAT,
+                    close FLOAT,
+                    high FLOAT,
+                    low FLOAT
+                    );
+        create unique index if not exists {rt}_index on {rt} (date);
+        '''.format(rt=self._rollup_table(step)))
+        conn.execute("replace into {rt} ".format(rt=self._rollup_table(step))+self._resample_sql(step),(0,2**62))
+        self.rollups.add(step)
+        
+    def drop_rollup(self,freq):
+        step=freq_seconds(freq)
+        def drop(conn):
+            conn.execute("drop table if exists {rt}".format(rt=self._rollup_table(step)))
+            self.rollups.discard(step)
+        self.pool.write(drop)
+        
+    def _update_rollups(self,conn,lo,hi):
+        '''
+        Recompute the rollup candles of the buckets containing the dates lo to hi
+        '''
+        for step in self.rollups:
+            conn.execute("replace into {rt} ".format(rt=self._rollup_table(step))+self._resample_sql(step),
+                         (lo//step*step,(hi//step+1)*step))
+    
+    def _gap_table(self,step): return "{tn}_gaps_{step}".format(tn=self.tablename,step=step)
+    
+    def _holes_sql(self,step):
+        '''
+        select the holes (first missing date,next saved date) between the rows
+        with ?<=date<=? more than step seconds apart
+        '''
+        return '''select prev+{step},date from
+            (select lag(date) over (order by date) as prev,date from {tn} where date>=? and date<=?)
+            where date-prev>{step}'''.format(tn=self.tablename,step=step)
+    
+    def add_gap_index(self,freq):
+        '''
+        Keep a table of the holes between the saved candles, i.e. consecutive
+        candles more than freq apart, updated with every append. gaps then
+        reads from it. A table has one gap index, which is found again when
+        the database is opened.
+        :param freq: the timeframe of the candles like '5s' or seconds
+        '''
+        step=freq_seconds(freq)
+        if step!=self.gap_step: self.pool.write(self._add_gap_index,step)
+    
+    def _add_gap_index(self,conn,step):
+        if self.gap_step: conn.execute("drop table if exists {gt}".format(gt=self._gap_table(self.gap_step)))
+        gt=self._gap_table(step)
+        conn.executescript('''
+        create table if not exists {gt}(
+                    start INTEGER,
+                    stop INTEGER
+                    );
+        create unique index if not exists {gt}_index on {gt} (start);
+        '''.format(gt=gt))
+        conn.execute("insert into {gt} ".format(gt=gt)+self._holes_sql(step),(0,2**62))
+        self.gap_step=step
+    
+    def drop_gap_index(self):
+        def drop(conn):
+            if self.gap_step: conn.execute("drop table if exists {gt}".format(gt=self._gap_table(self.gap_step)))
+            self.gap_step=None
+        self.pool.write(drop)
+    
+    def _update_gaps(self,conn,lo,hi):
+        '''
+        Recompute the holes between the saved candles next to the dates lo and hi
+        '''
+        if not self.gap_step: return
+        tn,gt=self.tablename,self._gap_table(self.gap_step)
+        a=conn.execute("select ifnull(max(date),?) from {tn} where date<?".format(tn=tn),(lo,lo)).fetchone()[0]
+        b=conn.execute("select ifnull(min(date),?) from {tn} where date>?".format(tn=tn),(hi,hi)).fetchone()[0]
+        conn.execute("delete from {gt} where start>? and stop<=?".format(gt=gt),(a,b))
+        conn.execute("insert into {gt} ".format(gt=gt)+self._holes_sql(self.gap_step),(a,b))
+    
+    def gaps(self,start=None,end=None,freq=None):
+        '''
+        The holes between saved candles more than freq apart, read from the
+        gap index if freq is its timeframe, else computed. Missing candles
+        before the first or after the last saved one are not holes.
+        :param start: first date, holes ending after it are included
+        :param end: last date (exclusive), holes starting before it are included
+        :param freq: timeframe of the candles, defaults to that of the gap index
+        @return: list of (first missing date,next saved date) as pd.Timestamp
+        '''
+        a=int(dt_to_int(pd.to_datetime(start))) if start is not None else 0
+        b=int(dt_to_int(pd.to_datetime(end))) if end is not None else 2**62
+        step=freq_seconds(freq) if freq is not None else self.gap_step
+        if step is None: raise ValueError("no gap index, pass freq")
+        if step==self.gap_step:
+            rows=self.conn.execute("select start,stop from {gt} where stop>? and start<? order by start".format(gt=self._gap_table(step)),(a,b))
+        else:
+            #holes reaching into the range from saved candles outside of it
+            tn=self.tablename
+            lo=self.conn.execute("select ifnull(max(date),?) from {tn} where date<?".format(tn=tn),(a,a)).fetchone()[0]
+            hi=self.conn.execute("select ifnull(min(date),?) from {tn} where date>=?".format(tn=tn),(b,b)).fetchone()[0]
+            rows=self.conn.execute(self._holes_sql(step)+" order by date",(lo,hi))
+        return [(pd.Timestamp(ts_to_dt(x)),pd.Timestamp(ts_to_dt(y))) for x,y in rows if y>a and x<b]
+    
+    def resample(self,freq,start=None,end=None):
+        '''
+        Aggregate the saved candles into candles of timeframe freq inside
+        sqlite. Buckets are aligned to multiples of freq since the epoch,
+        open and close are those of the first and last candle in a bucket.
+        Buckets without candles are left out.
+        :param freq: a fixed frequency like '1h' or seconds
+        :param start: first date, the bucket containing it is included
+        :param end: last date (exclusive), the bucket containing it is included
+        @return: pd.DataFrame like __getitem__
+        '''
+        step=freq_seconds(freq)
+        a=int(dt_to_int(pd.to_datetime(start)))//step*step if start is not None else 0
+        b=-(-int(dt_to_int(pd.to_datetime(end)))//step)*step if end is not None else 2**62
+        if step in self.rollups:
+            sql="select {sel} from {rt} where date>=? and date<? order by date".format(sel=self.select,rt=self._rollup_table(step))
+        else:
+            sql=self._resample_sql(step,self.select)
+        return self._fetch(sql,(a,b))[1]
     
     @property
     def max_date(self):
@@ -371,30 +972,226 @@ class CandleStorage2():
             a=min(2**32,a+2)
             b=min(2**32,b+2)
         
-        ret=pd.read_sql("select * from {tn} where {col}>=? and {col}<? order by date".format(col=col,tn=self.tablename),
-          self.conn,
-          #index_col='idx',
-          params=(a,b),
-          #parse_dates={'date':'s'}
-          )
-        ret.date=ret.date.map(ts_to_dt)
+        return self._read(col,a,b)
+    
+    def _read(self,col,a,b):
+        '''
+        Read rows with a<=col<b into numpy columns, served from the cache if possible
+        '''
+        if self.cache:
+            self._check_version()
+            ret=self.cache.get(col,a,b)
+            if ret is not None: return ret
+            generation=self.cache.generation
+        dates,ret=self._fetch("select {sel} from {tn} where {col}>=? and {col}<? order by date".format(sel=self.select,col=col,tn=self.tablename),(a,b))
+        if self.cache:
+            self.cache.put(col,a,b,dates,ret,generation)
+            ret=ret.copy()
         return ret
+    
+    def _check_version(self):
+        '''
+        Drop the cache if the db changed since the last check, including
+        writes of other instances and processes. PRAGMA data_version of a
+        connection kept for this changes with every commit of any other
+        connection.
+        '''
+        with self._version_lock:
+            if self._version is None:
+                conn=sqlite3.connect(self.name,timeout=self.pool.timeout,check_same_thread=False)
+                self._version=[conn,None]
+            version=self._version[0].execute("PRAGMA data_version").fetchone()[0]
+            changed=version!=self._version[1]
+            self._version[1]=version
+        if changed: self.cache.invalidate()
+
+    def _fetch(self,sql,params):
+        '''
+        Run a query selecting cols with NULL as 'nan' straight into numpy
+        @return: (int dates,pd.DataFrame)
+        '''
+        dates,arr=self._fetch_array(sql,params)
+        ret=pd.DataFrame(dict(zip(self.cols[1:],arr[:,1:].T)),columns=self.cols)
+        ret['date']=ints_to_dates(dates)
+        return dates,ret
+    
+    def _fetch_array(self,sql,params):
+        '''
+        @return: (int dates,float64 array with a column per col)
+        '''
+        cur=self.conn.execute(sql,params)
+        arr=np.fromiter(chain.from_iterable(cur),dtype=np.float64).reshape(-1,len(self.cols))
+        return arr[:,0].astype(np.int64),arr
+    
+    def iter_range(self,start=None,end=None,chunksize=2**16,prefetch=False,arrays=False):
+        '''
+        Iterate over the rows with start<=date<end in chunks of at most
+        chunksize rows, so only one or, with prefetch, two chunks are in
+        memory at a time. Each chunk is read with its own query continuing
+        after the last date of the one before (keyset pagination on the date
+        index), rows appended meanwhile behind that date are included.
+        Chunks are not cached.
+        :param start: first date, defaults to the first saved one
+        :param end: last date (exclusive), defaults to after the last saved one
+        :param int chunksize: rows per chunk
+        :param bool prefetch: read the next chunk in a background thread
+                              while the current one is processed
+        :param bool arrays: yield dicts of numpy columns instead of
+                            pd.DataFrames, date as datetime64[ns]
+        '''
+        a=dt_to_int(pd.to_datetime(start)) if start is not None else 0
+        b=dt_to_int(pd.to_datetime(end)) if end is not None else 2**62
+        chunks=self._iter_chunks(int(a),int(b),chunksize,arrays)
+        return prefetched(chunks,self.pool.release) if prefetch else chunks
+    
+    def _iter_chunks(self,a,b,chunksize,arrays):
+        sql="select {sel} from {tn} where date>=? and date<? order by date limit ?".format(sel=self.select,tn=self.tablename)
+        while a<b:
+            if arrays:
+                dates,arr=self._fetch_array(sql,(a,b,chunksize))
+                chunk=dict(zip(self.cols[1:],arr[:,1:].T))
+                chunk['date']=ints_to_dates(dates)
+            else: dates,chunk=self._fetch(sql,(a,b,chunksize))
+            if len(dates): yield chunk
+            if len(dates)<chunksize: return
+            a=dates[-1]+1
     def __len__(self): return self.len
     
-    def is_complete(self):
-        mi=self.min_date
-        ma=self.max_date
-        freq=(self[1].date-self[0].date).iloc[0].total_seconds()
-        if (ma-mi).total_seconds()/freq==len(self): return True
-        return False
+    def is_complete(self,freq=None):
+        '''
+        True if there are no holes between the saved candles, see gaps
+        :param freq: timeframe of the candles, defaults to that of the gap
+                     index, else the shortest distance between two candles
+        '''
+        if freq is None and self.gap_step is None:
+            freq=self.min_step()
+            if freq is None: return True
+        return not self.gaps(freq=freq)
+    
+    def min_step(self):
+        '''
+        The shortest distance between two saved candles in seconds, None if
+        there are less than two
+        '''
+        return self.conn.execute("select min(date-prev) from (select lag(date) over (order by date) as prev,date from {tn})".format(tn=self.tablename)).fetchone()[0]
             
     
+instrument(CandleStorage2,'append','storage.append',rows=lambda ret,self,df,*a: len(df))
+instrument(CandleStorage2,'bulk_load','storage.bulk_load',rows=lambda ret,*a: ret)
+instrument(CandleStorage2,'_update_rollups','storage.rollups')
+instrument(CandleStorage2,'_read','storage.read',rows=lambda ret,*a: len(ret))
+instrument(CandleStorage2,'_fetch_array','storage.fetch',rows=lambda ret,*a: len(ret[0]))
+instrument(CandleStorage2,'resample','storage.resample',rows=lambda ret,*a: len(ret))
+    
+def panel(storage,tables,start=None,end=None,field='close',fill=True,how='outer'):
+    '''
+    One field of several tables of a database aligned on their dates, read
+    with a single query over the date indexes and merged with numpy.
+    :param storage: a CandleStorage2 of the database or its filename
+    :param list tables: table names, eg. one per pair
+    :param start: first date
+    :param end: last date (exclusive)
+    :param str field: open, close, high or low
+    :param bool fill: dates missing in a table repeat its preceding value
+                      (NaN before its first date), else they are NaN
+    :param str how: 'outer' for the dates of any table, 'inner' for the
+                    dates of all tables
+    @return: (dates as datetime64[ns],float64 array of dates x tables)
+    '''
+    if field not in CandleStorage2.cols[1:]: raise ValueError("no field %r"%field)
+    if how not in ('outer','inner'): raise ValueError("how is outer or inner, not %r"%how)
+    a=int(dt_to_int(pd.to_datetime(start))) if start is not None else 0
+    b=int(dt_to_int(pd.to_datetime(end))) if end is not None else 2**62
+    sql=" union all ".join("select date,{k},ifnull({f},'nan') from \"{tn}\" where date>=? and date<?".format(k=k,f=field,tn=tn)
+                           for k,tn in enumerate(tables))
+    pool=ConnectionPool(storage) if isinstance(storage,basestring) else None
+    try:
+        conn=pool.conn if pool else storage.conn
+        arr=np.fromiter(chain.from_iterable(conn.execute(sql,(a,b)*len(tables))),dtype=np.float64).reshape(-1,3)
+    finally:
+        if pool: pool.close()
+    dates,row=np.unique(arr[:,0].astype(np.int64),return_inverse=True)
+    col=arr[:,1].astype(np.int64)
+    values=np.full((len(dates),len(tables)),np.nan)
+    values[row,col]=arr[:,2]
+    present=np.zeros(values.shape,bool)
+    present[row,col]=True
+    if how=='inner':
+        keep=present.all(axis=1)
+        dates,values,present=dates[keep],values[keep],present[keep]
+    elif fill and len(dates):
+        #index of the last present row of each column, row 0 is NaN if it is missing
+        last=np.where(present,np.arange(len(dates))[:,None],0)
+        np.maximum.accumulate(last,axis=0,out=last)
+        values=values[last,np.arange(len(tables))]
+    return ints_to_dates(dates),values
+    
+def prefetched(iterable,release=None,size=1):
+    '''
+    Iterate over iterable in a background thread, which keeps up to size
+    items ready. Exceptions are raised in the consuming thread. The thread
+    stops when the returned generator is closed.
+    :param release: called in the background thread when it ends, eg. to
+                    close its sqlite connection
+    '''
+    queue=Queue(size)
+    stop=threading.Event()
+    end=object()
+    def put(item):
+        while not stop.is_set():
+            try: return queue.put(item,timeout=.1)
+            except Full: pass
+    def work():
+        try:
+            for item in iterable:
+                put((item,None))
+                if stop.is_set(): return
+            put((end,None))
+        except BaseException: put((None,sys.exc_info()))
+        finally:
+            if release is not None: release()
+    t=threading.Thread(target=work,name='prefetch')
+    t.daemon=True
+    t.start()
+    try:
+        while True:
+            item,err=queue.get()
+            if err is not None: raise err[0],err[1],err[2]
+            if item is end: return
+            yield item
+    finally:
+        stop.set()
+        t.join()
+    
 def dt_to_int(dt):
     '''
-    convert datetime to unixtimestamp as int
+    convert datetime to unixtimestamp as int. Naive datetimes are UTC
     :param datetime.datetime dt:
     '''
-    return mktime(dt.timetuple())
+    return pd.Timestamp(dt).value//S
 
 def ts_to_dt(ts):
-    return DT.fromtimestamp(ts)
+    return DT.utcfromtimestamp(ts)
+
+def dates_to_int(dates):
+    '''
+    Vectorized dt_to_int
+    :param dates: datetimes, a pd.Series or pd.DatetimeIndex
+    @return: np.ndarray of int64
+    '''
+    return to_ns(dates)//S
+
+def ints_to_dates(ts):
+    '''
+    Vectorized ts_to_dt
+    :param ts: unix timestamps in seconds
+    @return: np.ndarray of naive UTC datetime64[ns]
+    '''
+    return from_ns(np.asarray(ts,dtype=np.int64)*S)
+
+def freq_seconds(freq):
+    '''
+    Seconds of a fixed frequency like '5s' or '1h', ints are returned as is
+    '''
+    if isinstance(freq,(int,long)): return freq
+    return int(to_offset(freq).nanos//S)
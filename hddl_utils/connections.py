@@ -0,0 +1,118 @@
+import sqlite3,threading,atexit,weakref
+
+#open pools, their connections are closed at exit
+_pools=weakref.WeakSet()
+
+class ConnectionPool(object):
+    '''
+    Manages the sqlite connections to one database file. Every thread reads
+    through its own connection, which is opened on first use and reused
+    afterwards. Writes run in the calling thread on a single writer
+    connection under a lock, so they are serialized and never compete for
+    the database lock. In WAL mode readers run concurrently with the
+    writer. The connections of threads that ended are closed when the next
+    thread connects.
+    As every connection opens the file itself, ':memory:' databases are
+    not supported.
+    '''
+    def __init__(self,name,journal_mode='WAL',synchronous=None,timeout=30):
+        '''
+        :param str name: db filename
+        :param journal_mode: sqlite journal_mode pragma, e.g. WAL, OFF, DELETE
+        :param synchronous: sqlite synchronous pragma, e.g. OFF, NORMAL, FULL.
+                            None keeps the sqlite default
+        :param timeout: seconds to wait for a lock held by another process
+        '''
+        self.name=name
+        self.journal_mode=journal_mode
+        self.synchronous=synchronous
+        self.timeout=timeout
+        self.closed=False
+        self._local=threading.local()
+        #thread -> its connection
+        self._conns={}
+        self._lock=threading.Lock()
+        #held while writing, re-entrant for writes inside a write
+        self._write_lock=threading.RLock()
+        self._writer=None
+        self._depth=0
+        _pools.add(self)
+
+    def _open(self):
+        conn=sqlite3.connect(self.name,timeout=self.timeout,check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=%s;"%self.journal_mode)
+        if self.synchronous is not None: conn.execute("PRAGMA synchronous=%s;"%self.synchronous)
+        return conn
+
+    def connect(self):
+        '''
+        Open a new connection with the pools pragmas for the calling thread
+        and close the connections of threads that ended
+        '''
+        conn=self._open()
+        with self._lock:
+            dead=[t for t in self._conns if not t.is_alive()]
+            old=[self._conns.pop(t) for t in dead]
+            self._conns[threading.current_thread()]=conn
+        for c in old: c.close()
+        return conn
+
+    @property
+    def conn(self):
+        '''
+        The connection of the calling thread
+        '''
+        if self.closed: raise sqlite3.ProgrammingError("connection pool of %s is closed"%self.name)
+        conn=getattr(self._local,'conn',None)
+        if conn is None: conn=self._local.conn=self.connect()
+        return conn
+
+    def release(self):
+        '''
+        Close the connection of the calling thread, e.g. before it ends
+        '''
+        conn=getattr(self._local,'conn',None)
+        if conn is None: return
+        self._local.conn=None
+        with self._lock: self._conns.pop(threading.current_thread(),None)
+        conn.close()
+
+    def write(self,fn,*args):
+        '''
+        Run fn(conn,*args) on the writer connection and commit, waiting for
+        the writes of other threads. A write inside fn runs in the same
+        transaction. Exceptions of fn are raised after a rollback.
+        @return: the result of fn
+        '''
+        with self._write_lock:
+            if self.closed: raise sqlite3.ProgrammingError("connection pool of %s is closed"%self.name)
+            if self._writer is None: self._writer=self._open()
+            conn=self._writer
+            if self._depth: return fn(conn,*args)
+            self._depth+=1
+            try:
+                ret=fn(conn,*args)
+                conn.commit()
+                return ret
+            except BaseException:
+                try: conn.rollback()
+                except sqlite3.Error: pass
+                raise
+            finally: self._depth-=1
+
+    def close(self):
+        '''
+        Wait for a running write and close all connections
+        '''
+        with self._write_lock:
+            with self._lock:
+                self.closed=True
+                conns=self._conns.values()
+                if self._writer is not None: conns.append(self._writer)
+                self._conns,self._writer={},None
+        for conn in conns: conn.close()
+        self._local=threading.local()
+
+@atexit.register
+def _close_all():
+    for pool in list(_pools): pool.close()
@@ -0,0 +1,356 @@
+'''
+Live aggregation of ticks into candles saved in CandleStorage2 tables.
+Sources run in their own threads and put batches of ticks into a bounded
+queue, which blocks them while the aggregator is behind (backpressure). The
+aggregator feeds all symbols through one CandleAggregator and hands the
+closed candles in micro-batches to a writer thread, which appends them to
+one table per symbol and duration:
+
+    ingest=Ingest([ReplaySource('EURUSD.zip','EURUSD',speed=60)],['EURUSD'],(1,60),'live.db')
+    print ingest.run()
+
+Ticks are lines "SYMBOL,YYYYMMDD HHMMSSfff,ask,bid[,vol]" like the histdata
+tick csv (EST) with the symbol in front, the price is the mean of ask and bid.
+'''
+import sys,time,socket,zipfile,threading
+from Queue import Queue,Empty,Full
+from collections import namedtuple,deque
+import numpy as np,pandas as pd
+from candles import CandleAggregator,CandleStorage2
+from timestamps import S,EST_OFFSET,to_ns
+from stats import instrument
+
+#symbol is a name or an array of names, received the wall time the source read the ticks
+Ticks=namedtuple('Ticks','symbol date price received')
+
+def parse_stamps(stamps):
+    '''
+    histdata stamps "YYYYMMDD HHMMSSfff" (EST) to UTC ns
+    '''
+    return to_ns(pd.to_datetime(stamps,format='%Y%m%d %H%M%S%f'))+EST_OFFSET
+
+def parse_lines(lines,received=None):
+    '''
+    Parse tick lines "SYMBOL,YYYYMMDD HHMMSSfff,ask,bid[,vol]"
+    @return: Ticks
+    '''
+    rows=[l.split(',') for l in lines if l.strip()]
+    symbol=np.array([r[0] for r in rows])
+    price=np.array([(float(r[2])+float(r[3]))/2 for r in rows])
+    return Ticks(symbol,parse_stamps([r[1] for r in rows]),price,received or time.time())
+
+class ReplaySource(object):
+    '''
+    Replays a histdata tick csv, or the csv inside a histdata zip archive,
+    as ticks of symbol.
+    '''
+    def __init__(self,path,symbol,speed=None,batch=1024):
+        '''
+        :param float speed: play the ticks speed times as fast as they were
+                            recorded, None as fast as possible
+        :param int batch:   ticks per batch
+        '''
+        self.path=path
+        self.symbol=symbol
+        self.speed=speed
+        self.batch=batch
+
+    def _open(self):
+        if zipfile.is_zipfile(self.path):
+            z=zipfile.ZipFile(self.path)
+            return z.open([n for n in z.namelist() if n.lower().endswith('.csv')][0])
+        return open(self.path,'rb')
+
+    def __iter__(self):
+        f=self._open()
+        start=None
+        try:
+            for df in pd.read_csv(f,header=None,names='date ask bid vol'.split(),dtype={'date':str},chunksize=self.batch):
+                date=parse_stamps(df.date.values)
+                if self.speed:
+                    if start is None: start=(date[0],time.time())
+                    wait=start[1]+(date[-1]-start[0])/1e9/self.speed-time.time()
+                    if wait>0: time.sleep(wait)
+                yield Ticks(self.symbol,date,((df.ask+df.bid)/2).values,time.time())
+        finally: f.close()
+
+class SocketSource(object):
+    '''
+    Receives tick lines on a TCP port, from any number of connections, or
+    in UDP datagrams of one or more lines. Yields the lines received within
+    timeout seconds, at most batch at once, until close is called.
+    '''
+    def __init__(self,port=0,host='127.0.0.1',udp=False,batch=1024,timeout=.05):
+        '''
+        :param int port: 0 picks a free port, see self.port
+        '''
+        self.udp=udp
+        self.batch=batch
+        self.timeout=timeout
+        self.sock=socket.socket(socket.AF_INET,socket.SOCK_DGRAM if udp else socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self.sock.bind((host,port))
+        self.port=self.sock.getsockname()[1]
+        self.lines=Queue()
+        self.closed=threading.Event()
+        if not udp: self.sock.listen(8)
+        self._thread(self._receive if udp else self._accept)
+
+    def _thread(self,target,*args):
+        t=threading.Thread(target=target,args=args,name='tick socket %d'%self.port)
+        t.daemon=True
+        t.start()
+
+    def _accept(self):
+        self.sock.settimeout(self.timeout)
+        while not self.closed.is_set():
+            try: conn,_=self.sock.accept()
+            except socket.timeout: continue
+            except socket.error: break
+            self._thread(self._read,conn)
+
+    def _read(self,conn):
+        conn.settimeout(self.timeout)
+        rest=''
+        while not self.closed.is_set():
+            try: data=conn.recv(2**16)
+            except socket.timeout: continue
+            if not data: break
+            lines=(rest+data).split('\n')
+            rest=lines.pop()
+            for l in lines: self.lines.put(l)
+        if rest: self.lines.put(rest)
+        conn.close()
+
+    def _receive(self):
+        self.sock.settimeout(self.timeout)
+        while not self.closed.is_set():
+            try: data=self.sock.recv(2**16)
+            except socket.timeout: continue
+            except socket.error: break
+            for l in data.split('\n'): self.lines.put(l)
+
+    def __iter__(self):
+        while not self.closed.is_set() or not self.lines.empty():
+            lines=[]
+            try:
+                lines.append(self.lines.get(timeout=self.timeout))
+                while len(lines)<self.batch: lines.append(self.lines.get_nowait())
+            except Empty: pass
+            lines=[l for l in lines if l.strip()]
+            if lines: yield parse_lines(lines)
+
+    def close(self):
+        '''
+        stop receiving, the lines received so far are still yielded
+        '''
+        self.closed.set()
+        self.sock.close()
+
+class Ingest(object):
+    '''
+    Aggregates the ticks of several sources into candles of several
+    durations and appends them to the table "SYMBOL_DURATION" of a sqlite
+    database (see CandleStorage2). Closed candles are written in micro
+    batches of up to flush_rows candles or after flush_interval seconds.
+    Ticks of symbols not in symbols are counted and dropped, so are late
+    ticks older than the last tick of their symbol. At the end of all
+    sources the running candles are closed and written, too. An error in
+    any thread stops the service and is raised by join.
+    '''
+    def __init__(self,sources,symbols,durations=(60,),storage='live.db',queue_size=16,flush_rows=4096,flush_interval=.5):
+        '''
+        :param list sources:    iterables of Ticks, eg. ReplaySource or SocketSource
+        :param list symbols:    the symbols to aggregate
+        :param list durations:  candle durations in seconds
+        :param storage:     sqlite filename, or a function(symbol,duration)
+                            returning the CandleStorage2 to append to
+        :param int queue_size:  max pending tick batches of the sources and
+                                candle batches of the writer
+        '''
+        self.sources=list(sources)
+        self.aggregator=CandleAggregator(symbols,[d*S for d in durations])
+        self.lookup=dict((n,i) for i,n in enumerate(symbols))
+        if not callable(storage):
+            name=storage
+            storage=lambda symbol,duration: CandleStorage2(name=name,tablename='%s_%d'%(symbol,duration),cache_size=0)
+        self.storages=dict(((s,d),storage(s,d)) for s in symbols for d in durations)
+        self.ticks=Queue(queue_size)
+        self.closed=Queue(queue_size)
+        self.flush_rows=flush_rows
+        self.flush_interval=flush_interval
+        self.stop_event=threading.Event()
+        self.errors=[]
+        self.threads=[]
+        self.counts=dict(ticks=0,unknown=0,late=0,candles=0,batches=0,flushes=0)
+        #last tick of each symbol
+        self.last=np.full(len(symbols),np.iinfo(np.int64).min,np.int64)
+        self.blocked=0.
+        self.latency=deque(maxlen=2**16)
+        self._lock=threading.Lock()
+        self.start_time=self.end_time=None
+
+    def start(self):
+        self.start_time=time.time()
+        for i,source in enumerate(self.sources): self._thread(self._read,'ingest source %d'%i,source)
+        self._thread(self._aggregate,'ingest aggregator')
+        self._thread(self._write,'ingest writer')
+        return self
+
+    def _thread(self,target,name,*args):
+        def run():
+            try: target(*args)
+            except BaseException:
+                self.errors.append(sys.exc_info())
+                self.stop_event.set()
+                for source in self.sources:
+                    if hasattr(source,'close'): source.close()
+        t=threading.Thread(target=run,name=name)
+        t.daemon=True
+        t.start()
+        self.threads.append(t)
+
+    def _put(self,queue,item):
+        '''
+        put item, blocking while queue is full unless stopped
+        @return: False if stopped
+        '''
+        t=time.time()
+        while not self.stop_event.is_set():
+            try:
+                queue.put(item,timeout=.1)
+                break
+            except Full: pass
+        with self._lock: self.blocked+=time.time()-t
+        return not self.stop_event.is_set()
+
+    def _read(self,source):
+        try:
+            for ticks in source:
+                if not self._put(self.ticks,ticks): break
+        finally: self._put(self.ticks,None)
+
+    def _aggregate(self):
+        running=len(self.sources)
+        pending,received,since=[],[],None
+        while running:
+            try: ticks=self.ticks.get(timeout=self.flush_interval)
+            except Empty: ticks=False
+            if ticks is None: running-=1
+            elif ticks is not False:
+                closed,at=self._add(ticks)
+                if len(closed):
+                    pending.append(closed)
+                    received.append(at)
+                    since=since or time.time()
+            if pending and (ticks is None or sum(len(c) for c in pending)>=self.flush_rows or time.time()-since>=self.flush_interval):
+                if not self._put(self.closed,(np.concatenate(pending),np.concatenate(received))): return
+                pending,received,since=[],[],None
+        closed=self.aggregator.flush()
+        self._put(self.closed,(closed,np.full(len(closed),time.time())))
+        self._put(self.closed,None)
+
+    def _add(self,ticks):
+        '''
+        aggregate a batch of ticks
+        @return: (closed candles,received time of their closing ticks)
+        '''
+        n=len(ticks.date)
+        if isinstance(ticks.symbol,basestring):
+            if ticks.symbol not in self.lookup: index=np.full(n,-1,np.int64)
+            else: index=np.full(n,self.lookup[ticks.symbol],np.int64)
+        else: index=np.array([self.lookup.get(s,-1) for s in ticks.symbol],dtype=np.int64)
+        keep=index>=0
+        unknown=n-keep.sum()
+        for i in np.unique(index[keep]):
+            rows=np.flatnonzero(index==i)
+            t=ticks.date[rows]
+            prev=np.maximum.accumulate(np.r_[self.last[i],t])
+            keep[rows[t<prev[:-1]]]=False
+            self.last[i]=prev[-1]
+        with self._lock:
+            self.counts['ticks']+=n
+            self.counts['unknown']+=unknown
+            self.counts['late']+=n-unknown-keep.sum()
+            self.counts['batches']+=1
+        if not keep.all(): index,date,price=index[keep],ticks.date[keep],ticks.price[keep]
+        else: date,price=ticks.date,ticks.price
+        closed=self.aggregator.add(index,date,price)
+        return closed,np.full(len(closed),ticks.received)
+
+    def _write(self):
+        while not self.stop_event.is_set():
+            try: item=self.closed.get(timeout=.1)
+            except Empty: continue
+            if item is None: break
+            self._flush(*item)
+
+    def _flush(self,closed,received):
+        '''
+        append closed candles to their tables
+        '''
+        durations=self.aggregator.durations
+        symbols=self.aggregator.symbols
+        for (s,d),rows in pd.DataFrame({'symbol':closed['symbol'],'duration':closed['duration']}).groupby(['symbol','duration']).indices.items():
+            c=closed[rows]
+            df=pd.DataFrame({'date':c['date']//S,'open':c['open'],'close':c['close'],'high':c['high'],'low':c['low']},columns=CandleStorage2.cols)
+            self.storages[symbols[s],int(d//S)].append(df)
+        now=time.time()
+        with self._lock:
+            self.counts['candles']+=len(closed)
+            self.counts['flushes']+=1
+            self.latency.extend(now-received)
+        return len(closed)
+
+    def join(self):
+        '''
+        Wait until all sources are exhausted and their candles written.
+        Exceptions of the threads are raised here.
+        '''
+        for t in self.threads:
+            while t.is_alive(): t.join(.1)
+        self.end_time=self.end_time or time.time()
+        if self.errors:
+            err=self.errors[0]
+            raise err[0],err[1],err[2]
+
+    def stop(self):
+        '''
+        Stop all threads without writing pending candles
+        '''
+        self.stop_event.set()
+        for source in self.sources:
+            if hasattr(source,'close'): source.close()
+        try: self.join()
+        finally: self.close()
+
+    def close(self):
+        for storage in self.storages.values(): storage.close()
+
+    def run(self):
+        '''
+        start, wait for the end of the sources and close the storages
+        @return: report
+        '''
+        self.start()
+        try: self.join()
+        finally: self.close()
+        return self.report()
+
+    def report(self):
+        '''
+        counts, throughput, latency from receiving the closing tick of a
+        candle to writing it (seconds, of the last 65536 candles) and the
+        seconds sources and aggregator were blocked by full queues
+        '''
+        with self._lock:
+            ret=dict(self.counts)
+            latency=np.array(self.latency)
+            ret['blocked']=self.blocked
+        ret['seconds']=(self.end_time or time.time())-self.start_time
+        ret['ticks_per_s']=ret['ticks']/max(ret['seconds'],1e-9)
+        if len(latency): ret['latency']=dict(mean=latency.mean(),p50=np.percentile(latency,50),p99=np.percentile(latency,99),max=latency.max())
+        return ret
+
+instrument(Ingest,'_add','ingest.aggregate',rows=lambda ret,self,ticks: len(ticks.date))
+instrument(Ingest,'_flush','ingest.flush',rows=lambda ret,*a: ret)
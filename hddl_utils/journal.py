@@ -0,0 +1,83 @@
+import os,json,threading,shutil
+from hddl_utils.cache import ArchiveCache
+
+PENDING,FETCHED,PARSED,COMMITTED='pending','fetched','parsed','committed'
+
+class Journal(object):
+    '''
+    Persistent state (PENDING, FETCHED, PARSED, COMMITTED) of the pair/month
+    jobs of a download. Every transition is appended as a json line to the
+    journal file and synced to disk, a torn last line of a crashed run is
+    ignored. The archives of fetched months are kept in a spool (an
+    ArchiveCache in "<path>.d") until the month is committed, so a restart
+    neither downloads them again nor needs to look at the outputs.
+    '''
+    def __init__(self,path):
+        '''
+        :param str path:    the journal file, created if missing
+        '''
+        self.path=path
+        self.spool=ArchiveCache(path+'.d',max_size=2**62)
+        self.states={}
+        self._lock=threading.Lock()
+        try:
+            with open(path) as f:
+                for line in f:
+                    try: e=json.loads(line)
+                    except ValueError: continue
+                    self.states[tuple(e['job'])]=e['state']
+        except IOError: pass
+        self._compact()
+
+    def _compact(self):
+        '''
+        Rewrite the journal with the current state of each job and drop
+        spooled archives nobody waits for
+        '''
+        tmp=self.path+'.tmp'
+        with open(tmp,'w') as f:
+            for job,state in sorted(self.states.items()):
+                f.write(json.dumps(dict(job=job,state=state))+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp,self.path)
+        for _,_,p in self.spool.entries():
+            pair,ym=os.path.basename(p)[:-4].rsplit('_',1)
+            if self.state(pair,int(ym[:4]),int(ym[4:])) not in (FETCHED,PARSED): self.spool.remove(pair,int(ym[:4]),int(ym[4:]))
+        self.f=open(self.path,'a')
+
+    def state(self,pair,year,month):
+        return self.states.get((pair.upper(),year,month),PENDING)
+
+    def set(self,pair,year,month,state,raw=None):
+        '''
+        Record the new state of a job.
+        :param raw: the fetched archive as string or file, spooled until the
+                    job is committed
+        '''
+        job=(pair.upper(),year,month)
+        #parsing the month checks the archive anyway
+        if raw is not None: self.spool.put(pair,year,month,raw,verify=False)
+        with self._lock:
+            self.f.write(json.dumps(dict(job=job,state=state))+'\n')
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.states[job]=state
+        if state==COMMITTED: self.spool.remove(pair,year,month)
+
+    def open(self,pair,year,month):
+        '''
+        The spooled archive of a fetched job as open file, or None
+        '''
+        if self.state(pair,year,month) not in (FETCHED,PARSED): return None
+        return self.spool.open(pair,year,month)
+
+    def unfinished(self):
+        '''
+        jobs fetched or parsed but not committed
+        '''
+        return sorted(job for job,state in self.states.items() if state in (FETCHED,PARSED))
+
+    def close(self):
+        self.f.close()
+        if not self.spool.entries(): shutil.rmtree(self.spool.path,ignore_errors=True)
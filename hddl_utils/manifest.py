@@ -0,0 +1,70 @@
+import os,json
+
+class Manifest(object):
+    '''
+    Sidecar file "<output>.manifest.json" describing the months a candle file
+    contains. For every month (a "YYYY-MM" key) it records the first and last
+    date, the number of rows and the byte range [offset,end) in the output,
+    so resuming a download does not need to read the output itself.
+    Months found by scanning an output without manifest have no byte range.
+    '''
+    def __init__(self,output):
+        '''
+        :param str output: path of the described file
+        '''
+        self.output=output
+        self.path=output+'.manifest.json'
+        self.months={}
+
+    @classmethod
+    def load(cls,output):
+        '''
+        Load the manifest of output. Returns None if there is none or if it
+        does not match the output, e.g. because the output was replaced.
+        '''
+        m=cls(output)
+        try:
+            with open(m.path) as f: m.months=json.load(f)['months']
+            size=os.path.getsize(output)
+        except (IOError,OSError,ValueError,KeyError): return None
+        if size<m.end: return None
+        return m
+
+    @property
+    def end(self):
+        '''
+        End of the last recorded month in the output
+        '''
+        return max([0]+[v['end'] for v in self.months.values() if v.get('end') is not None])
+
+    @property
+    def rows(self): return sum(v.get('rows') or 0 for v in self.months.values())
+
+    def add(self,month,first=None,last=None,rows=None,offset=None,end=None):
+        '''
+        Record a month
+        :param str month:   "YYYY-MM"
+        :param str first:   first date of the month in the output
+        :param str last:    last date of the month in the output
+        :param int rows:    number of rows
+        :param int offset:  byte offset of the first row
+        :param int end:     byte offset after the last row
+        '''
+        self.months[month]=dict(first=first,last=last,rows=rows,offset=offset,end=end)
+
+    def __contains__(self,month): return month in self.months
+
+    def save(self):
+        '''
+        Atomically replace the manifest file
+        '''
+        tmp=self.path+'.tmp'
+        with open(tmp,'w') as f: 
+            json.dump({'output':os.path.basename(self.output),'months':self.months},f,indent=1,sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp,self.path)
+
+    def remove(self):
+        try: os.remove(self.path)
+        except OSError: pass
@@ -0,0 +1,294 @@
+'''
+Candle storage split by time into one sqlite file per year or month, each
+holding a CandleStorage2 table. A catalog keeps the rows and the first and
+last date of every partition, so opening the storage, len, min_date and
+max_date only read the catalog. Partitions are opened when first used,
+reads spanning several partitions run in a thread pool.
+'''
+import os,threading
+from multiprocessing.pool import ThreadPool
+import numpy as np,pandas as pd
+from candles import CandleStorage2,DT,dt_to_int,dates_to_int,ts_to_dt,freq_seconds,prefetched
+from connections import ConnectionPool
+from stats import instrument
+
+UNITS=dict(year='Y',month='M')
+
+class PartitionedStorage(object):
+    '''
+    Like CandleStorage2, but with a partition per year or month (UTC) in the
+    directory name: "<tablename>_<key>.db" with keys like "2017" or
+    "2017-03" and the catalog "catalog.db". Rows are indexed by date only.
+    '''
+    cols=CandleStorage2.cols
+    def __init__(self,name='candles',tablename='stock',partition='month',workers=4,**kw):
+        '''
+        :param str name: directory of the partitions
+        :param str tablename: table name, several tables may share a directory
+        :param str partition: 'year' or 'month'. Fixed when the table is created
+        :param int workers: threads running the queries of several partitions
+        :param kw: further arguments of the CandleStorage2 of each partition,
+                   e.g. journal_mode, synchronous or cache_size. The range
+                   cache is off unless cache_size is given, as every
+                   partition would keep its own
+        '''
+        kw.setdefault('cache_size',0)
+        if partition not in UNITS: raise ValueError("partition is year or month, not %r"%partition)
+        if not os.path.isdir(name): os.makedirs(name)
+        self.name=name
+        self.tablename=tablename
+        self.kw=kw
+        self.workers=ThreadPool(workers)
+        self.open_partitions={}
+        self._lock=threading.Lock()
+        self.catalog_pool=ConnectionPool(os.path.join(name,'catalog.db'))
+        self.catalog_pool.write(self._create_catalog,partition)
+        self.catalog=dict((key,dict(rows=rows,first=first,last=last)) for key,rows,first,last in
+                          self.catalog_pool.conn.execute("select key,rows,first,last from {ct}".format(ct=self._catalog_table)))
+        self.unit=self.catalog_pool.conn.execute("select unit from {ct}_unit".format(ct=self._catalog_table)).fetchone()[0]
+
+    @property
+    def _catalog_table(self): return "{tn}_partitions".format(tn=self.tablename)
+
+    def _create_catalog(self,conn,partition):
+        conn.executescript('''
+        create table if not exists {ct}(
+                    key TEXT PRIMARY KEY,
+                    rows INTEGER,
+                    first INTEGER,
+                    last INTEGER
+                    );
+        create table if not exists {ct}_unit(unit TEXT);
+        '''.format(ct=self._catalog_table))
+        if conn.execute("select count(*) from {ct}_unit".format(ct=self._catalog_table)).fetchone()[0]==0:
+            conn.execute("insert into {ct}_unit values (?)".format(ct=self._catalog_table),(UNITS[partition],))
+
+    def _save_catalog(self,key):
+        def save(conn):
+            if key in self.catalog:
+                c=self.catalog[key]
+                conn.execute("replace into {ct} values (?,?,?,?)".format(ct=self._catalog_table),(key,c['rows'],c['first'],c['last']))
+            else: conn.execute("delete from {ct} where key=?".format(ct=self._catalog_table),(key,))
+        self.catalog_pool.write(save)
+
+    def path(self,key): return os.path.join(self.name,'%s_%s.db'%(self.tablename,key))
+
+    def partition(self,key):
+        '''
+        the CandleStorage2 of partition key, opened on first use
+        '''
+        with self._lock:
+            s=self.open_partitions.get(key)
+            if s is None: s=self.open_partitions[key]=CandleStorage2(name=self.path(key),tablename=self.tablename,**self.kw)
+        return s
+
+    def keys(self,a=0,b=2**62):
+        '''
+        sorted keys of the partitions with rows in [a,b) (seconds)
+        '''
+        return sorted(k for k,c in self.catalog.items() if c['rows'] and c['first']<b and c['last']>=a)
+
+    def _split(self,df):
+        '''
+        @return: list of (key,rows of df in partition key)
+        '''
+        part=_seconds(df).astype('M8[s]').astype('M8[%s]'%self.unit)
+        keys,index=np.unique(part,return_inverse=True)
+        if len(keys)==1: return [(str(keys[0]),df)]
+        return [(str(k),df[index==i]) for i,k in enumerate(keys)]
+
+    def append(self,df,update=True,batchsize=None):
+        '''
+        append df to its partitions, see CandleStorage2.append. Partitions
+        are written in parallel.
+        '''
+        if not len(df): return 0
+        self.workers.map(lambda item: self._append(item[0],item[1],update,batchsize),self._split(df))
+
+    def _append(self,key,df,update,batchsize):
+        s=self.partition(key)
+        date=_seconds(df)
+        lo,hi=int(date.min()),int(date.max())
+        count="select count(*) from {tn} where date>=? and date<=?".format(tn=self.tablename)
+        before=s.conn.execute(count,(lo,hi)).fetchone()[0]
+        s.append(df,update,batchsize)
+        added=s.conn.execute(count,(lo,hi)).fetchone()[0]-before
+        c=self.catalog.setdefault(key,dict(rows=0,first=lo,last=hi))
+        c['rows']+=added
+        c['first'],c['last']=min(c['first'],lo),max(c['last'],hi)
+        self._save_catalog(key)
+
+    def bulk_load(self,frames,batchsize=2**16,defer_index=True):
+        '''
+        Load many DataFrames, see CandleStorage2.bulk_load. Consecutive
+        frames of the same partition are loaded together, so date ordered
+        frames load each partition once.
+        @return: number of loaded rows
+        '''
+        if isinstance(frames,pd.DataFrame): frames=[frames]
+        n=0
+        run,key=[],None
+        for df in frames:
+            if not len(df): continue
+            for k,part in self._split(df):
+                if k!=key and run:
+                    n+=self._load(key,run,batchsize,defer_index)
+                    run=[]
+                key=k
+                run.append(part)
+        if run: n+=self._load(key,run,batchsize,defer_index)
+        return n
+
+    def _load(self,key,frames,batchsize,defer_index):
+        s=self.partition(key)
+        n=s.bulk_load(frames,batchsize,defer_index)
+        self.refresh(key)
+        return n
+
+    def refresh(self,key=None):
+        '''
+        Recount the rows and dates of partition key, or of all partition
+        files in the directory, e.g. after a crash between writing a
+        partition and the catalog
+        '''
+        if key is None:
+            prefix=self.tablename+'_'
+            keys=[n[len(prefix):-3] for n in os.listdir(self.name) if n.startswith(prefix) and n.endswith('.db')]
+            for k in set(keys)|set(self.catalog): self.refresh(k)
+            return
+        if not os.path.exists(self.path(key)): self.catalog.pop(key,None)
+        else:
+            rows,first,last=self.partition(key).conn.execute("select count(*),min(date),max(date) from {tn}".format(tn=self.tablename)).fetchone()
+            self.catalog[key]=dict(rows=rows,first=first,last=last)
+        self._save_catalog(key)
+
+    def clear(self,key=None):
+        '''
+        Remove partition key, or all partitions, without touching the others
+        '''
+        for k in [key] if key is not None else list(self.catalog):
+            self._remove(k)
+            self.catalog.pop(k,None)
+            self._save_catalog(k)
+
+    def _remove(self,key,path=None):
+        s=self.open_partitions.pop(key,None) if path is None else None
+        if s is not None: s.close()
+        path=path or self.path(key)
+        for suffix in ('','-wal','-shm','-journal'):
+            if os.path.exists(path+suffix): os.remove(path+suffix)
+
+    def rebuild(self,key,frames):
+        '''
+        Replace partition key by the candles of frames, which must all lie
+        inside the partition. They are loaded into a new file, which replaces
+        the partition when complete.
+        @return: number of loaded rows
+        '''
+        if isinstance(frames,pd.DataFrame): frames=[frames]
+        def checked(frames):
+            for df in frames:
+                for k,_ in self._split(df) if len(df) else []:
+                    if k!=key: raise ValueError("candles of %s in partition %s"%(k,key))
+                yield df
+        tmp=self.path(key)+'.rebuild'
+        self._remove(key,tmp)
+        s=CandleStorage2(name=tmp,tablename=self.tablename,**self.kw)
+        try: n=s.bulk_load(checked(frames))
+        except BaseException:
+            s.close()
+            self._remove(key,tmp)
+            raise
+        s.close()
+        self._remove(key)
+        os.rename(tmp,self.path(key))
+        self.refresh(key)
+        return n
+
+    def _range(self,key):
+        if isinstance(key,str):
+            p=pd.Period(key)
+            return dt_to_int(p.to_timestamp()),dt_to_int((p+1).to_timestamp())
+        if isinstance(key,slice) and key.step is None and not isinstance(key.start,(int,long)) and not isinstance(key.stop,(int,long)):
+            a=dt_to_int(pd.to_datetime(key.start)) if key.start is not None else 0
+            b=dt_to_int(pd.to_datetime(key.stop)) if key.stop is not None else 2**62
+            return a,b
+        raise TypeError("a partitioned storage is indexed by dates")
+
+    def __getitem__(self,key):
+        '''
+        Rows of a date string like '2017-03' or of a slice of dates, read
+        from the partitions in parallel
+        '''
+        a,b=self._range(key)
+        dfs=self.workers.map(lambda k: self.partition(k)._read('date',a,b),self.keys(a,b))
+        if not dfs: return pd.DataFrame({'date':np.array([],'M8[ns]')},columns=self.cols)
+        return dfs[0] if len(dfs)==1 else pd.concat(dfs,ignore_index=True)
+
+    def iter_range(self,start=None,end=None,chunksize=2**16,prefetch=False,arrays=False):
+        '''
+        see CandleStorage2.iter_range, chunks do not span partitions
+        '''
+        a=int(dt_to_int(pd.to_datetime(start))) if start is not None else 0
+        b=int(dt_to_int(pd.to_datetime(end))) if end is not None else 2**62
+        chunks=self._iter_chunks(a,b,chunksize,arrays)
+        return prefetched(chunks,self._release) if prefetch else chunks
+
+    def _iter_chunks(self,a,b,chunksize,arrays):
+        for k in self.keys(a,b):
+            for chunk in self.partition(k)._iter_chunks(a,b,chunksize,arrays): yield chunk
+
+    def _release(self):
+        '''
+        close the connections of the calling thread
+        '''
+        for s in self.open_partitions.values(): s.pool.release()
+
+    def resample(self,freq,start=None,end=None):
+        '''
+        see CandleStorage2.resample, the partitions are resampled in parallel.
+        freq must divide a day, so no bucket spans two partitions.
+        '''
+        step=freq_seconds(freq)
+        if 86400%step: raise ValueError("%s does not divide a day"%freq)
+        a=dt_to_int(pd.to_datetime(start)) if start is not None else 0
+        b=dt_to_int(pd.to_datetime(end)) if end is not None else 2**62
+        keys=self.keys(a//step*step,-(-b//step)*step)
+        dfs=self.workers.map(lambda k: self.partition(k).resample(freq,start,end),keys)
+        if not dfs: return pd.DataFrame({'date':np.array([],'M8[ns]')},columns=self.cols)
+        return pd.concat(dfs,ignore_index=True)
+
+    def __len__(self): return sum(c['rows'] for c in self.catalog.values())
+
+    @property
+    def min_date(self):
+        '''
+        The first saved date if any else None, from the catalog
+        '''
+        keys=self.keys()
+        return ts_to_dt(self.catalog[keys[0]]['first']) if keys else None
+
+    @property
+    def max_date(self):
+        '''
+        The last saved date if any else None, from the catalog
+        '''
+        keys=self.keys()
+        return ts_to_dt(self.catalog[keys[-1]]['last']) if keys else None
+
+    def close(self):
+        for s in self.open_partitions.values(): s.close()
+        self.open_partitions={}
+        self.catalog_pool.close()
+        self.workers.terminate()
+
+def _seconds(df):
+    '''
+    the dates of df as int64 seconds like CandleStorage2.append expects them
+    '''
+    date=df.date.values
+    if isinstance(df.date.iloc[0],DT) or np.issubdtype(date.dtype,np.datetime64): date=dates_to_int(df.date)
+    return np.asarray(date,dtype=np.int64)
+
+instrument(PartitionedStorage,'__getitem__','partitions.read',rows=lambda ret,*a: len(ret))
+instrument(PartitionedStorage,'append','partitions.append',rows=lambda ret,self,df,*a: len(df))
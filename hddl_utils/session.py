@@ -0,0 +1,100 @@
+import time,random,threading
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError,Timeout
+
+#answers worth another try
+RETRY_STATUS=frozenset([429,500,502,503,504])
+
+def backoff_delay(backoff,attempt):
+    '''
+    seconds to wait before retry number attempt+1: exponential with jitter,
+    so clients failing together do not retry together
+    '''
+    return backoff*2**attempt*random.uniform(.5,1.)
+
+class RateLimit(object):
+    '''
+    Token bucket shared by threads. Allows burst calls at once, then rate
+    calls per second. Waiting callers are served in the order they arrived.
+    '''
+    def __init__(self,rate,burst=1):
+        '''
+        :param float rate:  calls per second
+        :param int burst:   number of calls allowed without waiting
+        '''
+        self.rate=float(rate)
+        self.burst=burst
+        self.tokens=float(burst)
+        self.stamp=time.time()
+        self._lock=threading.Lock()
+
+    def wait(self):
+        '''
+        take a token, sleeping until it is available
+        '''
+        with self._lock:
+            now=time.time()
+            self.tokens=min(self.burst,self.tokens+(now-self.stamp)*self.rate)-1
+            self.stamp=now
+            delay=-self.tokens/self.rate
+        if delay>0: time.sleep(delay)
+
+class PooledSession(Session):
+    '''
+    A requests.Session to share between download threads. It keeps up to
+    connections connections per host alive, spaces requests by a RateLimit
+    and retries connection errors and RETRY_STATUS answers with exponential
+    backoff. Errors while reading a streamed body are left to the caller,
+    see retry.
+    '''
+    def __init__(self,connections=4,rate=None,burst=1,retries=3,backoff=1.):
+        '''
+        :param int connections: max number of kept alive connections per host
+        :param float rate:      max requests per second, None for no limit
+        :param int burst:       requests allowed at once before rate applies
+        :param int retries:     max number of retries of a request
+        :param float backoff:   seconds before the first retry, doubled for
+                                each further one
+        '''
+        Session.__init__(self)
+        adapter=HTTPAdapter(pool_connections=connections,pool_maxsize=connections)
+        self.mount('http://',adapter)
+        self.mount('https://',adapter)
+        self.limit=RateLimit(rate,burst) if rate else None
+        self.retries=retries
+        self.backoff=backoff
+        self.stats=dict(requests=0,retries=0)
+        self._lock=threading.Lock()
+
+    def _count(self,key):
+        with self._lock: self.stats[key]+=1
+
+    def request(self,method,url,**kw):
+        for attempt in range(self.retries+1):
+            if self.limit: self.limit.wait()
+            self._count('requests')
+            delay=backoff_delay(self.backoff,attempt)
+            try:
+                r=Session.request(self,method,url,**kw)
+                if r.status_code not in RETRY_STATUS or attempt==self.retries: return r
+                try: delay=max(delay,float(r.headers.get('Retry-After',0)))
+                except ValueError: pass
+                r.close()
+            except (ConnectionError,Timeout):
+                if attempt==self.retries: raise
+            self._count('retries')
+            time.sleep(delay)
+
+def retry(fn,retries=3,backoff=1.,errors=(ConnectionError,Timeout)):
+    '''
+    Wrap fn so that it is called again with exponential backoff when it
+    raises one of errors, at most retries times.
+    '''
+    def call(*args,**kw):
+        for attempt in range(retries+1):
+            try: return fn(*args,**kw)
+            except errors:
+                if attempt==retries: raise
+            time.sleep(backoff_delay(backoff,attempt))
+    return call
@@ -0,0 +1,164 @@
+'''
+Instrumentation of the download and storage stages. Modules register the
+functions and methods worth measuring with instrument, at their end where
+the measured ones are defined: hddl.py the download and parse stages,
+candles.py, partitions.py and ingest.py the storage stages. Nothing is
+wrapped until enable is called, so there is no overhead while disabled:
+
+    stats=enable()
+    download(...)
+    disable()
+    print stats.table()
+'''
+import time,json,threading,resource
+
+_points=[]
+_active=None
+
+class Stats(object):
+    '''
+    Calls, wall time, bytes, rows and peak memory per stage. The peak of a
+    stage is the largest resident set size seen before or after its calls,
+    or the new high-water mark of the process if it rose during a call.
+    Nested stages are measured inclusively, calls in several threads add
+    up and may see each others memory.
+    '''
+    fields=('calls','seconds','bytes','rows')
+    def __init__(self):
+        self.stages={}
+        self.start=time.time()
+        self._lock=threading.Lock()
+
+    def add(self,stage,seconds,bytes=0,rows=0,calls=1,peak=None):
+        '''
+        Record calls to stage
+        :param int peak:    peak rss in bytes, defaults to the current rss
+        '''
+        if peak is None: peak=rss()
+        with self._lock:
+            s=self.stages.get(stage)
+            if s is None: s=self.stages[stage]=dict(calls=0,seconds=0.,bytes=0,rows=0,peak=0)
+            s['calls']+=calls
+            s['seconds']+=seconds
+            s['bytes']+=bytes or 0
+            s['rows']+=rows or 0
+            s['peak']=max(s['peak'],peak)
+
+    def merge(self,summary):
+        '''
+        add the stages of a summary of another Stats, eg. from a worker process
+        '''
+        for stage,s in summary['stages'].items(): self.add(stage,**s)
+
+    def summary(self):
+        '''
+        @return:    dict ready to be dumped as JSON
+        '''
+        with self._lock: stages=dict((k,dict(v)) for k,v in self.stages.items())
+        return dict(wall=time.time()-self.start,peak=max_rss(),stages=stages)
+
+    def save(self,path):
+        with open(path,'w') as f: json.dump(self.summary(),f,indent=1,sort_keys=True)
+
+    def table(self):
+        '''
+        the summary as text table, stages with the most time first
+        '''
+        s=self.summary()
+        lines=["%-24s %7s %9s %10s %11s %8s"%('stage','calls','seconds','MB','rows','peak MB')]
+        for stage,v in sorted(s['stages'].items(),key=lambda i: -i[1]['seconds']):
+            lines.append("%-24s %7d %9.3f %10.2f %11d %8.1f"%(stage,v['calls'],v['seconds'],v['bytes']/2.**20,v['rows'],v['peak']/2.**20))
+        lines.append("wall %.3fs, peak %.1f MB"%(s['wall'],s['peak']/2.**20))
+        return '\n'.join(lines)
+
+def max_rss():
+    '''
+    max resident set size of the process in bytes
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def rss():
+    '''
+    current resident set size of the process in bytes, the max one where
+    /proc is missing
+    '''
+    try:
+        with open('/proc/self/statm') as f: return int(f.read().split()[1])*PAGESIZE
+    except IOError: return max_rss()
+
+PAGESIZE=resource.getpagesize()
+
+def _count(f,ret,args):
+    return f(ret,*args) if f is not None else 0
+
+def _wrap(point):
+    owner,name,stage,rows,size,fn=point
+    def measured(*args,**kw):
+        before,high=rss(),max_rss()
+        t=time.time()
+        ret=fn(*args,**kw)
+        stats=_active
+        if stats is not None:
+            seconds=time.time()-t
+            after=max_rss()
+            peak=max(before,rss(),after if after>high else 0)
+            stats.add(stage,seconds,_count(size,ret,args),_count(rows,ret,args),peak=peak)
+        return ret
+    #pickled by reference like fn, eg. to run in a process pool
+    measured.__name__,measured.__module__=fn.__name__,fn.__module__
+    measured.__doc__=fn.__doc__
+    setattr(owner,name,measured)
+
+def instrument(owner,name,stage=None,rows=None,bytes=None):
+    '''
+    Register owner.name, a method of a class or a function of a module, to be
+    measured as stage while enabled. Generator functions are only measured
+    until they return the generator.
+    :param str stage:   defaults to name
+    :param rows:    function(result,*args) returning the number of rows
+    :param bytes:   function(result,*args) returning the number of bytes
+    '''
+    point=(owner,name,stage or name,rows,bytes,owner.__dict__[name])
+    _points.append(point)
+    if _active is not None: _wrap(point)
+
+def enable(stats=None):
+    '''
+    Measure the registered stages from now on
+    @return: the Stats collecting them
+    '''
+    global _active
+    if _active is None:
+        for p in _points: _wrap(p)
+    _active=stats or Stats()
+    return _active
+
+def disable():
+    '''
+    Remove the instrumentation
+    @return: the Stats collected since enable or None
+    '''
+    global _active
+    stats,_active=_active,None
+    for owner,name,_,_,_,fn in _points: setattr(owner,name,fn)
+    return stats
+
+def active():
+    '''
+    the Stats currently collecting or None
+    '''
+    return _active
+
+def measured_call(fn,*args):
+    '''
+    Call fn(*args) with a fresh Stats enabled, eg. in a worker process.
+    Module level, so it can run inside a process pool.
+    @return:    (result, summary of the Stats)
+    '''
+    prev=_active
+    stats=enable()
+    try: ret=fn(*args)
+    finally:
+        if prev is None: disable()
+        else: enable(prev)
+    return ret,stats.summary()
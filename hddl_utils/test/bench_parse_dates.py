@@ -0,0 +1,23 @@
+'''
+Benchmark of the vectorized tick date parsing against the per row parse_date.
+'''
+import os,sys,io,time
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..','scripts'),os.path.join(here,'..','..')]
+import pandas as pd
+import hddl
+from histdata_server import make_ticks
+
+def bench(n=200000):
+    txt=make_ticks('EURUSD',2017,2,n)
+    t=time.time()
+    old=pd.read_csv(io.BytesIO(txt),header=None,names='ask bid vol'.split(),parse_dates=True,date_parser=hddl.parse_date)
+    t_old=time.time()-t
+    t=time.time()
+    new=hddl.read_ticks(io.BytesIO(txt))
+    t_new=time.time()-t
+    assert (old.index+pd.Timedelta(hddl.EST_OFFSET)).equals(new.index)
+    print "%d ticks: parse_date %.3fs, parse_dates %.3fs, speedup %.1fx"%(n,t_old,t_new,t_old/t_new)
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv)>1 else 200000)
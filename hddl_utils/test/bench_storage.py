@@ -0,0 +1,41 @@
+'''
+Benchmark of CandleStorage2 ingestion: the previous append path against
+the vectorized append and bulk_load. Reports rows per second.
+'''
+import os,sys,time,tempfile,shutil
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..')]
+import numpy as np,pandas as pd
+from hddl_utils.candles import CandleStorage2,dt_to_int
+
+def candles(n,start='2017-01-02'):
+    date=pd.date_range(start,periods=n,freq='s')
+    close=1+np.random.RandomState(0).normal(0,1e-4,n).cumsum()
+    return pd.DataFrame({'date':date.to_pydatetime(),'open':close,'close':close,'high':close+1e-4,'low':close-1e-4},
+                        columns=CandleStorage2.cols)
+
+def previous_append(cs,df):
+    date=df.date.map(dt_to_int)
+    vals=np.array([date,df.open,df.close,df.high,df.low]).T
+    cs.conn.executemany("replace into {tn}  values (?,?,?,?,?)".format(tn=cs.tablename),vals)
+    cs.conn.commit()
+
+def bench(n=10**6,chunk=10**5):
+    df=candles(n)
+    tmp=tempfile.mkdtemp()
+    runs=[('previous append',{},lambda cs: [previous_append(cs,df[i:i+chunk]) for i in range(0,n,chunk)]),
+          ('append',{},lambda cs: [cs.append(df[i:i+chunk]) for i in range(0,n,chunk)]),
+          ('bulk_load',{'journal_mode':'WAL','synchronous':'OFF'},lambda cs: cs.bulk_load(df[i:i+chunk] for i in range(0,n,chunk)))]
+    try:
+        for name,kw,run in runs:
+            cs=CandleStorage2(name=os.path.join(tmp,name+'.db'),**kw)
+            t=time.time()
+            run(cs)
+            t=time.time()-t
+            assert cs.conn.execute('select count(*) from stock').fetchone()[0]==n
+            print "%-16s %8.0f rows/s"%(name,n/t)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv)>1 else 10**6)
@@ -0,0 +1,237 @@
+'''
+Offline benchmark suite of the hot paths: download, unzip, parse, aggregate,
+csv output, CandleStorage2 ingestion and range reads, all against the local
+histdata stand-in. Every scenario is timed best of --repeat runs and the
+results are written as JSON, so runs can be compared over time:
+
+    python bench_suite.py --ticks 1000000 -o base.json
+    python bench_suite.py --ticks 1000000 --baseline base.json
+
+With --baseline the exit code is 1 if a scenario got slower than the
+tolerance allows.
+'''
+import os,sys,io,json,time,zipfile,tempfile,shutil,platform,argparse
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..','scripts'),os.path.join(here,'..','..')]
+import numpy as np,pandas as pd
+import hddl
+from hddl_utils.candles import CandleStorage2
+from histdata_server import HistdataServer
+
+FREQS=['5s','60s','3600s']
+SCENARIOS=[]
+
+def scenario(unit):
+    '''
+    Register a scenario. It is called with the Fixture, does its setup and
+    returns a function to time, which returns the number of processed units.
+    '''
+    def register(fn):
+        SCENARIOS.append((fn.__name__,unit,fn))
+        return fn
+    return register
+
+class Fixture(object):
+    '''
+    Shared input of the scenarios: a server, one month as zip, csv, ticks and
+    5s candles, created once per suite run.
+    '''
+    def __init__(self,ticks):
+        self.ticks=ticks
+        self.tmp=tempfile.mkdtemp()
+        self.server=HistdataServer(ticks=ticks).start()
+        self.zip=self.server.archive('EURUSD',2017,2)
+        zf=zipfile.ZipFile(io.BytesIO(self.zip))
+        self.csv=zf.read(zf.namelist()[0])
+        self.df=hddl.read_ticks(io.BytesIO(self.csv))
+        self.ts=self.df.index.values.view(np.int64)
+        self.price=((self.df.ask+self.df.bid)/2).values
+        self.candles=hddl.ticks_to_candles(self.df,'5s')
+        self.rows=self.candles.rename_axis('date').reset_index()[CandleStorage2.cols]
+        self._n=0
+
+    def path(self,name):
+        self._n+=1
+        return os.path.join(self.tmp,"%d_%s"%(self._n,name))
+
+    def close(self):
+        self.server.stop()
+        shutil.rmtree(self.tmp)
+
+@scenario('bytes')
+def download(fx):
+    def run():
+        d=hddl.Downloader('EURUSD',2017,2,host=fx.server.url,verbose=0)
+        d._load()
+        return d.size
+    return run
+
+@scenario('bytes')
+def unzip(fx):
+    def run():
+        zf=zipfile.ZipFile(io.BytesIO(fx.zip))
+        return len(zf.read(zf.namelist()[0]))
+    return run
+
+@scenario('ticks')
+def parse(fx):
+    return lambda: len(hddl.read_ticks(io.BytesIO(fx.csv)))
+
+@scenario('ticks')
+def aggregate(fx):
+    def run():
+        list(hddl.aggregate([(fx.ts,fx.price)],FREQS))
+        return len(fx.ts)
+    return run
+
+@scenario('ticks')
+def aggregate_chunked(fx):
+    def run():
+        list(hddl.aggregate(((fx.ts[i:i+2**16],fx.price[i:i+2**16]) for i in range(0,len(fx.ts),2**16)),FREQS))
+        return len(fx.ts)
+    return run
+
+@scenario('rows')
+def csv_write(fx):
+    def run():
+        out=hddl.CsvOutput(fx.path('out.csv'),'2017-02','2017-03',update=False)
+        out.begin('2017-02')
+        out.write(fx.candles)
+        out.commit()
+        out.close()
+        return len(fx.candles)
+    return run
+
+def _storage(fx,**kw):
+    return CandleStorage2(name=fx.path('test.db'),**kw)
+
+@scenario('rows')
+def storage_append(fx):
+    def run():
+        s=_storage(fx)
+        s.append(fx.rows)
+        s.close()
+        return len(fx.rows)
+    return run
+
+@scenario('rows')
+def storage_bulk_load(fx):
+    def run():
+        s=_storage(fx)
+        s.bulk_load(fx.rows[i:i+2**16] for i in range(0,len(fx.rows),2**16))
+        s.close()
+        return len(fx.rows)
+    return run
+
+def _read_days(s,fx):
+    n=0
+    for day in pd.date_range(fx.rows.date.iloc[0].normalize(),fx.rows.date.iloc[-1],freq='D'):
+        n+=len(s[day:day+pd.Timedelta('1d')])
+    return n
+
+@scenario('rows')
+def range_read(fx):
+    s=_storage(fx,cache_size=0)
+    s.bulk_load(fx.rows)
+    return lambda: _read_days(s,fx)
+
+@scenario('rows')
+def range_read_cached(fx):
+    s=_storage(fx)
+    s.bulk_load(fx.rows)
+    s['1970':'2100']
+    return lambda: _read_days(s,fx)
+
+@scenario('rows')
+def resample_sql(fx):
+    s=_storage(fx,cache_size=0)
+    s.bulk_load(fx.rows)
+    def run():
+        s.resample('1h')
+        return len(fx.rows)
+    return run
+
+@scenario('ticks')
+def end_to_end(fx):
+    def run():
+        hddl.download('EURUSD','2017-01','2017-03',[fx.path('%s.csv'%f) for f in FREQS],FREQS,update=False,host=fx.server.url)
+        return 2*fx.ticks
+    return run
+
+@scenario('ticks')
+def end_to_end_pipelined(fx):
+    def run():
+        hddl.download('EURUSD','2017-01','2017-03',[fx.path('%s.csv'%f) for f in FREQS],FREQS,update=False,host=fx.server.url,workers=2,parsers=2)
+        return 2*fx.ticks
+    return run
+
+def run(ticks=200000,repeat=3,only=None):
+    '''
+    Run the scenarios
+    :param int ticks:   ticks per month of the synthetic data
+    :param int repeat:  runs per scenario, the fastest is reported
+    :param list only:   names of the scenarios to run, defaults to all
+    @return: dict ready to be dumped as JSON
+    '''
+    fx=Fixture(ticks)
+    results={}
+    stdout=sys.stdout
+    try:
+        for name,unit,fn in SCENARIOS:
+            if only and name not in only: continue
+            runs=[]
+            sys.stdout=open(os.devnull,'w')
+            try:
+                timed=fn(fx)
+                for _ in range(repeat):
+                    t=time.time()
+                    n=timed()
+                    runs.append(time.time()-t)
+            finally:
+                sys.stdout.close()
+                sys.stdout=stdout
+            best=min(runs)
+            results[name]=dict(unit=unit,items=n,seconds=best,rate=n/best,runs=runs)
+            print >>sys.stderr,"%-22s %12.0f %s/s"%(name,n/best,unit)
+    finally:
+        sys.stdout=stdout
+        fx.close()
+    return dict(meta=dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'),python=platform.python_version(),
+                          numpy=np.__version__,pandas=pd.__version__,machine=platform.machine(),
+                          ticks=ticks,repeat=repeat),
+                scenarios=results)
+
+def compare(results,baseline,tolerance=0.25):
+    '''
+    Print the rate of every scenario relative to baseline.
+    @return: names of the scenarios slower than baseline by more than tolerance
+    '''
+    slower=[]
+    for name,r in sorted(results['scenarios'].items()):
+        b=baseline['scenarios'].get(name)
+        if b is None: continue
+        ratio=r['rate']/b['rate']
+        flag=''
+        if ratio<1-tolerance:
+            slower.append(name)
+            flag=' REGRESSION'
+        print >>sys.stderr,"%-22s %6.2fx%s"%(name,ratio,flag)
+    return slower
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description="Offline benchmarks of hddl, results are written as JSON")
+    parser.add_argument('--ticks',type=int,default=200000,help="ticks per synthetic month")
+    parser.add_argument('--repeat',type=int,default=3,help="runs per scenario, the fastest counts")
+    parser.add_argument('--only',nargs='+',choices=[s[0] for s in SCENARIOS],help="run only these scenarios")
+    parser.add_argument('-o','--output',help="write the JSON here instead of stdout")
+    parser.add_argument('--baseline',help="JSON of an earlier run to compare against")
+    parser.add_argument('--tolerance',type=float,default=0.25,help="allowed relative slowdown against the baseline")
+    args=parser.parse_args()
+    results=run(args.ticks,args.repeat,args.only)
+    if args.output:
+        with open(args.output,'w') as f: json.dump(results,f,indent=1,sort_keys=True)
+    else:
+        print json.dumps(results,indent=1,sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f: baseline=json.load(f)
+        if compare(results,baseline,args.tolerance): sys.exit(1)
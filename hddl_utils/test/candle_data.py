@@ -0,0 +1,34 @@
+'''
+Synthetic candles and comparisons shared by the tests of the storages and
+outputs.
+
+    df=candles('2017-01-02',1000,'1min')
+    assert same(CandleStorage2(...)['1970':'2100'],df)
+'''
+import numpy as np,pandas as pd
+from hddl_utils.candles import CandleStorage2
+
+def candles(start='2017-01-02',periods=None,freq='1min',seed=0,dates=None):
+    '''
+    A random walk of candles with open equal to close and high and low 1e-4
+    apart, in the columns of CandleStorage2.
+    :param dates: the dates of the candles, else periods dates from start
+                  every freq
+    '''
+    if dates is None: dates=pd.date_range(start,periods=periods,freq=freq)
+    close=1.1+np.random.RandomState(seed).normal(0,1e-4,len(dates)).cumsum()
+    return pd.DataFrame({'date':dates,'open':close,'close':close,'high':close+1e-4,'low':close-1e-4},
+                        columns=CandleStorage2.cols)
+
+def _dates(df):
+    return df.date.values if 'date' in df.columns else df.index.values
+
+def same(a,b):
+    '''
+    True if the candles of a and b have equal dates and close values, NaN
+    equal to NaN. The dates are the date column, or the index if there is
+    none, so frames read from a storage compare to csv frames indexed by date.
+    '''
+    cols=[c for c in b.columns if c!='date']
+    return len(a)==len(b) and (_dates(a)==_dates(b)).all() and \
+        np.allclose(a[cols].values.astype(float),b[cols].values.astype(float),equal_nan=True)
@@ -0,0 +1,146 @@
+'''
+A local stand-in for histdata.com. It serves the token page and get.php
+with deterministic synthetic tickdata, so downloads can be tested offline.
+
+    server=HistdataServer().start()
+    Downloader('EURUSD',2017,2,host=server.url).download()
+    server.stop()
+
+or standalone: python histdata_server.py [port] [ticks per month]
+'''
+import BaseHTTPServer,SocketServer,threading,zipfile,re,urlparse,zlib,time
+from io import BytesIO
+import numpy as np,pandas as pd
+
+TOKEN='0123456789abcdef'
+PAGE_RE=re.compile(r'/download-free-forex-historical-data/\?/ascii/tick-data-quotes/(\w+)/(\d+)/(\d+)')
+
+def make_ticks(pair,year,month,n=10000):
+    '''
+    Create n synthetic ticks of one month in histdata format
+    "YYYYMMDD HHMMSSfff,ask,bid,vol". The result only depends on the arguments.
+    :param str pair:
+    :param int year:
+    :param int month:
+    :param int n:   number of ticks
+    '''
+    rng=np.random.RandomState(zlib.crc32("%s%d%02d"%(pair,year,month))&0xffffffff)
+    start=pd.Timestamp(year=year,month=month,day=1)
+    span=int(((start+pd.offsets.MonthBegin())-start).total_seconds()*1000)
+    ms=np.sort(rng.randint(0,span,n))
+    ask=1.1+np.cumsum(rng.normal(0,1e-4,n))
+    bid=ask-rng.randint(1,20,n)*1e-5
+    t=start+pd.to_timedelta(ms,'ms')
+    if not n or min(ask.min(),bid.min())<1 or max(ask.max(),bid.max())>=9.9999995:
+        return ''.join("%s,%.6f,%.6f,0\n"%(s[:-3],a,b) for s,a,b in zip(t.strftime('%Y%m%d %H%M%S%f'),ask,bid))
+    #fixed width rows "YYYYMMDD HHMMSSfff,a.aaaaaa,b.bbbbbb,0\n" built as one byte array
+    row=np.empty((n,39),np.uint8)
+    row[:,[8,18,27,36,38]]=[ord(' '),ord(','),ord(','),ord(','),ord('\n')]
+    row[:,37]=ord('0')
+    fields=[(t.year,4),(t.month,2),(t.day,2),(t.hour,2),(t.minute,2),(t.second,2),(ms%1000,3)]
+    row[:,np.r_[0:8,9:18]]=np.hstack([_digits(np.asarray(v),w) for v,w in fields])
+    for price,at in ((ask,19),(bid,28)):
+        p=np.round(price*10**6).astype(np.int64)
+        row[:,at]=p//10**6+ord('0')
+        row[:,at+1]=ord('.')
+        row[:,at+2:at+8]=_digits(p%10**6,6)
+    return row.tostring()
+
+def _digits(x,width):
+    '''
+    ascii digits of non negative ints, zero padded to width
+    '''
+    return (x[:,None]//10**np.arange(width-1,-1,-1)%10+ord('0')).astype(np.uint8)
+
+def make_zip(pair,year,month,n=10000):
+    '''
+    Create the zip archive get.php would return for pair, year and month.
+    '''
+    bio=BytesIO()
+    zf=zipfile.ZipFile(bio,'w',zipfile.ZIP_DEFLATED)
+    zf.writestr("DAT_ASCII_%s_T_%d%02d.csv"%(pair,year,month),make_ticks(pair,year,month,n))
+    zf.writestr("DAT_ASCII_%s_T_%d%02d.txt"%(pair,year,month),"synthetic data\n")
+    zf.close()
+    return bio.getvalue()
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    #keep connections alive like a real server
+    protocol_version='HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server._lock: self.server.connections+=1
+
+    def do_GET(self):
+        m=PAGE_RE.match(self.path)
+        if not m: return self.send_error(404)
+        self._send('<html><input type="hidden" id="tk" value="%s"></html>'%TOKEN,'text/html')
+
+    def do_POST(self):
+        if self.path!='/get.php': return self.send_error(404)
+        form=urlparse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])))
+        if form.get('tk')!=[TOKEN]: return self.send_error(403)
+        ym=form['datemonth'][0]
+        time.sleep(self.server.latency)
+        with self.server._lock:
+            self.server.requests+=1
+            fail=self.server.fail>0 or form['fxpair'][0] in self.server.unavailable
+            self.server.fail=max(0,self.server.fail-1)
+        if fail: return self.send_error(503)
+        self._send(self.server.archive(form['fxpair'][0],int(ym[:4]),int(ym[4:])),'application/zip')
+
+    def _send(self,body,ctype):
+        self.send_response(200)
+        self.send_header('Content-Type',ctype)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,*args): pass
+
+class HistdataServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    daemon_threads=True
+    def __init__(self,port=0,ticks=10000,latency=0):
+        '''
+        :param int port:    port to listen on, 0 picks a free one
+        :param int ticks:   number of ticks per month
+        :param float latency:   seconds to wait before answering get.php
+        
+        Set fail to answer the next fail archive requests with 503, add
+        pairs to unavailable to answer all their requests with 503.
+        requests counts archive requests, connections accepted connections.
+        '''
+        BaseHTTPServer.HTTPServer.__init__(self,('127.0.0.1',port),Handler)
+        self.ticks=ticks
+        self.latency=latency
+        self.requests=0
+        self.connections=0
+        self.fail=0
+        self.unavailable=set()
+        self._archives={}
+        self._lock=threading.Lock()
+
+    @property
+    def url(self): return 'http://127.0.0.1:%d'%self.server_address[1]
+
+    def archive(self,pair,year,month):
+        key=(pair,year,month)
+        with self._lock:
+            if key not in self._archives: self._archives[key]=make_zip(pair,year,month,self.ticks)
+            return self._archives[key]
+
+    def start(self):
+        t=threading.Thread(target=self.serve_forever)
+        t.daemon=True
+        t.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == '__main__':
+    import sys
+    server=HistdataServer(int(sys.argv[1]) if len(sys.argv)>1 else 8000,int(sys.argv[2]) if len(sys.argv)>2 else 10000)
+    print "serving on",server.url
+    server.serve_forever()
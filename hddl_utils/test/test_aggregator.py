@@ -0,0 +1,55 @@
+'''
+Compares CandleAggregator against a per tick reference and measures its
+throughput.
+'''
+import os,sys,time
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..')]
+import numpy as np
+from hddl_utils.candles import CandleAggregator
+
+def reference(sym,ts,price,durations):
+    running={}
+    closed=[]
+    for k,(s,t,p) in enumerate(zip(sym,ts,price)):
+        for d in durations:
+            c=running.get((s,d))
+            if c and c[0]!=t//d*d:
+                closed.append((s,d)+c+(k,))
+                c=None
+            running[(s,d)]=(t//d*d,c[1],max(c[2],p),min(c[3],p),p) if c else (t//d*d,p,p,p,p)
+    return closed
+
+def ticks(n,symbols=5,seed=0):
+    rng=np.random.RandomState(seed)
+    ts=np.sort(rng.randint(1500000000,1500000000+n//2,n))
+    return rng.randint(0,symbols,n),ts,1+rng.normal(0,1e-3,n).cumsum()
+
+def test_matches_reference():
+    sym,ts,price=ticks(5000)
+    agg=CandleAggregator(range(5),[1,5,60])
+    got=[]
+    for i in range(0,len(ts),700):
+        c=agg.add(sym[i:i+700],ts[i:i+700],price[i:i+700])
+        got+=[tuple(r)[:-1]+(r['closed_by']+i,) for r in c]
+    assert got==reference(sym,ts,price,[1,5,60])
+    assert len(agg.flush())==15
+
+def test_onclose():
+    sym,ts,price=ticks(500,1)
+    calls=[]
+    CandleAggregator([0],[10]).add(sym,ts,price,lambda c,v: calls.append((c.start_time,c.open,c.close,v)))
+    ref=reference(sym,ts,price,[10])
+    assert [(c[3],c[6],(price[c[7]],ts[c[7]])) for c in ref]==[x[1:] for x in calls]
+
+def bench(n=10**6,symbols=20,batch=10**5):
+    sym,ts,price=ticks(n,symbols)
+    agg=CandleAggregator(range(symbols),[1,5,60,3600])
+    t=time.time()
+    for i in range(0,n,batch): agg.add(sym[i:i+batch],ts[i:i+batch],price[i:i+batch])
+    print "%d ticks, %d symbols, 4 durations: %.0f ticks/s"%(n,symbols,n/(time.time()-t))
+
+if __name__ == '__main__':
+    test_matches_reference()
+    test_onclose()
+    bench()
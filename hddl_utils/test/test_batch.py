@@ -0,0 +1,126 @@
+'''
+Batch downloads of several pairs against the local histdata stand-in:
+results, connection reuse, retries, rate limit and throughput.
+'''
+import os,sys,time,tempfile,filecmp,shutil
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..','scripts'),os.path.join(here,'..','..')]
+import hddl
+from hddl_utils.session import PooledSession,RateLimit
+from histdata_server import HistdataServer
+
+PAIRS=['EURUSD','GBPUSD','USDJPY']
+
+def dests(tmp,pairs,name='batch'):
+    return dict((p,os.path.join(tmp,'%s_%s.csv'%(name,p))) for p in pairs)
+
+def test_batch_matches_single():
+    server=HistdataServer(ticks=2000).start()
+    tmp=tempfile.mkdtemp()
+    try:
+        batch=dests(tmp,PAIRS)
+        session=PooledSession(3)
+        assert not hddl.download_batch(PAIRS,'2016-11','2017-03',batch,'60s',update=False,host=server.url,workers=3,parsers=2,session=session)
+        assert server.requests==12
+        #one connection per worker, reused for all months
+        assert server.connections<=3
+        for p in PAIRS:
+            single=os.path.join(tmp,'single_%s.csv'%p)
+            hddl.download(p,'2016-11','2017-03',single,'60s',update=False,host=server.url)
+            assert filecmp.cmp(single,batch[p],shallow=False),p
+        #nothing is missing
+        assert not hddl.download_batch(PAIRS,'2016-11','2017-03',batch,'60s',host=server.url)
+        assert server.requests==24
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+def test_retries():
+    server=HistdataServer(ticks=2000).start()
+    tmp=tempfile.mkdtemp()
+    try:
+        server.fail=3
+        session=PooledSession(2,retries=3,backoff=.01)
+        batch=dests(tmp,PAIRS[:2])
+        assert not hddl.download_batch(PAIRS[:2],'2017-01','2017-03',batch,'60s',host=server.url,workers=2,session=session)
+        assert session.stats['retries']==3 and server.requests==7
+        ref=os.path.join(tmp,'ref.csv')
+        hddl.download(PAIRS[0],'2017-01','2017-03',ref,'60s',host=server.url)
+        assert filecmp.cmp(ref,batch[PAIRS[0]],shallow=False)
+        #a pair failing for good does not stop the others
+        server.unavailable.add('GBPUSD')
+        batch=dests(tmp,PAIRS,'broken')
+        failed=hddl.download_batch(PAIRS,'2017-01','2017-03',batch,'60s',host=server.url,workers=2,retries=1,backoff=.01)
+        assert failed.keys()==['GBPUSD']
+        assert os.path.getsize(batch['GBPUSD'])==0
+        assert filecmp.cmp(ref,batch['EURUSD'],shallow=False)
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+def test_transient_fetch_errors():
+    calls=[]
+    def flaky(n):
+        calls.append(n)
+        if len(calls)<3: raise hddl.zipfile.BadZipfile('truncated')
+        return n
+    assert hddl.retry(flaky,3,0,hddl.TRANSIENT)(5)==5 and len(calls)==3
+    try:
+        hddl.retry(flaky,3,0,hddl.TRANSIENT)(None.bit_length)
+        assert False
+    except AttributeError: pass
+
+def test_rate_limit():
+    limit=RateLimit(50,burst=5)
+    t=time.time()
+    for _ in range(15): limit.wait()
+    dt=time.time()-t
+    #5 at once, then 10 at 50/s, a loaded machine may take longer
+    assert dt>.18,dt
+
+def test_interleave():
+    assert list(hddl.interleave([[1,2,3],[],['a'],'xy']))==[1,'a','x',2,'y',3]
+
+def test_output_names():
+    assert hddl.output_names('EURUSD','',[60])==['EURUSD_60.csv']
+    assert hddl.output_names('EURUSD','d/out.csv',[5,60],batch=True)==['d/EURUSD_out_5.csv','d/EURUSD_out_60.csv']
+    assert hddl.output_names('EURUSD','{pair}/m.csv',[60],batch=True)==['EURUSD/m.csv']
+    tmp=tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tmp,'pairs'),'w') as f: f.write('EURUSD\n#majors\nGBPUSD, USDJPY # yen\n\n')
+        assert hddl.read_pairs('@'+os.path.join(tmp,'pairs'))==PAIRS
+        assert hddl.read_pairs('EURUSD,GBPUSD')==PAIRS[:2]
+    finally: shutil.rmtree(tmp)
+
+def bench(pairs=PAIRS+['AUDUSD','USDCHF'],latency=.5,freq='3600s'):
+    '''
+    months per second of one process per pair (like running the cli for
+    each pair) and of a batch, with some network latency
+    '''
+    server=HistdataServer(ticks=2000,latency=latency).start()
+    tmp=tempfile.mkdtemp()
+    try:
+        t=time.time()
+        for p in pairs: hddl.download(p,'2016-01','2017-01',os.path.join(tmp,'single_%s.csv'%p),freq,update=False,host=server.url)
+        t_single=time.time()-t
+        n=server.requests
+        rate={}
+        for workers in (1,4,6,16):
+            t=time.time()
+            hddl.download_batch(pairs,'2016-01','2017-01',dests(tmp,pairs,workers),freq,update=False,host=server.url,workers=workers)
+            rate[workers]=n/(time.time()-t)
+            print "batch with %d workers: %.1f months/s"%(workers,rate[workers])
+        print "one pair after the other: %.1f months/s"%(n/t_single)
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    test_interleave()
+    test_output_names()
+    test_rate_limit()
+    test_transient_fetch_errors()
+    test_batch_matches_single()
+    test_retries()
+    bench()
+    print "ok"
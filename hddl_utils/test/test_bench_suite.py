@@ -0,0 +1,24 @@
+'''
+Runs the benchmark suite on a tiny month, so the scenarios keep working
+when the code they measure changes.
+'''
+import os,sys,json
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[here]
+import bench_suite
+
+def test_suite():
+    results=json.loads(json.dumps(bench_suite.run(ticks=2000,repeat=1)))
+    assert sorted(results['scenarios'])==sorted(s[0] for s in bench_suite.SCENARIOS)
+    for name,r in results['scenarios'].items():
+        assert r['items']>0 and r['rate']>0 and len(r['runs'])==1,name
+    assert results['meta']['ticks']==2000
+    #a run against itself has no regression
+    assert not bench_suite.compare(results,results)
+    slow=json.loads(json.dumps(results))
+    slow['scenarios']['parse']['rate']*=2
+    assert bench_suite.compare(results,slow)==['parse']
+
+if __name__ == '__main__':
+    test_suite()
+    print "ok"
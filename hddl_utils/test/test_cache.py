@@ -0,0 +1,40 @@
+'''
+Tests the raw archive cache against the local histdata stand-in.
+'''
+import os,sys,tempfile,shutil
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..','scripts'),os.path.join(here,'..','..')]
+import hddl
+from hddl_utils.cache import ArchiveCache
+from histdata_server import HistdataServer,make_zip
+
+def test_reaggregate_from_cache():
+    server=HistdataServer(ticks=2000).start()
+    tmp=tempfile.mkdtemp()
+    cache=ArchiveCache(os.path.join(tmp,'cache'))
+    try:
+        hddl.download('EURUSD','2017-01','2017-04',os.path.join(tmp,'a.csv'),'60s',update=False,host=server.url,cache=cache)
+        assert server.requests==3
+        hddl.download('EURUSD','2017-01','2017-04',os.path.join(tmp,'b.csv'),'5s',update=False,host=server.url,cache=cache,workers=2)
+        assert server.requests==3
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+def test_integrity_and_eviction():
+    tmp=tempfile.mkdtemp()
+    cache=ArchiveCache(tmp,max_size=2*len(make_zip('EURUSD',2017,1,500))+100)
+    for m in (1,2,3): 
+        cache.put('EURUSD',2017,m,make_zip('EURUSD',2017,m,500))
+        os.utime(cache._path('EURUSD',2017,m),(m,m))
+    cache.put('EURUSD',2017,4,make_zip('EURUSD',2017,4,500))
+    assert ('EURUSD',2017,1) not in cache and ('EURUSD',2017,2) not in cache
+    assert cache.get('EURUSD',2017,3)==make_zip('EURUSD',2017,3,500)
+    with open(cache._path('EURUSD',2017,4),'r+b') as f: f.truncate(100)
+    assert cache.get('EURUSD',2017,4) is None
+    assert ('EURUSD',2017,4) not in cache
+    shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    test_reaggregate_from_cache()
+    test_integrity_and_eviction()
@@ -0,0 +1,78 @@
+'''
+Checks the array backed memory tier of CandleStorage and measures single
+candle appends.
+'''
+import os,sys,time,tempfile,shutil
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..')]
+import numpy as np,pandas as pd
+from datetime import datetime,timedelta
+from hddl_utils.candles import CandleStorage,CandleBuffer
+
+T0=datetime(2017,3,20)
+
+def rows(a,b):
+    return [(T0+timedelta(minutes=k),1.+k,2.+k,3.+k,.5+k) for k in range(a,b)]
+
+def test_buffer():
+    buf=CandleBuffer(CandleStorage.cols,4)
+    v=lambda d: [np.asarray(d,float)]*4
+    assert buf.insert(np.array([5,1,3,3]),v([5,1,3,33]))==3
+    assert list(buf.dates)==[1,3,5] and list(buf.columns()[1])==[1,3,5]
+    #existing dates are kept, new ones go to their place
+    assert buf.insert(np.array([4,3,9]),v([4,30,9]))==2
+    assert list(buf.dates)==[1,3,4,5,9] and list(buf.columns()[1])==[1,3,4,5,9]
+    buf.drop(2)
+    assert list(buf.dates)==[4,5,9]
+    for k in range(10,100): buf.insert(np.array([k]),v([k]))
+    assert len(buf)==93 and list(buf.dates[:4])==[4,5,9,10] and buf.dates[-1]==99
+    df=buf.frame(1,3,10)
+    assert list(df.index)==[11,12] and list(df.open)==[5,9]
+    buf.drop(100)
+    assert not len(buf) and buf.start==0
+
+def test_storage():
+    d=tempfile.mkdtemp()
+    try:
+        s=CandleStorage(name=os.path.join(d,'test.db'),max_size=50,min_size=20)
+        for k in range(0,200,7): s.append(rows(k,k+7))
+        #duplicates and an out of order candle
+        s.append(rows(195,196)+rows(190,191))
+        assert len(s)==203 and len(s.data)<=50 and s.last_saved_idx==len(s)-len(s.data)-1
+        assert s.data.date.is_monotonic_increasing and s.data.date.is_unique
+        saved=s.last_saved_idx
+        #slices across the memory/sqlite boundary
+        df=s[saved-5:saved+5]
+        assert list(df.index)==range(saved-5,saved+5)
+        assert list(df.open)==[1.+k for k in range(saved-5,saved+5)]
+        assert s[saved-5].open==1.+saved-5 and s[-1].open==203.
+        assert list(s[5:10].open)==[6.,7.,8.,9.,10.]
+        df=s[T0+timedelta(minutes=saved-3):T0+timedelta(minutes=saved+3)]
+        assert list(df.open)==[1.+k for k in range(saved-3,saved+4)]
+        assert s[T0+timedelta(minutes=7)].close==9.
+        assert s[T0+timedelta(minutes=200)].close==202.
+        s.close()
+        #the spilled candles are in sqlite
+        s=CandleStorage(name=os.path.join(d,'test.db'))
+        assert s.conn.execute('select count(*),min(idx),max(idx) from stock').fetchone()==(saved+1,0,saved)
+        s.close()
+    finally: shutil.rmtree(d)
+
+def bench(n=100000):
+    d=tempfile.mkdtemp()
+    try:
+        s=CandleStorage(name=os.path.join(d,'test.db'))
+        candles=rows(0,n)
+        t=time.time()
+        for c in candles: s.append([c])
+        dt=time.time()-t
+        assert len(s)==n
+        print "%d single appends %.2fs, %d candles/s"%(n,dt,n/dt)
+        s.close()
+    finally: shutil.rmtree(d)
+
+if __name__ == '__main__':
+    test_buffer()
+    test_storage()
+    bench()
+    print "ok"
@@ -0,0 +1,156 @@
+'''
+Hammers CandleStorage2 with reads from several threads while other threads
+append, and checks the connection pool reuses and closes its connections.
+'''
+import os,sys,time,tempfile,shutil,threading,sqlite3
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..')]
+import numpy as np,pandas as pd
+from hddl_utils.candles import CandleStorage2
+from hddl_utils.connections import ConnectionPool
+from candle_data import candles
+
+def run(threads):
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+def test_read_while_appending(writers=2,readers=6,batches=30,n=500):
+    d=tempfile.mkdtemp()
+    try:
+        s=CandleStorage2(name=os.path.join(d,'test.db'))
+        errors=[]
+        done=threading.Event()
+        def write(w):
+            try:
+                for i in range(batches):
+                    s.append(candles(pd.Timestamp('2017-01-01')+pd.Timedelta(days=w*batches+i),n))
+            except Exception as e: errors.append(e)
+        def read(r):
+            try:
+                seen=0
+                while not done.is_set():
+                    df=s['2016-12-01':'2017-06-01']
+                    assert df.date.is_monotonic_increasing and df.date.is_unique
+                    #a batch is committed at once
+                    assert len(df)%n==0 and len(df)>=seen
+                    seen=len(df)
+                    s.max_date
+                s.pool.release()
+            except Exception as e: errors.append(e)
+        rs=[threading.Thread(target=read,args=(r,)) for r in range(readers)]
+        for t in rs: t.start()
+        run([threading.Thread(target=write,args=(w,)) for w in range(writers)])
+        done.set()
+        for t in rs: t.join()
+        assert not errors,errors
+        assert len(s['2016-12-01':'2017-06-01'])==writers*batches*n
+        #closing drops every connection, whichever threads opened them
+        s.close()
+        assert not s.pool._conns
+        try:
+            s.conn
+            assert False
+        except sqlite3.ProgrammingError: pass
+    finally: shutil.rmtree(d)
+
+def test_pool():
+    d=tempfile.mkdtemp()
+    try:
+        pool=ConnectionPool(os.path.join(d,'test.db'))
+        assert pool.conn is pool.conn
+        assert pool.conn.execute('PRAGMA journal_mode').fetchone()[0]=='wal'
+        pool.write(lambda conn: conn.execute('create table t (a INTEGER)'))
+        #writes run in the calling thread, one at a time on one connection
+        idents,conns,running=set(),set(),[0,0]
+        def insert(conn,i):
+            idents.add(threading.current_thread().ident)
+            conns.add(id(conn))
+            running[0]+=1
+            running[1]=max(running)
+            time.sleep(.001)
+            conn.execute('insert into t values (?)',(i,))
+            running[0]-=1
+        run([threading.Thread(target=pool.write,args=(insert,i)) for i in range(20)])
+        assert len(idents)==20 and len(conns)==1 and running[1]==1
+        assert pool.conn.execute('select count(*) from t').fetchone()[0]==20
+        #a write inside a write uses the writer connection and its transaction
+        def outer(conn):
+            conn.execute('insert into t values (100)')
+            pool.write(lambda c: conns.add(id(c)) or c.execute('insert into t values (101)'))
+            raise ValueError('fail')
+        try:
+            pool.write(outer)
+            assert False
+        except ValueError: pass
+        assert len(conns)==1
+        assert pool.conn.execute('select count(*) from t where a>=100').fetchone()[0]==0
+        #a failing write is rolled back and raised in the caller
+        def fail(conn):
+            conn.execute('insert into t values (-1)')
+            raise ValueError('fail')
+        try:
+            pool.write(fail)
+            assert False
+        except ValueError: pass
+        assert pool.conn.execute('select count(*) from t where a<0').fetchone()[0]==0
+        pool.close()
+    finally: shutil.rmtree(d)
+
+LIBMOD='''
+import sys
+sys.path[:0]=%r
+from hddl_utils.candles import CandleStorage2
+from candle_data import candles
+s=CandleStorage2(name=%r)
+s.append(candles(periods=100))
+s.close()
+'''
+
+def test_append_on_import(timeout=60):
+    '''
+    a module appending at import does not deadlock on the import lock
+    '''
+    import subprocess
+    d=tempfile.mkdtemp()
+    try:
+        with open(os.path.join(d,'libmod.py'),'w') as f:
+            f.write(LIBMOD%([os.path.join(here,'..','..'),here],os.path.join(d,'test.db')))
+        p=subprocess.Popen([sys.executable,'-c','import libmod'],cwd=d)
+        t0=time.time()
+        while p.poll() is None and time.time()-t0<timeout: time.sleep(.1)
+        if p.poll() is None: p.kill()
+        assert p.wait()==0
+        assert len(CandleStorage2(name=os.path.join(d,'test.db'))['1970':'2100'])==100
+    finally: shutil.rmtree(d)
+
+def test_short_lived_threads(threads=200,concurrent=10):
+    '''
+    the connections of threads that ended are closed
+    '''
+    d=tempfile.mkdtemp()
+    try:
+        s=CandleStorage2(name=os.path.join(d,'test.db'),cache_size=0)
+        s.append(candles('2017-01-01',100))
+        conns=[]
+        def read():
+            assert len(s['2017-01-01'])==100
+            conns.append(s.conn)
+        for i in range(0,threads,concurrent): run([threading.Thread(target=read) for _ in range(concurrent)])
+        #main thread and the last threads
+        assert len(s.pool._conns)<=concurrent+1
+        closed=0
+        for conn in conns:
+            try: conn.execute('select 1')
+            except sqlite3.ProgrammingError: closed+=1
+        assert closed>=threads-concurrent,closed
+        s.close()
+    finally: shutil.rmtree(d)
+
+if __name__ == '__main__':
+    test_pool()
+    test_append_on_import()
+    test_short_lived_threads()
+    t=time.time()
+    test_read_while_appending()
+    print "read while appending %.2fs"%(time.time()-t)
+    print "ok"
@@ -0,0 +1,112 @@
+'''
+Converts downloaded candle csv files into sqlite tables and column files and
+compares them with the csv.
+'''
+import os,sys,time,tempfile,shutil,subprocess
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..','scripts'),os.path.join(here,'..','..')]
+import numpy as np,pandas as pd
+import hddl
+from hddl_utils.candles import CandleStorage2
+from hddl_utils.tickstore import read_columns
+from histdata_server import HistdataServer
+from candle_data import same
+
+def read(path):
+    return pd.read_csv(path,index_col=0,parse_dates=True)
+
+def csvs(tmp,freq='60s',ticks=5000):
+    server=HistdataServer(ticks=ticks).start()
+    try:
+        paths=[]
+        for pair,fro,to in (('EURUSD','2017-01','2017-04'),('EURUSD','2017-04','2017-06'),('GBPUSD','2017-01','2017-03')):
+            paths.append(os.path.join(tmp,'%s_%s.csv'%(pair,fro)))
+            hddl.download(pair,fro,to,paths[-1],freq,host=server.url,journal=False)
+        return paths
+    finally: server.stop()
+
+def test_ranges():
+    tmp=tempfile.mkdtemp()
+    try:
+        path=os.path.join(tmp,'a.csv')
+        with open(path,'w') as f: f.write(',open\n'+''.join('2017-01-01 00:00:%02d,%d\n'%(i,i) for i in range(50)))
+        for blocksize in (1,7,29,30,1000):
+            ranges=hddl.csv_ranges(path,blocksize)
+            assert ranges[0][0]==6 and ranges[-1][1]==os.path.getsize(path)
+            assert all(a[1]==b[0] for a,b in zip(ranges,ranges[1:]))
+            lines=[open(path).read()[a:b] for a,b in ranges]
+            assert all(l.endswith('\n') for l in lines) and sum(l.count('\n') for l in lines)==50
+    finally: shutil.rmtree(tmp)
+
+def test_imap_bounded():
+    pool=hddl.ThreadPool(4)
+    pulled=[]
+    def items():
+        for i in range(50):
+            pulled.append(i)
+            yield i
+    for n,x in enumerate(hddl.imap_bounded(pool,abs,items(),6)):
+        assert x==n and len(pulled)<=n+7
+        time.sleep(.001)
+    assert n==49
+    pool.terminate()
+
+def test_convert():
+    tmp=tempfile.mkdtemp()
+    try:
+        jan,apr,gbp=csvs(tmp)
+        db=os.path.join(tmp,'out.db')
+        #the two EURUSD files overlap in 2017-04 and become one table
+        rows=hddl.convert([jan,apr,gbp],db,['EURUSD','EURUSD','1gbp'],processes=2,blocksize=2**14,verbose=0)
+        ref=pd.concat([read(jan),read(apr),read(gbp)])
+        assert rows==dict(EURUSD=len(read(jan))+len(read(apr)),t_1gbp=len(read(gbp)))
+        eur=pd.concat([read(jan),read(apr)])
+        eur=eur[~eur.index.duplicated(keep='last')]
+        assert same(CandleStorage2(name=db,tablename='EURUSD')['1970':'2100'],eur)
+        assert same(CandleStorage2(name=db,tablename='t_1gbp')['1970':'2100'],read(gbp))
+        #columnar
+        out=os.path.join(tmp,'columns')
+        hddl.convert([gbp],out,columnar=True,processes=2,blocksize=2**14,verbose=0)
+        cols=read_columns(os.path.join(out,'GBPUSD_2017_01'))
+        df=pd.DataFrame(dict((k,np.asarray(v)) for k,v in cols.items()))
+        df['date']=df.date.values.view('M8[ns]')
+        assert same(df,read(gbp))
+        #the cli
+        subprocess.check_call([sys.executable,os.path.join(here,'..','..','scripts','hddl.py'),'convert',gbp,'-o',os.path.join(tmp,'cli.db'),'-n','gbp'],
+                              stdout=open(os.devnull,'w'),env=dict(os.environ,PYTHONPATH=os.path.join(here,'..','..')))
+        assert same(CandleStorage2(name=os.path.join(tmp,'cli.db'),tablename='gbp')['1970':'2100'],read(gbp))
+    finally: shutil.rmtree(tmp)
+
+def bench():
+    '''
+    rows/s of the old conversion (chunks of 4096 rows with inferred date
+    formats, appended one by one) and of convert
+    '''
+    tmp=tempfile.mkdtemp()
+    try:
+        paths=csvs(tmp,'5s',100000)
+        n=sum(len(read(p)) for p in paths)
+        t=time.time()
+        for p in paths:
+            cs=CandleStorage2(name=os.path.join(tmp,'old.db'),tablename=os.path.basename(p)[:-4].replace('-','_'),cache_size=0)
+            for df in pd.read_csv(p,index_col=[0],header=None,names="open close high low".split(),skiprows=1,
+                                  parse_dates=True,infer_datetime_format=True,chunksize=4096):
+                cs.append(df.rename_axis('date').reset_index())
+            cs.close()
+        t_old=time.time()-t
+        for processes in (1,2,4):
+            t=time.time()
+            hddl.convert(paths,os.path.join(tmp,'new%d.db'%processes),processes=processes,blocksize=2**20,verbose=0)
+            print "convert with %d processes: %d rows/s"%(processes,n/(time.time()-t))
+        t=time.time()
+        hddl.convert(paths,os.path.join(tmp,'columns'),columnar=True,blocksize=2**20,verbose=0)
+        print "columnar: %d rows/s"%(n/(time.time()-t))
+        print "chunks of 4096 rows: %d rows/s"%(n/t_old)
+    finally: shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    test_ranges()
+    test_imap_bounded()
+    test_convert()
+    bench()
+    print "ok"
@@ -0,0 +1,165 @@
+'''
+The gap index of CandleStorage2 must match the holes found with numpy after
+any sequence of appends, and download must only fetch the months of a
+sqlite output that have gaps and were not fetched before.
+'''
+import os,sys,time,tempfile,shutil
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..','scripts'),os.path.join(here,'..','..')]
+import numpy as np,pandas as pd
+import hddl
+from hddl_utils.candles import CandleStorage2
+from hddl_utils.timestamps import open_time
+from histdata_server import HistdataServer
+from candle_data import candles
+
+def holes(dates,step):
+    '''
+    the holes of the sorted unique dates with numpy
+    '''
+    ts=np.unique(pd.DatetimeIndex(dates).asi8)
+    at=np.flatnonzero(np.diff(ts)>step*10**9)
+    return [(pd.Timestamp(a+step*10**9),pd.Timestamp(b)) for a,b in zip(ts[at],ts[at+1])]
+
+def test_gap_index():
+    d=tempfile.mkdtemp()
+    try:
+        all_=pd.date_range('2017-01-02',periods=20000,freq='5s')
+        keep=np.ones(len(all_),bool)
+        for a,b in ((100,101),(500,620),(5000,5003),(9999,15000)): keep[a:b]=False
+        dates=all_[keep]
+        s=CandleStorage2(name=os.path.join(d,'test.db'),gaps='5s')
+        #chunks ending inside holes, out of order
+        df=candles(dates=dates)
+        for i in (3,0,2,1): s.append(df[i*4000:(i+1)*4000])
+        s.append(df[12000:])
+        assert s.gaps()==holes(dates,5)==s.gaps(freq=5)
+        assert len(s.gaps())==4 and not s.is_complete()
+        #bounds, holes overlapping them are included
+        assert s.gaps('2017-01-02 00:08:21','2017-01-02 00:45')==holes(dates,5)[:2]
+        assert s.gaps(freq='1min')==holes(dates,60)
+        #filling holes
+        s.append(candles(dates=all_[500:600]))
+        s.append(candles(dates=all_[5000:5003]))
+        dates=dates.union(all_[500:600]).union(all_[5000:5003])
+        assert s.gaps()==holes(dates,5)
+        s.close()
+        #found again, bulk_load
+        s=CandleStorage2(name=os.path.join(d,'test.db'))
+        assert s.gap_step==5
+        s.bulk_load(candles(dates=all_[15000:16000]))
+        assert s.gaps()==holes(dates.union(all_[15000:16000]),5)
+        s.bulk_load(candles(dates=all_))
+        assert s.gaps()==[] and s.is_complete()
+        s.drop_gap_index()
+        assert s.gap_step is None and s.is_complete()
+        s.append(candles(dates=all_[-1:]+pd.Timedelta('1h')))
+        assert not s.is_complete() and s.is_complete('2h')
+        s.clear()
+        s.close()
+        assert CandleStorage2(name=os.path.join(d,'empty.db')).is_complete()
+    finally: shutil.rmtree(d)
+
+def test_open_time():
+    t=lambda s: pd.Timestamp(s).value
+    h=3600*10**9
+    #fx weekend from friday to sunday 17:00 EST
+    assert open_time(t('2017-01-06 21:00'),t('2017-01-08 23:00'))==2*h
+    assert open_time(t('2017-01-07'),t('2017-01-08'))==0
+    assert open_time(t('2017-01-02'),t('2017-01-09'))==120*h
+
+def test_download():
+    server=HistdataServer(ticks=20000).start()
+    tmp=tempfile.mkdtemp()
+    out=lambda name: os.path.join(tmp,name)
+    try:
+        hddl.download('EURUSD','2017-01','2017-06',out('ref.csv'),'60s',host=server.url,journal=False)
+        ref=hddl.read_output(out('ref.csv'))
+        assert hddl.output_format(out('a.db'))=='sqlite'
+        #a hole in february, one over a weekend in march, april is missing
+        s=CandleStorage2(name=out('a.db'),tablename='candles')
+        part=ref[(ref.index<'2017-02-10')|(ref.index>='2017-02-11')]
+        part=part[(part.index<'2017-03-04')|(part.index>='2017-03-05 22:00')]
+        #months are EST
+        s.append(part[:'2017-04-01 04:59'].rename_axis('date').reset_index())
+        s.append(part['2017-05-01 05:00':].rename_axis('date').reset_index())
+        s.close()
+        n=server.requests
+        hddl.download('EURUSD','2017-01','2017-06',out('a.db'),'60s',host=server.url,journal=False)
+        assert server.requests==n+2
+        ref=ref[(ref.index<'2017-03-04')|(ref.index>='2017-03-05 22:00')]
+        df=hddl.read_output(out('a.db'))
+        assert (df.index.values==ref.index.values).all() and np.allclose(df[ref.columns].values,ref.values,equal_nan=True)
+        s=CandleStorage2(name=out('a.db'),tablename='candles')
+        #and short ones between the months
+        assert s.gap_step==60 and [(a.strftime('%m-%d'),b.strftime('%m-%d %H')) for a,b in s.gaps() if b-a>pd.Timedelta('1h')]==[('03-04','03-05 22')]
+        s.close()
+        n=server.requests
+        hddl.download('EURUSD','2017-01','2017-06',out('a.db'),'60s',host=server.url,journal=False)
+        assert server.requests==n
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+def test_closures():
+    '''
+    months committed with holes, like the christmas closure, are not fetched
+    again, the current month is
+    '''
+    tmp=tempfile.mkdtemp()
+    dest=os.path.join(tmp,'a.db')
+    try:
+        dates=pd.date_range('2018-11-01 05:00','2019-02-01 05:00',freq='1min',closed='left')
+        #closed from dec 24 17:00 to dec 25 17:00 EST
+        dates=dates[(dates<'2018-12-24 22:00')|(dates>='2018-12-25 22:00')]
+        df=candles(dates=dates).set_index('date')
+        out=hddl.SqliteOutput(dest,'2018-11','2019-02')
+        assert len(out.wanted)==3
+        for key,month in df.groupby([hddl.month_key(d) for d in df.index]):
+            out.begin(key)
+            out.write(month)
+            out.commit()
+        out.close()
+        out=hddl.SqliteOutput(dest,'2018-11','2019-02')
+        assert [(a.strftime('%m-%d %H'),b.strftime('%m-%d %H')) for a,b in out.storage.gaps()]==[('12-24 22','12-25 22')]
+        assert not out.wanted
+        #the open month
+        month=hddl.month_key(pd.Timestamp.utcnow().tz_localize(None))
+        out.begin(month)
+        out.commit()
+        assert [d.strftime('%Y-%m') for d in out.incomplete(month,pd.Timestamp(month)+pd.offsets.MonthEnd())]==[month]
+        out.close()
+        #overwriting forgets the fetched months
+        out=hddl.SqliteOutput(dest,'2018-11','2019-02',update=False)
+        assert len(out.wanted)==3 and not out.fetched()
+        out.close()
+    finally: shutil.rmtree(tmp)
+
+def bench(n=2000000,chunk=2**14):
+    '''
+    cost of keeping the gap index while appending and of asking for holes
+    with and without it
+    '''
+    d=tempfile.mkdtemp()
+    try:
+        dates=pd.date_range('2017-01-02',periods=n,freq='1s')
+        dates=dates[np.random.RandomState(0).rand(n)>1e-3]
+        df=candles(dates=dates)
+        for gaps in (None,1):
+            s=CandleStorage2(name=os.path.join(d,'%s.db'%gaps),cache_size=0,gaps=gaps)
+            t=time.time()
+            for i in range(0,len(df),chunk): s.append(df[i:i+chunk])
+            t_append=time.time()-t
+            t=time.time()
+            found=s.gaps(freq=1)
+            print "gap index %-5s: append %7d rows/s, %d holes in %.3fs"%(gaps is not None,len(df)/t_append,len(found),time.time()-t)
+            s.close()
+    finally: shutil.rmtree(d)
+
+if __name__ == '__main__':
+    test_gap_index()
+    test_open_time()
+    test_download()
+    test_closures()
+    bench()
+    print "ok"
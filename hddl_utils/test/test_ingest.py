@@ -0,0 +1,165 @@
+'''
+Replays synthetic tick archives through the ingest service and compares the
+saved candles with candles computed from all ticks at once. Also feeds
+ticks over tcp and udp.
+'''
+import os,sys,time,tempfile,shutil,socket
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..')]
+import numpy as np,pandas as pd
+from hddl_utils.ingest import Ingest,Ticks,ReplaySource,SocketSource,parse_stamps,parse_lines
+from hddl_utils.candles import CandleStorage2
+from histdata_server import make_zip,make_ticks
+from candle_data import same
+
+def archive(tmp,pair,month=1,n=20000):
+    path=os.path.join(tmp,'%s_%d.zip'%(pair,month))
+    with open(path,'wb') as f: f.write(make_zip(pair,2017,month,n))
+    return path
+
+def reference(pair,step,month=1,n=20000):
+    '''
+    candles of the ticks with at least one tick, open is the first tick
+    '''
+    lines=make_ticks(pair,2017,month,n).splitlines()
+    ts=parse_stamps([l.split(',')[0] for l in lines])
+    price=np.array([(float(l.split(',')[1])+float(l.split(',')[2]))/2 for l in lines])
+    g=pd.Series(price).groupby(ts//(step*10**9))
+    return pd.DataFrame({'date':pd.to_datetime(g.first().index.values*step*10**9),'open':g.first().values,
+                         'close':g.last().values,'high':g.max().values,'low':g.min().values},columns=CandleStorage2.cols)
+
+def saved(db,table):
+    s=CandleStorage2(name=db,tablename=table,cache_size=0)
+    try: return s['1970':'2100']
+    finally: s.close()
+
+def wait(ingest,ticks,timeout=10):
+    deadline=time.time()+timeout
+    while ingest.report()['ticks']<ticks and time.time()<deadline: time.sleep(.05)
+
+def test_replay():
+    tmp=tempfile.mkdtemp()
+    try:
+        db=os.path.join(tmp,'live.db')
+        sources=[ReplaySource(archive(tmp,'EURUSD'),'EURUSD',batch=999),ReplaySource(archive(tmp,'GBPUSD'),'GBPUSD',batch=500),
+                 ReplaySource(archive(tmp,'USDJPY',n=100),'USDJPY')]
+        report=Ingest(sources,['EURUSD','GBPUSD'],(60,3600),db,queue_size=2,flush_rows=1000).run()
+        for pair in ('EURUSD','GBPUSD'):
+            for step in (60,3600):
+                assert same(saved(db,'%s_%d'%(pair,step)),reference(pair,step)),(pair,step)
+        assert report['ticks']==40100 and report['unknown']==100 and report['batches']==62
+        assert report['candles']==sum(len(reference(p,s)) for p in ('EURUSD','GBPUSD') for s in (60,3600))
+        assert report['flushes']>2 and 0<=report['latency']['p50']<=report['latency']['max'] and report['ticks_per_s']>0
+        #a month in about half a second
+        t=time.time()
+        report=Ingest([ReplaySource(archive(tmp,'EURUSD',2),'EURUSD',speed=31*86400/.5,batch=100)],['EURUSD'],(60,),db).run()
+        assert .4<time.time()-t<5 and report['ticks']==20000
+        assert same(saved(db,'EURUSD_60'),pd.concat([reference('EURUSD',60),reference('EURUSD',60,2)],ignore_index=True))
+    finally: shutil.rmtree(tmp)
+
+def test_sockets():
+    tmp=tempfile.mkdtemp()
+    try:
+        lines=['%s,%s'%(pair,l) for pair in ('EURUSD','GBPUSD') for l in make_ticks(pair,2017,1,2000).splitlines()]
+        order=np.argsort([l.split(',')[1] for l in lines],kind='mergesort')
+        lines=[lines[i] for i in order]
+        tcp,udp=SocketSource(),SocketSource(udp=True)
+        ingest=Ingest([tcp,udp],['EURUSD','GBPUSD'],(60,),os.path.join(tmp,'live.db'),flush_interval=.05).start()
+        #split inside a line, a second connection
+        conn=socket.create_connection(('127.0.0.1',tcp.port))
+        data='\n'.join(lines[:3000])+'\n'
+        conn.sendall(data[:1001])
+        time.sleep(.05)
+        conn.sendall(data[1001:])
+        conn.close()
+        #ticks of concurrent connections would be late
+        wait(ingest,3000)
+        conn=socket.create_connection(('127.0.0.1',tcp.port))
+        conn.sendall('\n'.join(lines[3000:3500]))
+        conn.close()
+        sock=socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        time.sleep(.2)
+        for i in range(3500,len(lines),50): sock.sendto('\n'.join(lines[i:i+50]),('127.0.0.1',udp.port))
+        wait(ingest,len(lines))
+        tcp.close()
+        udp.close()
+        ingest.join()
+        ingest.close()
+        assert ingest.report()['ticks']==len(lines)
+        ref=parse_lines(lines)
+        assert len(ref.date)==4000 and ref.symbol[0] in ('EURUSD','GBPUSD')
+        for pair in ('EURUSD','GBPUSD'):
+            assert same(saved(os.path.join(tmp,'live.db'),pair+'_60'),reference(pair,60,n=2000)),pair
+    finally: shutil.rmtree(tmp)
+
+def test_late():
+    tmp=tempfile.mkdtemp()
+    try:
+        db=os.path.join(tmp,'live.db')
+        lines=['EURUSD,%s'%l for l in make_ticks('EURUSD',2017,1,2000).splitlines()]
+        #31s older than the running candle, older than the last tick and in the same batch
+        stamp=lines[1000].split(',')[1]
+        t=pd.to_datetime(stamp,format='%Y%m%d %H%M%S%f')
+        late=lambda dt: 'EURUSD,%s,2.0,2.0'%(t-pd.Timedelta(dt)).strftime('%Y%m%d %H%M%S%f')[:-3]
+        tcp=SocketSource()
+        ingest=Ingest([tcp],['EURUSD'],(60,),db,flush_interval=.05).start()
+        conn=socket.create_connection(('127.0.0.1',tcp.port))
+        conn.sendall('\n'.join(lines[:1001])+'\n')
+        time.sleep(.3)
+        conn.sendall('\n'.join([late('31s'),late('1ms')]+lines[1001:1500]+[late('0s')]+lines[1500:])+'\n')
+        conn.close()
+        wait(ingest,len(lines)+3)
+        tcp.close()
+        ingest.join()
+        ingest.close()
+        r=ingest.report()
+        assert r['ticks']==len(lines)+3 and r['late']==3 and r['unknown']==0,r
+        assert same(saved(db,'EURUSD_60'),reference('EURUSD',60,n=2000))
+    finally: shutil.rmtree(tmp)
+
+def test_errors():
+    '''
+    an error in a thread stops the service and is raised
+    '''
+    tmp=tempfile.mkdtemp()
+    try:
+        tcp=SocketSource()
+        bad=[Ticks('EURUSD',np.array([1,2]),np.array([1.]),time.time())]
+        t=time.time()
+        try:
+            Ingest([tcp,bad],['EURUSD'],(60,),os.path.join(tmp,'live.db')).run()
+            assert False
+        except (ValueError,IndexError): pass
+        assert time.time()-t<5 and tcp.closed.is_set()
+        class Failing(object):
+            def append(self,df): raise IOError('disk full')
+            def close(self): pass
+        tcp=SocketSource()
+        ingest=Ingest([tcp,ReplaySource(archive(tmp,'EURUSD'),'EURUSD')],['EURUSD'],(60,),lambda s,d: Failing())
+        try:
+            ingest.run()
+            assert False
+        except IOError: pass
+        assert time.time()-t<10
+    finally: shutil.rmtree(tmp)
+
+def bench(symbols=8,n=200000):
+    '''
+    ticks/s and latency of replaying several symbols as fast as possible
+    '''
+    tmp=tempfile.mkdtemp()
+    try:
+        pairs=['P%d'%i for i in range(symbols)]
+        sources=[ReplaySource(archive(tmp,p,n=n),p,batch=4096) for p in pairs]
+        r=Ingest(sources,pairs,(1,60,3600),os.path.join(tmp,'live.db')).run()
+        print "%d symbols: %d ticks/s, %d candles, latency p50 %.1fms p99 %.1fms, blocked %.1fs"%(
+            symbols,r['ticks_per_s'],r['candles'],r['latency']['p50']*1e3,r['latency']['p99']*1e3,r['blocked'])
+    finally: shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    test_replay()
+    test_sockets()
+    test_late()
+    test_errors()
+    bench()
+    print "ok"
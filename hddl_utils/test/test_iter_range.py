@@ -0,0 +1,94 @@
+'''
+Chunks of CandleStorage2.iter_range must add up to the slice read with
+__getitem__, with and without prefetching.
+'''
+import os,sys,time,tempfile,shutil,threading
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..')]
+import numpy as np,pandas as pd
+from hddl_utils.candles import CandleStorage2,prefetched
+from candle_data import candles,same
+
+def seconds(n,start='2017-01-02'):
+    '''
+    n candles a second apart with a NaN
+    '''
+    df=candles(start,n,'1s')
+    df.loc[7,'high']=np.nan
+    return df
+
+def test_iter_range():
+    d=tempfile.mkdtemp()
+    try:
+        s=CandleStorage2(name=os.path.join(d,'test.db'))
+        df=seconds(10000)
+        s.append(df)
+        for prefetch in (False,True):
+            for chunksize in (999,10000,20000):
+                chunks=list(s.iter_range(chunksize=chunksize,prefetch=prefetch))
+                assert all(len(c)<=chunksize for c in chunks) and len(chunks)==-(-len(df)//chunksize)
+                assert same(pd.concat(chunks,ignore_index=True),df)
+            #bounds, end is exclusive
+            chunks=list(s.iter_range('2017-01-02 00:10','2017-01-02 01:00',chunksize=100,prefetch=prefetch))
+            assert same(pd.concat(chunks,ignore_index=True),s['2017-01-02 00:10':'2017-01-02 01:00'])
+            assert len(chunks)==30 and chunks[-1].date.iloc[-1]==pd.Timestamp('2017-01-02 00:59:59')
+            assert list(s.iter_range('2018-01-01','2019-01-01',prefetch=prefetch))==[]
+            assert [len(c) for c in s.iter_range('2017-01-02 00:00:05','2017-01-02 00:00:08',chunksize=1,prefetch=prefetch)]==[1,1,1]
+            #numpy columns
+            cols=list(s.iter_range(chunksize=3000,prefetch=prefetch,arrays=True))
+            assert [len(c['date']) for c in cols]==[3000,3000,3000,1000]
+            assert (np.concatenate([c['date'] for c in cols])==df.date.values).all()
+            assert np.allclose(np.concatenate([c['high'] for c in cols]),df.high.values,equal_nan=True)
+        #rows appended after the last chunk read are included
+        it=s.iter_range(chunksize=4000)
+        first=next(it)
+        s.append(seconds(10,'2017-01-03'))
+        assert sum(len(c) for c in it)+len(first)==len(df)+10
+        s.close()
+    finally: shutil.rmtree(d)
+
+def test_prefetched():
+    threads=threading.active_count()
+    #stopping early ends the background thread
+    it=prefetched(iter(xrange(100)))
+    assert next(it)==0 and next(it)==1
+    it.close()
+    assert threading.active_count()==threads
+    def fail():
+        yield 1
+        raise ValueError('broken')
+    released=[]
+    it=prefetched(fail(),lambda: released.append(threading.current_thread()))
+    assert next(it)==1
+    try:
+        next(it)
+        assert False
+    except ValueError: pass
+    assert len(released)==1 and released[0] is not threading.current_thread()
+    assert threading.active_count()==threads
+
+def bench(n=2000000,chunksize=2**16):
+    '''
+    rows/s and peak memory of reading everything at once and in chunks,
+    with some work per chunk
+    '''
+    d=tempfile.mkdtemp()
+    try:
+        s=CandleStorage2(name=os.path.join(d,'test.db'),cache_size=0)
+        s.bulk_load(seconds(n))
+        def work(close): return np.log(close).diff().std()
+        t=time.time()
+        work(s['1970':'2100'].close)
+        print "__getitem__: %d rows/s"%(n/(time.time()-t))
+        for prefetch in (False,True):
+            t=time.time()
+            for c in s.iter_range(chunksize=chunksize,prefetch=prefetch): work(c.close)
+            print "iter_range prefetch=%s: %d rows/s"%(prefetch,n/(time.time()-t))
+        s.close()
+    finally: shutil.rmtree(d)
+
+if __name__ == '__main__':
+    test_iter_range()
+    test_prefetched()
+    bench()
+    print "ok"
@@ -0,0 +1,90 @@
+'''
+A download killed in the middle of a month must leave no partial month in
+the output, and the restart must only fetch months that were not fetched.
+'''
+import os,sys,tempfile,filecmp,shutil
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..','scripts'),os.path.join(here,'..','..')]
+import hddl
+from hddl_utils.journal import Journal,PENDING,FETCHED,PARSED,COMMITTED
+from hddl_utils.manifest import Manifest
+from histdata_server import HistdataServer,make_zip
+
+class Killed(BaseException): pass
+
+def test_journal():
+    tmp=tempfile.mkdtemp()
+    try:
+        path=os.path.join(tmp,'out.csv.journal')
+        j=Journal(path)
+        j.set('EURUSD',2017,1,FETCHED,make_zip('EURUSD',2017,1,100))
+        j.set('EURUSD',2017,2,FETCHED,make_zip('EURUSD',2017,2,100))
+        j.set('EURUSD',2017,1,PARSED)
+        j.set('EURUSD',2017,1,COMMITTED)
+        j.close()
+        #torn line of a crash
+        with open(path,'a') as f: f.write('{"job": ["EURUSD", 2017, 3], "sta')
+        j=Journal(path)
+        assert j.state('EURUSD',2017,1)==COMMITTED and j.state('EURUSD',2017,3)==PENDING
+        assert j.unfinished()==[('EURUSD',2017,2)]
+        assert j.open('EURUSD',2017,1) is None
+        with j.open('EURUSD',2017,2) as f: assert f.read()==make_zip('EURUSD',2017,2,100)
+        assert len(open(path).readlines())==2
+        j.set('EURUSD',2017,2,COMMITTED)
+        j.close()
+        assert not os.path.exists(path+'.d')
+    finally: shutil.rmtree(tmp)
+
+def kill_in(month,chunks=1):
+    '''
+    make CsvOutput.write die after writing chunks chunks of month
+    '''
+    write=hddl.CsvOutput.write
+    def killer(self,df):
+        write(self,df)
+        if self.month['month']==month:
+            killer.n+=1
+            if killer.n>=chunks: raise Killed()
+    killer.n=0
+    hddl.CsvOutput.write=killer
+    return write
+
+def test_restart():
+    server=HistdataServer(ticks=3000).start()
+    tmp=tempfile.mkdtemp()
+    out=lambda name: os.path.join(tmp,name)
+    try:
+        hddl.download('EURUSD','2017-01','2017-07',out('full.csv'),'60s',update=False,host=server.url,journal=False)
+        for name,kw in (('serial.csv',dict(chunksize=500,journal=True)),('piped.csv',dict(workers=3,parsers=1,journal=True))):
+            write=kill_in('2017-03',2 if 'chunksize' in kw else 1)
+            try:
+                hddl.download('EURUSD','2017-01','2017-07',out(name),'60s',host=server.url,**kw)
+                assert False
+            except Killed: pass
+            finally: hddl.CsvOutput.write=write
+            #only whole months in the output
+            assert os.path.getsize(out(name))==Manifest.load(out(name)).end
+            assert sorted(Manifest.load(out(name)).months)==['2017-01','2017-02']
+            j=Journal(out(name)+'.journal')
+            fetched=j.unfinished()
+            assert ('EURUSD',2017,3) in fetched
+            assert j.state('EURUSD',2017,2)==COMMITTED
+            j.close()
+            #left over by a kill -9
+            open(out(name)+'.part','w').write('2017-03-01 00:00:00,1,1,1,1\n')
+            n=server.requests
+            hddl.download('EURUSD','2017-01','2017-07',out(name),'60s',host=server.url,**kw)
+            assert server.requests==n+4-len(fetched),name
+            assert filecmp.cmp(out('full.csv'),out(name),shallow=False),name
+            assert not os.path.exists(out(name)+'.part') and not os.path.exists(out(name)+'.journal.d')
+            j=Journal(out(name)+'.journal')
+            assert not j.unfinished() and j.state('EURUSD',2017,6)==COMMITTED
+            j.close()
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    test_journal()
+    test_restart()
+    print "ok"
@@ -0,0 +1,96 @@
+'''
+The binary outputs must hold the same candles as the csv output, resume
+like it, and are benchmarked against it. Formats whose library is missing
+are skipped.
+'''
+import os,sys,time,tempfile,shutil
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..','scripts'),os.path.join(here,'..','..')]
+import numpy as np,pandas as pd
+import hddl
+from histdata_server import HistdataServer
+from candle_data import same
+
+def available(fmt):
+    tmp=tempfile.mkdtemp()
+    try:
+        out=hddl.FORMATS[fmt](os.path.join(tmp,'a'),'2017-01','2017-02')
+        out.begin('2017-01')
+        out.write(pd.DataFrame(dict((c,[1.]) for c in 'open close high low'.split()),index=pd.DatetimeIndex(['2017-01-01'])))
+        out.commit()
+        out.close()
+        return True
+    except ImportError: return False
+    finally: shutil.rmtree(tmp)
+
+def formats():
+    '''
+    the formats other than csv whose libraries are installed
+    '''
+    return [f for f in sorted(hddl.FORMATS) if f!='csv' and available(f)]
+
+def test_formats():
+    assert hddl.output_format('a.csv')=='csv' and hddl.output_format('a.H5')=='hdf' and hddl.output_format('a.npz','csv')=='csv'
+    assert hddl.output_format('a.parquet')=='parquet' and hddl.output_format('a')=='csv'
+    fmts=formats()
+    assert 'npz' in fmts
+    server=HistdataServer(ticks=3000).start()
+    tmp=tempfile.mkdtemp()
+    out=lambda name: os.path.join(tmp,name)
+    try:
+        hddl.download('EURUSD','2017-01','2017-05',[out('ref.csv'),out('refh.csv')],['60s','3600s'],update=False,host=server.url,journal=False)
+        ref,refh=hddl.read_output(out('ref.csv')),hddl.read_output(out('refh.csv'))
+        for fmt in fmts:
+            dest=out('a.'+fmt)
+            #several durations, resumed, and cut by a crash
+            hddl.download('EURUSD','2017-01','2017-03',[dest,out('b.'+fmt)],['60s','3600s'],host=server.url,fmt=fmt,journal=False)
+            if fmt=='hdf':
+                store=pd.HDFStore(dest)
+                store.append('candles',ref[-5:])
+                store.close()
+            #a month is one transaction
+            elif fmt=='sqlite': pass
+            else: open(os.path.join(dest,'2017-03.%s.tmp'%fmt),'w').write('garbage')
+            n=server.requests
+            hddl.download('EURUSD','2017-01','2017-05',[dest,out('b.'+fmt)],['60s','3600s'],host=server.url,fmt=fmt,journal=False)
+            assert server.requests==n+2,fmt
+            assert same(hddl.read_output(dest,fmt),ref),fmt
+            assert same(hddl.read_output(out('b.'+fmt),fmt),refh),fmt
+            #overwrite
+            hddl.download('EURUSD','2017-02','2017-03',dest,'60s',update=False,host=server.url,fmt=fmt,journal=False)
+            assert same(hddl.read_output(dest,fmt),ref['2017-02-01 05:00':'2017-03-01 04:59']),fmt
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+def bench(months=6):
+    '''
+    write and read throughput and size of 5s candles of each format
+    '''
+    tmp=tempfile.mkdtemp()
+    try:
+        index=pd.date_range('2017-01-01',periods=months*31*24*720,freq='5s')
+        close=1.1+np.random.RandomState(0).normal(0,1e-4,len(index)).cumsum()
+        df=pd.DataFrame({'open':close,'close':close,'high':close+1e-4,'low':close-1e-4},index=index,columns='open close high low'.split())
+        for fmt in ['csv']+formats():
+            dest=os.path.join(tmp,'out.'+fmt)
+            t=time.time()
+            out=hddl.FORMATS[fmt](dest,'2017-01',str(index[-1]+pd.offsets.MonthBegin())[:7],update=False)
+            for key,month in df.groupby(df.index.to_period('M')):
+                out.begin(str(key))
+                out.write(month)
+                out.commit()
+            out.close()
+            t_write=time.time()-t
+            t=time.time()
+            assert len(hddl.read_output(dest,fmt))==len(df)
+            t_read=time.time()-t
+            size=os.path.getsize(dest) if os.path.isfile(dest) else sum(os.path.getsize(os.path.join(dest,n)) for n in os.listdir(dest))
+            print "%-8s write %9d rows/s, read %9d rows/s, %6.1f MB"%(fmt,len(df)/t_write,len(df)/t_read,size/2.**20)
+    finally: shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    print "formats:",', '.join(formats())
+    test_formats()
+    bench()
+    print "ok"
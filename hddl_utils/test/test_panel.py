@@ -0,0 +1,92 @@
+'''
+panel must match an outer join of the tables read one by one, forward
+filled with pandas.
+'''
+import os,sys,time,tempfile,shutil
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..')]
+import numpy as np,pandas as pd
+from hddl_utils.candles import CandleStorage2,panel
+from candle_data import candles,same as frames_same
+
+def gappy(n,seed,start='2017-01-02',missing=.1):
+    '''
+    n minutes of candles, missing of them left out
+    '''
+    dates=pd.date_range(start,periods=n,freq='1min')
+    return candles(dates=dates[np.random.RandomState(seed).rand(n)>missing],seed=seed)
+
+def reference(db,tables,start,end,field,fill,how='outer'):
+    cols=[]
+    for tn in tables:
+        s=CandleStorage2(name=db,tablename=tn,cache_size=0)
+        cols.append(s[start:end].set_index('date')[field].rename(tn))
+        s.close()
+    df=pd.concat(cols,axis=1,join=how)
+    #a saved NaN is not filled
+    if fill: df=pd.concat([c.reindex(df.index,method='ffill') for c in cols],axis=1)
+    return df
+
+def same(got,ref):
+    dates,values=got
+    return frames_same(pd.DataFrame(values,index=dates,columns=ref.columns),ref)
+
+def test_panel():
+    d=tempfile.mkdtemp()
+    try:
+        db=os.path.join(d,'test.db')
+        tables=['EURUSD','GBPUSD','USDJPY']
+        for i,tn in enumerate(tables):
+            s=CandleStorage2(name=db,tablename=tn)
+            df=gappy(5000,i,start='2017-01-02 0%d:00'%i)
+            df.loc[10,'close']=np.nan
+            s.append(df)
+            s.close()
+        s=CandleStorage2(name=db,tablename='EURUSD')
+        for field in ('close','high'):
+            for fill in (True,False):
+                for start,end in (('1970','2100'),('2017-01-02 01:30','2017-01-03 12:00')):
+                    ref=reference(db,tables,start,end,field,fill)
+                    assert same(panel(db,tables,start,end,field,fill),ref),(field,fill,start)
+                    assert same(panel(s,tables,pd.Timestamp(start),end,field,fill),ref)
+        assert same(panel(db,tables,field='low',how='inner'),reference(db,tables,'1970','2100','low',False,'inner'))
+        #order of tables, a table twice, no rows
+        ref=reference(db,['USDJPY','EURUSD','USDJPY'],'1970','2100','open',True)
+        assert same(panel(db,['USDJPY','EURUSD','USDJPY'],field='open'),ref)
+        dates,values=panel(db,tables,'2018','2019')
+        assert len(dates)==0 and values.shape==(0,3)
+        for kw in (dict(field='date'),dict(field='close; drop table EURUSD'),dict(how='left')):
+            try:
+                panel(db,tables,**kw)
+                assert False
+            except ValueError: pass
+        s.close()
+    finally: shutil.rmtree(d)
+
+def bench(pairs=24,n=500000):
+    '''
+    panel of pairs tables of n minutes against reading them one by one and
+    joining them with pandas
+    '''
+    d=tempfile.mkdtemp()
+    try:
+        db=os.path.join(d,'test.db')
+        tables=['P%d'%i for i in range(pairs)]
+        for i,tn in enumerate(tables):
+            s=CandleStorage2(name=db,tablename=tn,cache_size=0)
+            s.bulk_load(gappy(n,i,missing=.01))
+            s.close()
+        t=time.time()
+        ref=reference(db,tables,'1970','2100','close',True)
+        t_ref=time.time()-t
+        t=time.time()
+        got=panel(db,tables)
+        t_panel=time.time()-t
+        assert same(got,ref)
+        print "%d pairs x %d minutes: panel %.2fs, read and join %.2fs"%(pairs,n,t_panel,t_ref)
+    finally: shutil.rmtree(d)
+
+if __name__ == '__main__':
+    test_panel()
+    bench()
+    print "ok"
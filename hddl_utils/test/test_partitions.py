@@ -0,0 +1,133 @@
+'''
+A PartitionedStorage must return what a single CandleStorage2 table holding
+the same candles returns, open from its catalog alone and rebuild or drop a
+partition without touching the others.
+'''
+import os,sys,time,tempfile,shutil
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..')]
+import numpy as np,pandas as pd
+from hddl_utils.candles import CandleStorage2
+from hddl_utils.partitions import PartitionedStorage
+from candle_data import candles,same
+
+def files(d):
+    return dict((n,os.path.getmtime(os.path.join(d,n))) for n in os.listdir(d) if n.startswith('stock_2017'))
+
+def test_partitions():
+    d=tempfile.mkdtemp()
+    try:
+        path=os.path.join(d,'parts')
+        df=candles('2017-01-20',60*24*60)
+        ref=CandleStorage2(name=os.path.join(d,'ref.db'))
+        p=PartitionedStorage(path)
+        #chunks spanning months
+        for i in range(0,len(df),20000):
+            p.append(df[i:i+20000])
+            ref.append(df[i:i+20000])
+        #replaced rows are not counted twice
+        p.append(df[40000:50000])
+        assert len(p)==len(df) and p.keys()==['2017-01','2017-02','2017-03']
+        assert sorted(n for n in os.listdir(path) if n.endswith('.db'))==['catalog.db','stock_2017-01.db','stock_2017-02.db','stock_2017-03.db']
+        assert same(p['1970':'2100'],df) and same(p['2017-02'],ref['2017-02'])
+        assert same(p['2017-01-31 12:00':'2017-03-02'],ref['2017-01-31 12:00':'2017-03-02'])
+        assert len(p['2018':'2019'])==0
+        for prefetch in (False,True):
+            assert same(pd.concat(p.iter_range('2017-01-25',None,7000,prefetch),ignore_index=True),ref['2017-01-25':'2100'])
+        assert same(p.resample('1h'),ref.resample('1h')) and same(p.resample('15min','2017-02-03','2017-03-05'),ref.resample('15min','2017-02-03','2017-03-05'))
+        try:
+            p.resample('7h')
+            assert False
+        except ValueError: pass
+        try:
+            p[0:10]
+            assert False
+        except TypeError: pass
+        p.close()
+        #the catalog alone
+        p=PartitionedStorage(path)
+        assert len(p)==len(df) and p.min_date==df.date.iloc[0] and p.max_date==df.date.iloc[-1]
+        assert p.open_partitions=={}
+        #no range cache per partition
+        q=PartitionedStorage(path,cache_size=2**20)
+        assert p.partition('2017-02').cache is None and q.partition('2017-02').cache
+        q.close()
+        #rebuild a partition, the others stay untouched
+        before=files(path)
+        feb=ref['2017-02']
+        feb.loc[5,'close']=2.
+        assert p.rebuild('2017-02',[feb[:1000],feb[1000:]])==len(feb)
+        after=files(path)
+        assert after['stock_2017-01.db']==before['stock_2017-01.db'] and after['stock_2017-03.db']==before['stock_2017-03.db']
+        assert same(p['2017-02'],feb) and len(p)==len(df)
+        try:
+            p.rebuild('2017-02',[feb[:10],ref['2017-03']])
+            assert False
+        except ValueError: pass
+        assert same(p['2017-02'],feb) and not os.path.exists(p.path('2017-02')+'.rebuild')
+        p.clear('2017-01')
+        assert p.keys()==['2017-02','2017-03'] and len(p)==len(df)-len(ref['2017-01'])
+        assert not os.path.exists(p.path('2017-01'))
+        #written behind the catalog
+        p.partition('2017-03').append(candles('2017-03-25',10))
+        p.refresh()
+        assert len(p)==len(df)-len(ref['2017-01'])+10
+        p.clear()
+        assert len(p)==0 and p.min_date is None and p['1970':'2100'].shape==(0,5)
+        p.close()
+        ref.close()
+    finally: shutil.rmtree(d)
+
+def test_years():
+    d=tempfile.mkdtemp()
+    try:
+        df=candles('2016-12-01',24*90,'1h')
+        p=PartitionedStorage(os.path.join(d,'parts'),'EURUSD','year')
+        assert p.bulk_load([df[:1000],df[1000:]],batchsize=300)==len(df)
+        assert p.keys()==['2016','2017'] and len(p)==len(df) and same(p['1970':'2100'],df)
+        p.close()
+        #the partitioning is kept by the catalog
+        p=PartitionedStorage(os.path.join(d,'parts'),'EURUSD')
+        assert p.unit=='Y' and same(p['2017'],df[df.date>='2017'].reset_index(drop=True))
+        p.close()
+        try:
+            PartitionedStorage(os.path.join(d,'parts'),partition='week')
+            assert False
+        except ValueError: pass
+    finally: shutil.rmtree(d)
+
+def bench(months=12,chunk=60*24):
+    '''
+    a year of 10s candles: appending a day at a time, opening and reading a day
+    of a single table and of monthly partitions
+    '''
+    d=tempfile.mkdtemp()
+    try:
+        df=candles('2017-01-01',months*30*86400//10,'10s')
+        for name,make in (('single table',lambda: CandleStorage2(name=os.path.join(d,'one.db'),cache_size=0)),
+                          ('partitioned',lambda: PartitionedStorage(os.path.join(d,'parts'),cache_size=0))):
+            s=make()
+            t=time.time()
+            s.bulk_load(df[:-chunk*30])
+            t_load=time.time()-t
+            t=time.time()
+            for i in range(len(df)-chunk*30,len(df),chunk): s.append(df[i:i+chunk])
+            t_append=(time.time()-t)/30
+            s.close()
+            t=time.time()
+            s=make()
+            n=len(s)
+            t_open=time.time()-t
+            t=time.time()
+            s['2017-06-10']
+            t_read=time.time()-t
+            s.close()
+            print "%-12s: bulk load %.1fs, append a day %.0fms, open %.1fms, read a day %.1fms (%d rows)"%(
+                name,t_load,t_append*1e3,t_open*1e3,t_read*1e3,n)
+    finally: shutil.rmtree(d)
+
+if __name__ == '__main__':
+    test_partitions()
+    test_years()
+    bench()
+    print "ok"
@@ -0,0 +1,61 @@
+'''
+Compares the pipelined download against the serial one using the local
+histdata stand-in.
+'''
+import os,sys,time,tempfile,filecmp,shutil,threading
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..','scripts'),os.path.join(here,'..','..')]
+import hddl
+from histdata_server import HistdataServer
+
+def test_pipeline_matches_serial():
+    server=HistdataServer(ticks=2000).start()
+    tmp=tempfile.mkdtemp()
+    serial,piped=os.path.join(tmp,'serial.csv'),os.path.join(tmp,'piped.csv')
+    try:
+        hddl.download('EURUSD','2016-11','2017-04',serial,'60s',update=False,host=server.url)
+        hddl.download('EURUSD','2016-11','2017-04',piped,'60s',update=False,host=server.url,workers=3,parsers=2)
+        assert filecmp.cmp(serial,piped,shallow=False)
+        assert server.requests==10
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+def test_chunked_matches_whole():
+    server=HistdataServer(ticks=5000).start()
+    tmp=tempfile.mkdtemp()
+    whole,serial,piped=[os.path.join(tmp,n) for n in ('whole.csv','serial.csv','piped.csv')]
+    try:
+        hddl.download('EURUSD','2017-01','2017-03',whole,'60s',update=False,host=server.url)
+        hddl.download('EURUSD','2017-01','2017-03',serial,'60s',update=False,host=server.url,chunksize=333)
+        hddl.download('EURUSD','2017-01','2017-03',piped,'60s',update=False,host=server.url,chunksize=333,workers=2)
+        assert filecmp.cmp(whole,serial,shallow=False)
+        assert filecmp.cmp(whole,piped,shallow=False)
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+def test_concurrent_fetches(fetchers=16,jobs=32,wait=.1):
+    '''
+    all fetchers are busy, not only queue_size of them
+    '''
+    lock=threading.Lock()
+    running=[0,0]
+    def fetch(n):
+        with lock:
+            running[0]+=1
+            running[1]=max(running)
+        time.sleep(wait)
+        with lock: running[0]-=1
+        return n
+    t=time.time()
+    got=list(hddl.pipeline([(n,) for n in range(jobs)],fetch,abs,fetchers=fetchers,parsers=1,queue_size=2))
+    assert got==[((n,),n) for n in range(jobs)]
+    assert running[1]==fetchers,running
+    assert time.time()-t<jobs/fetchers*wait+1
+
+if __name__ == '__main__':
+    test_concurrent_fetches()
+
+    test_pipeline_matches_serial()
+    test_chunked_matches_whole()
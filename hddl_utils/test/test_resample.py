@@ -0,0 +1,100 @@
+'''
+Checks CandleStorage2.resample and rollup tables against candles computed
+from the ticks directly.
+'''
+import os,sys,time,tempfile,shutil
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..')]
+import numpy as np,pandas as pd
+from hddl_utils.candles import CandleStorage2
+from hddl_utils.aggregate import ohlc,fill
+from candle_data import same
+
+S=10**9
+START=1487000000
+
+def ticks(n,seconds,seed=0):
+    '''
+    at least one tick per second, so no 5s candle is padded, since a padded
+    candle repeats high and low of the preceding one
+    '''
+    rng=np.random.RandomState(seed)
+    ts=np.sort(np.r_[np.arange(START,START+seconds),rng.randint(START,START+seconds,n)]).astype(np.int64)*S
+    return ts,1.1+rng.normal(0,1e-4,len(ts)).cumsum()
+
+def candles(ts,price,step):
+    bins,o,c,h,l=fill(*ohlc(ts,price,step*S))
+    return pd.DataFrame({'date':pd.to_datetime(bins*step*S),'open':o,'close':c,'high':h,'low':l},
+                        columns=CandleStorage2.cols)
+
+def test_resample():
+    d=tempfile.mkdtemp()
+    try:
+        ts,price=ticks(20000,6*3600)
+        s=CandleStorage2(name=os.path.join(d,'test.db'))
+        s.append(candles(ts,price,5))
+        for freq,step in [('1min',60),('15min',900),(3600,3600)]:
+            assert same(s.resample(freq),candles(ts,price,step)),freq
+        #buckets containing start and end
+        ref=candles(ts,price,3600)
+        df=s.resample('1h','2017-02-13 16:30','2017-02-13 18:10')
+        assert same(df,ref[(ref.date>='2017-02-13 16:00')&(ref.date<'2017-02-13 19:00')].reset_index(drop=True))
+        s.close()
+    finally: shutil.rmtree(d)
+
+def test_rollups():
+    d=tempfile.mkdtemp()
+    try:
+        ts,price=ticks(20000,6*3600,1)
+        fine=candles(ts,price,5)
+        s=CandleStorage2(name=os.path.join(d,'test.db'),rollups=['1min'])
+        #incremental updates, chunks end inside buckets
+        for i in range(0,len(fine),1001): s.append(fine[i:i+1001])
+        s.add_rollup('1h')
+        assert s.rollups==set([60,3600])
+        for step in s.rollups:
+            assert same(s.resample(step),candles(ts,price,step)),step
+            rt=s._rollup_table(step)
+            assert s.conn.execute('select count(*) from %s'%rt).fetchone()[0]==len(candles(ts,price,step))
+        #replacing candles updates their buckets
+        fine.loc[100:110,'high']=9
+        s.append(fine[100:111])
+        assert s.resample('1min').high.max()==9
+        s.close()
+        #rollup tables are found again, bulk_load updates them
+        s=CandleStorage2(name=os.path.join(d,'test.db'))
+        assert s.rollups==set([60,3600])
+        ts2,price2=ticks(1000,3600,2)
+        ts2+=7*3600*S
+        s.bulk_load(candles(ts2,price2,5))
+        ref=candles(ts2,price2,60)
+        assert same(s.resample('1min',ref.date.iloc[0]),ref)
+        s.drop_rollup('1h')
+        assert s.rollups==set([60])
+        s.clear()
+        assert not len(s.resample('1min'))
+        s.close()
+    finally: shutil.rmtree(d)
+
+def bench(hours=24*30):
+    d=tempfile.mkdtemp()
+    try:
+        ts,price=ticks(hours*500,hours*3600)
+        fine=candles(ts,price,5)
+        s=CandleStorage2(name=os.path.join(d,'test.db'),cache_size=0)
+        s.bulk_load(fine)
+        t=time.time()
+        ref=s['1970':'2100'].set_index('date').resample('1h').agg({'open':'first','close':'last','high':'max','low':'min'})
+        t_pd=time.time()-t
+        t=time.time(); s.resample('1h'); t_sql=time.time()-t
+        s.add_rollup('1h')
+        t=time.time(); s.resample('1h'); t_rollup=time.time()-t
+        print "1h from %d 5s candles: read+pandas %.2fs, sql %.2fs, rollup %.4fs"%(len(fine),t_pd,t_sql,t_rollup)
+        s.close()
+    finally: shutil.rmtree(d)
+
+if __name__ == '__main__':
+    test_resample()
+    test_rollups()
+    bench()
+    print "ok"
@@ -0,0 +1,36 @@
+'''
+Resuming a download must only fetch missing months and give the same file
+as downloading everything at once.
+'''
+import os,sys,tempfile,filecmp,shutil
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..','scripts'),os.path.join(here,'..','..')]
+import hddl
+from hddl_utils.manifest import Manifest
+from histdata_server import HistdataServer
+
+def test_resume():
+    server=HistdataServer(ticks=2000).start()
+    tmp=tempfile.mkdtemp()
+    out=lambda name: os.path.join(tmp,name)
+    try:
+        hddl.download('EURUSD','2017-01','2017-05',out('full.csv'),'60s',update=False,host=server.url)
+        for name,damage in (('manifest.csv',None),('scan.csv','manifest'),('crash.csv','tail')):
+            hddl.download('EURUSD','2017-01','2017-03',out(name),'60s',host=server.url)
+            if damage=='manifest': os.remove(out(name)+'.manifest.json')
+            if damage=='tail':
+                with open(out(name),'a') as f: f.write('2017-03-01 05:00:00,1.0,1.0')
+            n=server.requests
+            hddl.download('EURUSD','2017-01','2017-05',out(name),'60s',host=server.url)
+            assert server.requests==n+2,name
+            assert filecmp.cmp(out('full.csv'),out(name),shallow=False),name
+        m=Manifest.load(out('manifest.csv'))
+        assert sorted(m.months)==['2017-01','2017-02','2017-03','2017-04']
+        assert m.end==os.path.getsize(out('manifest.csv'))
+        assert m.months['2017-03']['rows']==sum(1 for _ in open(out('full.csv')))-1-sum(m.months[k]['rows'] for k in ('2017-01','2017-02','2017-04'))
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    test_resume()
@@ -0,0 +1,119 @@
+'''
+Stage statistics of downloads and storage, serial, pipelined and from the
+cli, and that nothing stays wrapped once disabled.
+'''
+import os,sys,json,time,tempfile,shutil,subprocess,pstats
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..','scripts'),os.path.join(here,'..','..')]
+import numpy as np,pandas as pd
+import hddl
+from hddl_utils import stats
+from hddl_utils.candles import CandleStorage2
+from histdata_server import HistdataServer
+
+TICKS=3000
+
+def test_download_stats():
+    server=HistdataServer(ticks=TICKS).start()
+    tmp=tempfile.mkdtemp()
+    download=hddl.download
+    try:
+        st=stats.enable()
+        assert hddl.download is not download
+        hddl.download('EURUSD','2017-01','2017-03',os.path.join(tmp,'a.csv'),'60s',update=False,host=server.url)
+        s=st.summary()['stages']
+        assert s['download']['calls']==1
+        assert s['token']['calls']==2 and s['transfer']['bytes']==sum(len(server.archive('EURUSD',2017,m)) for m in (1,2))
+        assert s['read_csv']['rows']==2*TICKS and s['parse_dates']['rows']==2*TICKS and s['aggregate']['rows']==2*TICKS
+        assert s['csv_write']['rows']==sum(1 for _ in open(os.path.join(tmp,'a.csv')))-1
+        assert s['download']['seconds']>=s['transfer']['seconds'] and s['download']['peak']>0
+        #stages of the parsing processes are merged
+        st=stats.enable()
+        hddl.download('EURUSD','2017-01','2017-03',os.path.join(tmp,'b.csv'),'60s',update=False,host=server.url,workers=2,parsers=2)
+        s=st.summary()['stages']
+        assert s['fetch']['calls']==2 and s['parse_month']['calls']==2 and s['read_csv']['rows']==2*TICKS
+        assert stats.disable() is st
+        assert hddl.download is download and CandleStorage2.__dict__['append'].__name__=='append'
+        assert stats.active() is None
+        s=CandleStorage2(name=os.path.join(tmp,'test.db'))
+        df=pd.read_csv(os.path.join(tmp,'a.csv'),parse_dates=[0]).rename(columns={'Unnamed: 0':'date'})
+        st=stats.enable()
+        s.append(df)
+        s['2017':'2018']
+        s['2017':'2018']
+        s.resample('1h')
+        stats.disable()
+        s.close()
+        s=st.summary()['stages']
+        #the second read is served by the cache, resample fetches too
+        assert s['storage.append']['rows']==len(df) and s['storage.read']['calls']==2 and s['storage.fetch']['calls']==2
+        assert s['storage.fetch']['rows']==len(df)+s['storage.resample']['rows']
+        json.dumps(st.summary())
+        assert 'storage.append' in st.table()
+    finally:
+        stats.disable()
+        server.stop()
+        shutil.rmtree(tmp)
+
+def big(n): return np.ones(n).sum()
+def small(): return 1
+
+def test_peak(n=2**24):
+    '''
+    a stage after the largest one does not get its peak
+    '''
+    stats.instrument(sys.modules[__name__],'big')
+    stats.instrument(sys.modules[__name__],'small')
+    try:
+        st=stats.enable()
+        big(n)
+        small()
+        stats.disable()
+        s=st.summary()['stages']
+        assert s['big']['peak']-s['small']['peak']>n*8*.8,s
+        assert s['small']['peak']>0 and st.summary()['peak']>=s['big']['peak']
+    finally:
+        stats.disable()
+        del stats._points[-2:]
+
+def test_cli():
+    server=HistdataServer(ticks=TICKS).start()
+    tmp=tempfile.mkdtemp()
+    try:
+        out=os.path.join(tmp,'a.csv')
+        hddl.download('EURUSD','2017-01','2017-02',out,'60s',host=server.url,journal=False)
+        subprocess.check_call([sys.executable,os.path.join(here,'..','..','scripts','hddl.py'),'convert',out,'-o',out+'.db',
+                               '--stats',out+'.json','--profile',out+'.prof'],
+                              stdout=open(os.devnull,'w'),env=dict(os.environ,PYTHONPATH=os.path.join(here,'..','..')))
+        with open(out+'.json') as f: s=json.load(f)
+        assert s['stages']['convert']['rows']==s['stages']['storage.bulk_load']['rows']>0 and s['wall']>0
+        assert pstats.Stats(out+'.prof').total_calls>0
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+def bench(n=200000):
+    '''
+    cost of a call to an instrumented method while disabled and enabled
+    '''
+    tmp=tempfile.mkdtemp()
+    try:
+        s=CandleStorage2(name=os.path.join(tmp,'test.db'),cache_size=0)
+        def run():
+            t=time.time()
+            for _ in xrange(n): s._update_rollups(None,0,0)
+            return (time.time()-t)/n*1e6
+        off=run()
+        stats.enable()
+        on=run()
+        stats.disable()
+        print "instrumented call: %.2fus disabled, %.2fus enabled"%(off,on)
+        s.close()
+    finally: shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    test_download_stats()
+    test_peak()
+    test_cli()
+    bench()
+    print "ok"
@@ -0,0 +1,133 @@
+'''
+Checks that CandleStorage2 reads match the previous read_sql path and that
+cached ranges are invalidated by writes, also of other connections.
+'''
+import os,sys,time,tempfile,shutil
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..')]
+#dates are UTC, a local zone with daylight saving time does not matter
+os.environ['TZ']='Europe/Berlin'
+time.tzset()
+import numpy as np,pandas as pd
+from hddl_utils.candles import CandleStorage2,RangeCache,ts_to_dt
+from candle_data import candles
+
+def storage(**kw):
+    d=tempfile.mkdtemp()
+    s=CandleStorage2(name=os.path.join(d,'test.db'),**kw)
+    s.append(candles('2017-03-20',24*14,'1h'))
+    return d,s
+
+def reference(s,a,b):
+    ret=pd.read_sql("select * from {tn} where date>=? and date<? order by date".format(tn=s.tablename),s.conn,params=(a,b))
+    ret.date=ret.date.map(ts_to_dt)
+    return ret
+
+def test_matches_read_sql():
+    d,s=storage(cache_size=0)
+    try:
+        for key in ['2017-03-26','2017-03',slice('2017-03-25 12:00','2017-03-27')]:
+            ret=s[key]
+            a=s.conn.execute("select min(date),max(date)+1 from stock").fetchone()
+            ref=reference(s,*a)
+            ref=ref[ref.date.isin(ret.date)].reset_index(drop=True)
+            assert len(ret) and ret.equals(ref),key
+        assert s[5].equals(s[5:6])
+    finally: shutil.rmtree(d)
+
+def test_cache():
+    d,s=storage()
+    try:
+        a=s['2017-03-25':'2017-03-29']
+        assert s.cache.entries
+        assert s['2017-03-25':'2017-03-29'].equals(a)
+        #served from the cached superset
+        sub=s['2017-03-26':'2017-03-27']
+        assert len(sub)==24 and sub.equals(a[(a.date>='2017-03-26')&(a.date<'2017-03-27')].reset_index(drop=True))
+        #returned frames are copies
+        a.close=0
+        assert (s['2017-03-25':'2017-03-29'].close>0).all()
+        #writes into a cached range invalidate it
+        s.append(candles('2017-03-26 05:00',1).assign(close=42))
+        assert s['2017-03-26 05:00':'2017-03-26 06:00'].close.iloc[0]==42
+        assert s['2017-03-25':'2017-03-29'].close.max()==42
+        #no writes in between, the cache is kept
+        n=len(s.cache.entries)
+        s['2017-03-21']
+        assert len(s.cache.entries)==n+1
+        #writes of another instance or process are seen
+        other=CandleStorage2(name=s.name,cache_size=0)
+        other.append(candles('2017-03-26 05:00',1).assign(close=2.))
+        assert s['2017-03-26 05:00':'2017-03-26 06:00'].close.iloc[0]==2.
+        assert s['2017-03-25':'2017-03-29'].close.max()==2.
+        other.close()
+        s.clear()
+        assert not s.cache.entries and not len(s['2017-03-25':'2017-03-29'])
+    finally: shutil.rmtree(d)
+
+def test_budget():
+    d,s=storage(cache_size=3000)
+    try:
+        for day in range(20,30): s['2017-03-%d'%day]
+        assert 0<s.cache.bytes<=3000
+        assert len(s.cache.entries)<10
+        #the latest read survives
+        assert s['2017-03-29'] is not None and s.cache.get(*list(s.cache.entries)[-1]) is not None
+    finally: shutil.rmtree(d)
+
+def test_dates_from_local():
+    '''
+    a table written with time.mktime before dates were UTC
+    '''
+    d=tempfile.mkdtemp()
+    try:
+        s=CandleStorage2(name=os.path.join(d,'test.db'),cache_size=0,rollups=['1d'])
+        df=candles('2017-03-25',72,'1h')
+        old=[(int(time.mktime(t.timetuple())),)+tuple(r) for t,r in zip(df.date,df[df.columns[1:]].values)]
+        s.pool.write(lambda conn: conn.executemany("replace into stock values (?,?,?,?,?)",old))
+        assert (s['1970':'2100'].date.iloc[:3]==df.date.iloc[:3]-pd.Timedelta('1h')).all()
+        #02:00 of the 26th does not exist in Berlin, mktime made it 03:00
+        ref=df[df.date!='2017-03-26 02:00'].reset_index(drop=True)
+        assert s.dates_from_local(days=1)==len(ref)
+        assert s['1970':'2100'].equals(ref) and s.resample('1d').equals(ref.resample('1d',on='date').agg(
+            dict(open='first',close='last',high='max',low='min')).reset_index()[s.cols])
+        #another zone
+        s.clear()
+        s.pool.write(lambda conn: conn.executemany("replace into stock values (?,?,?,?,?)",
+                                                   [(t-3600*5,)+tuple(r) for t,r in zip(df.date.values.astype('M8[s]').astype(int),df[df.columns[1:]].values)]))
+        #a failing migration leaves the table as it was
+        before=s['1970':'2100']
+        try:
+            s.dates_from_local('No/Zone')
+            assert False
+        except Exception: pass
+        assert len(before)==len(df) and s['1970':'2100'].equals(before)
+        assert not s.conn.execute("select count(*) from sqlite_master where name='stock_migrate'").fetchone()[0]
+        s.dates_from_local('Etc/GMT-5')
+        assert s['1970':'2100'].equals(df)
+        s.close()
+    finally: shutil.rmtree(d)
+
+def bench(n=200000,reads=20):
+    d=tempfile.mkdtemp()
+    try:
+        s=CandleStorage2(name=os.path.join(d,'test.db'),cache_size=0)
+        s.bulk_load(candles('2010-01-01',n,'1min'))
+        a,b=s.conn.execute("select min(date),max(date)+1 from stock").fetchone()
+        t=time.time(); reference(s,a,b); t_ref=time.time()-t
+        t=time.time(); s['2009':'2011']; t_new=time.time()-t
+        print "read %d rows: read_sql %.3fs, numpy %.3fs (%.1fx)"%(n,t_ref,t_new,t_ref/t_new)
+        s.cache=RangeCache(2**28)
+        s['2009':'2011']
+        t=time.time()
+        for i in range(reads): s['2010-01-%02d'%(i+2)]
+        print "%d cached day reads %.3fs"%(reads,time.time()-t)
+    finally: shutil.rmtree(d)
+
+if __name__ == '__main__':
+    test_matches_read_sql()
+    test_cache()
+    test_budget()
+    test_dates_from_local()
+    bench()
+    print "ok"
@@ -0,0 +1,44 @@
+'''
+Resampling from the columnar tick store must equal parsing the archives.
+'''
+import os,sys,tempfile,filecmp,shutil,io
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..','scripts'),os.path.join(here,'..','..')]
+import numpy as np
+import hddl
+from hddl_utils.tickstore import TickStore
+from histdata_server import HistdataServer,make_ticks
+
+def test_roundtrip():
+    tmp=tempfile.mkdtemp()
+    store=TickStore(tmp)
+    df=hddl.read_ticks(io.BytesIO(make_ticks('EURUSD',2017,2,1000)))
+    store.write('EURUSD',2017,2,df)
+    cols=store.read('EURUSD',2017,2)
+    assert isinstance(cols['date'],np.memmap)
+    assert (cols['date']==df.index.values.view(np.int64)).all()
+    assert (cols['ask']==df.ask.values).all() and (cols['bid']==df.bid.values).all()
+    assert store.read('EURUSD',2017,3) is None
+    shutil.rmtree(tmp)
+
+def test_resample_from_store():
+    server=HistdataServer(ticks=5000).start()
+    tmp=tempfile.mkdtemp()
+    store=TickStore(os.path.join(tmp,'ticks'))
+    out=lambda name: os.path.join(tmp,name)
+    try:
+        hddl.download('EURUSD','2017-01','2017-03',out('a.csv'),'60s',update=False,host=server.url,tickstore=store)
+        assert server.requests==2
+        hddl.download('EURUSD','2017-01','2017-03',out('b.csv'),'5s',update=False,host=server.url,tickstore=store,workers=2)
+        hddl.download('EURUSD','2017-01','2017-03',out('c.csv'),'5s',update=False,host=server.url,tickstore=store,chunksize=777)
+        assert server.requests==2
+        hddl.download('EURUSD','2017-01','2017-03',out('d.csv'),'5s',update=False,host=server.url)
+        assert filecmp.cmp(out('b.csv'),out('d.csv'),shallow=False)
+        assert filecmp.cmp(out('c.csv'),out('d.csv'),shallow=False)
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    test_roundtrip()
+    test_resample_from_store()
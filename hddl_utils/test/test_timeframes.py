@@ -0,0 +1,26 @@
+'''
+Several durations from one download must equal separate downloads.
+'''
+import os,sys,tempfile,filecmp,shutil
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]=[os.path.join(here,'..','..','scripts'),os.path.join(here,'..','..')]
+import hddl
+from histdata_server import HistdataServer
+
+def test_multi_timeframe():
+    server=HistdataServer(ticks=5000).start()
+    tmp=tempfile.mkdtemp()
+    freqs=['1s','5s','7s','60s','1h']
+    multi=[os.path.join(tmp,'multi_%s.csv'%f) for f in freqs]
+    try:
+        hddl.download('EURUSD','2017-01','2017-03',multi,freqs,update=False,host=server.url,chunksize=1000)
+        for f,m in zip(freqs,multi):
+            single=os.path.join(tmp,'single_%s.csv'%f)
+            hddl.download('EURUSD','2017-01','2017-03',single,f,update=False,host=server.url)
+            assert filecmp.cmp(single,m,shallow=False),f
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    test_multi_timeframe()
@@ -0,0 +1,124 @@
+import os,json,shutil
+import numpy as np
+
+class TickStore(object):
+    '''
+    Columnar on-disk store of raw ticks with one partition per pair and month.
+    A partition is a directory with one file of fixed dtype per column, which
+    are read back through numpy.memmap without copying:
+
+        PATH/EURUSD/201702/date.i8  int64 UTC ns since epoch
+                           ask.f8
+                           bid.f8
+                           vol.f4
+                           meta.json
+
+    meta.json is written last when a partition is complete; partitions are
+    written to a temporary directory and renamed, so readers never see a
+    partial month.
+    '''
+    columns=(('date','<i8'),('ask','<f8'),('bid','<f8'),('vol','<f4'))
+    def __init__(self,path):
+        '''
+        :param str path: root directory of the store
+        '''
+        self.path=path
+        if not os.path.isdir(path): os.makedirs(path)
+
+    def _dir(self,pair,year,month):
+        return os.path.join(self.path,pair.upper(),"%d%02d"%(year,month))
+
+    def __contains__(self,key):
+        return os.path.exists(os.path.join(self._dir(*key),'meta.json'))
+
+    def read(self,pair,year,month):
+        '''
+        Memory map a partition.
+        @return:    dict of numpy.memmap by column name or None if missing
+        '''
+        if (pair,year,month) not in self: return None
+        return read_columns(self._dir(pair,year,month))
+
+    def writer(self,pair,year,month):
+        '''
+        Return a TickWriter, which appends ticks to a new partition
+        '''
+        return TickWriter(self,pair,year,month)
+
+    def write(self,pair,year,month,df):
+        '''
+        Save the ticks of a month
+        :param pd.DataFrame df: ticks with columns ask, bid, vol indexed by date
+        '''
+        w=self.writer(pair,year,month)
+        w.append(df)
+        w.close()
+
+    def remove(self,pair,year,month):
+        shutil.rmtree(self._dir(pair,year,month),ignore_errors=True)
+
+class ColumnWriter(object):
+    '''
+    Appends arrays to the column files of a new partition directory
+    "name.dtype" (eg. date.i8) with meta.json. The partition is written
+    to a temporary directory and replaces dir when close is called.
+    '''
+    def __init__(self,dir,columns,**meta):
+        '''
+        :param str dir:     the partition directory
+        :param columns:     sequence of (name,dtype)
+        :param meta:        further entries of meta.json
+        '''
+        self.dir=dir
+        self.columns=columns
+        self.meta=meta
+        self.tmp="%s.%d.tmp"%(self.dir,os.getpid())
+        shutil.rmtree(self.tmp,ignore_errors=True)
+        os.makedirs(self.tmp)
+        self.files=[open(os.path.join(self.tmp,"%s.%s"%(name,dtype[1:])),'wb') for name,dtype in columns]
+        self.rows=0
+
+    def append(self,cols):
+        '''
+        :param cols: one array per column, of equal length
+        '''
+        for f,col,(_,dtype) in zip(self.files,cols,self.columns):
+            np.asarray(col,dtype=dtype).tofile(f)
+        self.rows+=len(cols[0])
+
+    def close(self):
+        for f in self.files: f.close()
+        with open(os.path.join(self.tmp,'meta.json'),'w') as f:
+            json.dump(dict(self.meta,rows=self.rows,columns=dict(self.columns)),f)
+        shutil.rmtree(self.dir,ignore_errors=True)
+        os.rename(self.tmp,self.dir)
+
+    def abort(self):
+        for f in self.files: f.close()
+        shutil.rmtree(self.tmp,ignore_errors=True)
+
+def read_columns(dir):
+    '''
+    Memory map a partition written by ColumnWriter.
+    @return:    dict of numpy.memmap by column name
+    '''
+    with open(os.path.join(dir,'meta.json')) as f: meta=json.load(f)
+    ret={}
+    for name,dtype in meta['columns'].items():
+        if not meta['rows']: ret[name]=np.empty(0,dtype); continue
+        ret[name]=np.memmap(os.path.join(dir,"%s.%s"%(name,dtype[1:])),dtype=dtype,mode='r',shape=(meta['rows'],))
+    return ret
+
+class TickWriter(ColumnWriter):
+    '''
+    Appends chunks of ticks to the column files of one partition. The
+    partition becomes visible when close is called.
+    '''
+    def __init__(self,store,pair,year,month):
+        ColumnWriter.__init__(self,store._dir(pair,year,month),store.columns)
+
+    def append(self,df):
+        '''
+        :param pd.DataFrame df: ticks with columns ask, bid, vol indexed by date
+        '''
+        ColumnWriter.append(self,[df.index.values.view(np.int64),df.ask.values,df.bid.values,df.vol.values])
@@ -0,0 +1,53 @@
+'''
+Times are int64 nanoseconds (ticks, candles in memory) or seconds (sqlite)
+since the epoch in UTC. Datetimes only appear at the API boundary, where
+naive ones are taken as UTC. All conversions are vectorized fixed offset
+arithmetic, they neither depend on the local time zone nor on daylight
+saving time.
+'''
+import numpy as np,pandas as pd
+
+S=10**9
+DAY=24*3600*S
+#histdata stamps are EST without daylight saving
+EST_OFFSET=5*3600*S
+
+def to_ns(dates):
+    '''
+    :param dates: datetimes, strings, a pd.Series or pd.DatetimeIndex. Naive
+                  dates are UTC, aware ones are converted
+    @return: np.ndarray of int64 ns
+    '''
+    idx=pd.DatetimeIndex(dates)
+    if idx.tz is not None: idx=idx.tz_convert(None)
+    return idx.asi8
+
+def from_ns(ns):
+    '''
+    @return: np.ndarray of naive UTC datetime64[ns]
+    '''
+    return np.asarray(ns,dtype=np.int64).view('M8[ns]')
+
+def est_midnight(ts):
+    '''
+    The UTC ns of midnight EST before ts (UTC ns)
+    '''
+    return ts-(ts-EST_OFFSET)%DAY
+
+WEEK=7*DAY
+#the fx market closes from friday to sunday 17:00 EST, 1970-01-02 was a friday
+WEEKEND=DAY+17*3600*S+EST_OFFSET
+
+def closed_time(ts):
+    '''
+    ns the fx market was closed over weekends between the first weekend
+    since the epoch and ts (UTC ns)
+    '''
+    weeks,rest=(ts-WEEKEND)//WEEK,(ts-WEEKEND)%WEEK
+    return weeks*2*DAY+np.minimum(rest,2*DAY)
+
+def open_time(a,b):
+    '''
+    ns between a and b (UTC ns) the fx market was open
+    '''
+    return b-a-(closed_time(b)-closed_time(a))
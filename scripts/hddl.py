@@ -6,50 +6,110 @@ Created on 20.04.2017
 @author: simon
 '''
 import pandas as pd,numpy as np
-import zipfile,re,argparse,sys
+import zipfile,re,argparse,sys,os,tempfile,shutil,time,cProfile
 from requests import Session
+from requests.exceptions import ConnectionError,Timeout,ChunkedEncodingError
 from datetime import datetime as DT
 from io import BytesIO
+from Queue import Queue
+from collections import deque
+from threading import Thread,Semaphore
+from multiprocessing import Pool,cpu_count
+from multiprocessing.pool import ThreadPool
 from hddl_utils.candles import CandleStorage2 
+from hddl_utils.cache import ArchiveCache
+from hddl_utils.aggregate import multi_ohlc,fill,lcm
+from hddl_utils.tickstore import TickStore,ColumnWriter
+from hddl_utils.manifest import Manifest
+from hddl_utils.journal import Journal,FETCHED,PARSED,COMMITTED
+from hddl_utils.timestamps import EST_OFFSET,S,from_ns,est_midnight,to_ns,open_time
+from hddl_utils.session import PooledSession,retry
+from hddl_utils import stats
+from hddl_utils.ingest import Ingest,ReplaySource,SocketSource
 
 
-URL_TEMPLATE='http://www.histdata.com/download-free-forex-historical-data/?/ascii/tick-data-quotes/{pair}/{year}/{month}'
-DOWNLOAD_URL="http://www.histdata.com/get.php"
+HOST='http://www.histdata.com'
+URL_TEMPLATE='{host}/download-free-forex-historical-data/?/ascii/tick-data-quotes/{pair}/{year}/{month}'
+DOWNLOAD_URL="{host}/get.php"
 DOWNLOAD_METHOD='POST'
+#errors of a fetch worth fetching the month again
+TRANSIENT=(ConnectionError,Timeout,ChunkedEncodingError,zipfile.BadZipfile)
 def parse_date(s): return DT.strptime(s+'000',"%Y%m%d %H%M%S%f")
 
+STAMP_FIELDS=((0,4),(4,6),(6,8),(9,11),(11,13),(13,15),(15,18))
+def parse_dates(stamps):
+    '''
+    Vectorized version of parse_date. Slices the digits of the fixed width
+    histdata stamps "YYYYMMDD HHMMSSfff" (EST) out of one byte buffer.
+    :param np.ndarray stamps:   array of stamp strings
+    @return:    int64 array of UTC nanoseconds since epoch
+    '''
+    b=np.asarray(stamps,dtype='S18').view(np.uint8).reshape(-1,18).astype(np.int64)-ord('0')
+    digits=np.delete(b,8,1)
+    if ((digits<0)|(digits>9)).any() or (b[:,8]!=ord(' ')-ord('0')).any(): 
+        raise ValueError("malformed timestamp")
+    y,m,d,H,M,S,ms=[b[:,i:j].dot(10**np.arange(j-i-1,-1,-1)) for i,j in STAMP_FIELDS]
+    #days since epoch of the proleptic gregorian calendar (H. Hinnant, days_from_civil)
+    y=y-(m<=2)
+    era=y//400
+    yoe=y-era*400
+    doy=(153*((m+9)%12)+2)//5+d-1
+    days=era*146097+yoe*365+yoe//4-yoe//100+doy-719468
+    return ((((days*24+H)*60+M)*60+S)*1000+ms)*10**6+EST_OFFSET
+
 
 class Downloader:
-    def __init__(self,pair,year,month,freq='5s',verbose=1):
+    def __init__(self,pair,year,month,freq='5s',verbose=1,host=HOST,cache=None,chunksize=None,tickstore=None,session=None,journal=None):
         """
         The forexdownloader Object is capable of downloading tick data of one Month 
         and to convert it to the desired frequency.
         :param str pair:    the currency pair to download eg. EURUSD, USDNZD, ...
         :param year (int):    the year of interest
         :param month (int):   the month of interesr (1-12)
-        :param freq (int):    frequency of candledata in seconds
+        :param freq (int):    frequency of candledata in seconds, or a list of
+                              them to get a list of DataFrames
+        :param str host:      base url of histdata.com or a stand-in server
+        :param ArchiveCache cache: raw archives are read from and saved to this cache
+        :param int chunksize: if set, spool the archive to a temporary file and
+                              parse it in chunks of chunksize ticks, so memory
+                              does not grow with the size of the month
+        :param TickStore tickstore: ticks are read from this columnar store if
+                              present, else the parsed ticks are saved there
+        :param Session session: requests.Session to download with, eg. a
+                              PooledSession shared by several Downloaders
+        :param Journal journal: the month is marked as fetched in journal and
+                              its archive is spooled there until committed.
+                              A spooled archive is used instead of downloading
         
         :method download:   starts the download and returns a pandas.DataFrame
                             with columns (open, close, high low) indexed by date. 
         
         """
         
-        self.url=URL_TEMPLATE.format(pair=pair,year=year,month=month)
-        s=self.session=Session()
+        self.url=URL_TEMPLATE.format(host=host,pair=pair,year=year,month=month)
+        self.download_url=DOWNLOAD_URL.format(host=host)
+        self.session=session or Session()
         self.year,self.month,self.pair=year,month,pair
         self.freq=freq
         self.verbose=verbose
+        self.cache=cache
+        self.cached=False
+        self.chunksize=chunksize
+        self.tickstore=tickstore
+        self.journal=journal
     def _prepare(self):
         
         r=self.session.get(self.url)
+        r.raise_for_status()
         m=re.search('id="tk" value="(.*?)"',r.text)
         tk=m.groups()[0]
         self.tk=tk
     def _download_raw(self):
         headers={'Referer':self.url}
         data={'tk':self.tk,'date':self.year,'datemonth':"%d%02d"%(self.year,self.month),'platform':'ASCII','timeframe':'T','fxpair':self.pair}
-        r=self.session.request(DOWNLOAD_METHOD,DOWNLOAD_URL,data=data,headers=headers,stream=True)
-        bio=BytesIO()
+        r=self.session.request(DOWNLOAD_METHOD,self.download_url,data=data,headers=headers,stream=True)
+        r.raise_for_status()
+        bio=tempfile.TemporaryFile() if self.chunksize else BytesIO()
         size=0
         for chunk in r.iter_content(chunk_size=2**19):
             bio.write(chunk)
@@ -58,28 +118,78 @@ class Downloader:
         
         if self.verbose : print ""
         self.size=size
-        zf=zipfile.ZipFile(bio)#BytesIO(r.content) )
+        self.raw=bio
+    
+    def _open(self,f):
+        self.raw=f
+        zf=zipfile.ZipFile(f)#BytesIO(r.content) )
         self.file=zf.open(zf.namelist()[0])
+    
+    def _load(self):
+        '''
+        Load the raw archive from the cache or the journal if available, else
+        download it. Only complete months are put into the cache.
+        '''
+        key=(self.pair,self.year,self.month)
+        f=self.cache.open(*key) if self.cache else None
+        if f is None and self.journal is not None: f=self.journal.open(*key)
+        self.cached=f is not None
+        if self.cached:
+            if self.journal is not None and self.journal.state(*key) not in (FETCHED,PARSED): self.journal.set(*key+(FETCHED,))
+            f.seek(0,2)
+            self.size=f.tell()
+            f.seek(0)
+            if not self.chunksize:
+                raw=f.read()
+                f.close()
+                f=BytesIO(raw)
+            return self._open(f)
+        self._prepare()
+        self._download_raw()
+        now=DT.utcnow()
+        cache=self.cache and (self.year,self.month)<(now.year,now.month)
+        if cache: self.cache.put(self.pair,self.year,self.month,self.raw)
+        if self.journal is not None: self.journal.set(*key+(FETCHED,None if cache else self.raw))
+        self._open(self.raw)
         
     def _parse_data(self,freq='5s'):
-        df=pd.read_csv(self.file,header=None,names='ask bid vol'.split(),parse_dates=True,date_parser=parse_date)
-        df['p']=(df.ask+df.bid)/2
-        grp=df['p'].groupby(pd.TimeGrouper(freq))
-        first=grp.first()
-        data=pd.DataFrame(columns='open close high low'.split(),index=first.index)
-        #data.open=grp.first() # better to use last close price
-        data.close=grp.last()
-        data.open=data.close.shift(1)
-        data.high=grp.max()
-        data.low=grp.min()
-
-        data=data.fillna(method='pad')
-        data.high=data.max(axis=1)
-        data.low=data.min(axis=1)
-        data.index=data.index.tz_localize('EST').tz_convert(None)
-        self.data=data
-        
-        return data
+        self.data=parse_ticks(self.file,freq)
+        return self.data
+    
+    def fetch(self,f=None):
+        '''
+        Fetch the zipped tickdata of the month without parsing it.
+        :param file f:  if given, the archive is copied into this file
+        @return:    the raw zip archive as string if f is None
+        '''
+        self._load()
+        self.raw.seek(0)
+        if f is None: return self.raw.read()
+        shutil.copyfileobj(self.raw,f,2**20)
+    
+    def iter_download(self,freq=None,verbose=None):
+        '''
+        starts the download and yields the candles chunk by chunk if chunksize
+        is set, else as a single pandas.DataFrame
+        '''
+        freq=freq or self.freq
+        self.verbose=verbose or self.verbose
+        key=(self.pair,self.year,self.month)
+        writer=None
+        if self.tickstore is not None and key in self.tickstore:
+            if self.verbose: print "Reading ticks from store"
+            chunks=store_chunks(self.tickstore.read(*key),self.chunksize)
+        else:
+            self._load()
+            if self.verbose: print "%s %f MB"%("Cached" if self.cached else "Downloaded",1.*self.size/2**20)
+            if self.tickstore is not None: writer=self.tickstore.writer(*key)
+            chunks=tick_chunks(self.file,self.chunksize,writer)
+        try:
+            for data in aggregate(chunks,freq): yield data
+        except BaseException:
+            if writer is not None: writer.abort()
+            raise
+        if writer is not None: writer.close()
     
     def download(self,freq=None,verbose=None):
         """
@@ -87,14 +197,258 @@ class Downloader:
         @return:    a pandas.DataFrame with columns (open, close, high low) indexed
                     by date
         """
-        freq=freq or self.freq
-        self._prepare()
-        self.verbose=verbose or self.verbose
-        self._download_raw()
-        if self.verbose: print "Downloaded %f MB"%(1.*self.size/2**20)
-        self._parse_data(freq)
+        self.data=_concat(list(self.iter_download(freq,verbose)),freq or self.freq)
         return self.data
     
+
+def read_ticks(f,chunksize=None):
+    '''
+    Read histdata tick csv into a DataFrame with columns ask, bid, vol indexed
+    by date (UTC). If chunksize is set, return an iterator over chunks of
+    chunksize rows.
+    '''
+    data=pd.read_csv(f,header=None,names='ask bid vol'.split(),chunksize=chunksize)
+    if not chunksize: return _index_dates(data)
+    return (_index_dates(df) for df in data)
+
+def _index_dates(df):
+    df.index=pd.DatetimeIndex(from_ns(parse_dates(df.index.values)))
+    return df
+
+def _as_list(freq): return list(freq) if isinstance(freq,(list,tuple)) else [freq]
+
+def _steps(freqs): return [pd.to_timedelta(f).value for f in freqs]
+
+def _concat(chunks,freq):
+    '''
+    concat the chunks yielded by iter_candles
+    '''
+    if not isinstance(freq,(list,tuple)): return chunks[0] if len(chunks)==1 else pd.concat(chunks)
+    return [_concat([c[i] for c in chunks],None) for i in range(len(freq))]
+
+def _candles(ts,p,steps,origin,prevs,start=None,stop=None):
+    '''
+    candles of several durations and the last bar of each, see ticks_to_candles
+    '''
+    bars=multi_ohlc(ts,p,steps,origin)
+    ret=[]
+    for step,prev in zip(steps,prevs):
+        bins,o,c,h,l=fill(*bars[step],prev=prev,
+                          start=None if start is None else (start-origin)//step,
+                          stop=None if stop is None else (stop-origin)//step)
+        index=pd.DatetimeIndex(from_ns(origin+bins*step))
+        ret.append(pd.DataFrame({'open':o,'close':c,'high':h,'low':l},index=index,columns='open close high low'.split()))
+    return ret,[tuple(a[-1] for a in bars[step][1:]) for step in steps]
+
+def ticks_to_candles(df,freq='5s',origin=None):
+    '''
+    Convert ticks to candles of duration freq, see hddl_utils.aggregate.
+    Several durations are computed from one pass over the ticks, longer
+    candles are built from shorter ones.
+    :param pd.DataFrame df: ticks as returned by read_ticks
+    :param freq:    duration of candles or a list of durations
+    :param int origin:  candles are aligned to origin (UTC ns). Defaults to
+                        midnight (EST) of the first tick like pd.TimeGrouper
+    @return:    a pandas.DataFrame with columns (open, close, high low) indexed
+                by date, or a list of them if freq is a list
+    '''
+    freqs=_as_list(freq)
+    ts=df.index.values.view(np.int64)
+    if origin is None: origin=est_midnight(ts[0])
+    ret,_=_candles(ts,((df.ask+df.bid)/2).values,_steps(freqs),origin,[None]*len(freqs))
+    return ret if isinstance(freq,(list,tuple)) else ret[0]
+
+def parse_ticks(f,freq='5s'):
+    '''
+    Parse histdata tick csv and convert it to candles of duration freq.
+    :param file f:   file like object of the tick csv
+    :param freq:    duration of candles or a list of durations
+    @return:    a pandas.DataFrame with columns (open, close, high low) indexed
+                by date, or a list of them if freq is a list
+    '''
+    return ticks_to_candles(read_ticks(f),freq)
+
+def tick_chunks(f,chunksize=None,writer=None):
+    '''
+    Yield (date,price) arrays of the tick csv f in chunks of chunksize ticks,
+    or all at once. The ticks are also appended to writer (a TickWriter) if given.
+    '''
+    for df in (read_ticks(f,chunksize) if chunksize else [read_ticks(f)]):
+        if writer is not None: writer.append(df)
+        yield df.index.values.view(np.int64),((df.ask+df.bid)/2).values
+
+def store_chunks(cols,chunksize=None):
+    '''
+    Yield (date,price) arrays of a memory mapped TickStore partition in chunks
+    of chunksize ticks, or all at once.
+    '''
+    n=len(cols['date'])
+    chunksize=chunksize or max(n,1)
+    for i in range(0,n,chunksize):
+        j=i+chunksize
+        yield cols['date'][i:j],(cols['ask'][i:j]+cols['bid'][i:j])/2
+
+def aggregate(chunks,freq='5s'):
+    '''
+    Convert chunks of sorted (date,price) arrays into candles and yield the
+    candles of each chunk. The ticks of the last, possibly unfinished candle of
+    a chunk are carried over to the next one, so the result does not depend
+    on the chunking. With several durations the carry spans their least
+    common multiple. Memory is bounded by a chunk plus the ticks of one candle.
+    '''
+    freqs=_as_list(freq)
+    steps=_steps(freqs)
+    span=lcm(steps)
+    origin=carry=start=None
+    prevs=[None]*len(freqs)
+    def candles(ts,p,stop=None):
+        data,prevs[:]=_candles(ts,p,steps,origin,prevs,start,stop)
+        return data if isinstance(freq,(list,tuple)) else data[0]
+    for ts,p in chunks:
+        if carry is not None: ts,p=np.r_[carry[0],ts],np.r_[carry[1],p]
+        if origin is None: origin=est_midnight(ts[0])
+        last=ts[-1]-(ts[-1]-origin)%span
+        split=ts.searchsorted(last)
+        carry=ts[split:],p[split:]
+        if not split: continue
+        yield candles(ts[:split],p[:split],last)
+        start=last
+    if carry is not None: yield candles(*carry)
+
+def iter_candles(f,freq='5s',chunksize=2**18):
+    '''
+    Like parse_ticks, but reads chunks of chunksize ticks and yields the
+    candles of each chunk, see aggregate.
+    '''
+    return aggregate(tick_chunks(f,chunksize),freq)
+
+def parse_month(fetched,freq='5s',chunksize=None,tickstore=None):
+    '''
+    Convert a month returned by fetch_job into candles.
+    Module level, so it can run inside a process pool.
+    :param tuple fetched:   ((pair,year,month),raw). raw is the archive, or the
+                            path of a spooled archive if chunksize is set, which
+                            is removed afterwards. If raw is None the ticks are
+                            read from tickstore.
+    :param TickStore tickstore: parsed ticks are saved to this store
+    '''
+    key,raw=fetched
+    if raw is None: return _concat(list(aggregate(store_chunks(tickstore.read(*key),chunksize),freq)),freq)
+    writer=tickstore.writer(*key) if tickstore is not None else None
+    f=open(raw,'rb') if chunksize else BytesIO(raw)
+    try:
+        zf=zipfile.ZipFile(f)
+        data=_concat(list(aggregate(tick_chunks(zf.open(zf.namelist()[0]),chunksize,writer),freq)),freq)
+    except Exception:
+        if writer is not None: writer.abort()
+        raise
+    finally:
+        f.close()
+        if chunksize: os.remove(raw)
+    if writer is not None: writer.close()
+    return data
+
+def parse_zip(raw,freq='5s',chunksize=None):
+    '''
+    Parse a raw histdata zip archive as returned by fetch_month, see parse_month.
+    '''
+    return parse_month((None,raw),freq,chunksize)
+
+def fetch_month(pair,year,month,host=HOST,cache=None,chunksize=None,tickstore=None,session=None,journal=None):
+    '''
+    Fetch the archive of one month. If chunksize is set the archive is
+    spooled to a temporary file and its path is returned. Returns None if
+    the ticks of the month are in tickstore.
+    '''
+    if tickstore is not None and (pair,year,month) in tickstore: return None
+    d=Downloader(pair,year,month,verbose=0,host=host,cache=cache,chunksize=chunksize,session=session,journal=journal)
+    if not chunksize: return d.fetch()
+    f=tempfile.NamedTemporaryFile(suffix='.zip',delete=False)
+    with f: d.fetch(f)
+    return f.name
+
+def fetch_job(*job):
+    '''
+    fetch_month, returning ((pair,year,month),raw) as needed by parse_month
+    '''
+    return job[:3],fetch_month(*job)
+
+class _Measured(object):
+    '''
+    Stands in for the AsyncResult of a stats.measured_call, merging the
+    stats of the worker into st on get.
+    '''
+    def __init__(self,res,st): self.res,self.st=res,st
+    def get(self):
+        ret,summary=self.res.get()
+        self.st.merge(summary)
+        return ret
+
+class _Failed(object):
+    '''
+    Stands in for an AsyncResult whose predecessor stage raised.
+    '''
+    def __init__(self,exc_info): self.exc_info=exc_info
+    def get(self): raise self.exc_info[0],self.exc_info[1],self.exc_info[2]
+
+def pipeline(jobs,fetch,parse,args=(),fetchers=4,parsers=None,queue_size=4,return_errors=False):
+    '''
+    Runs the stages fetch -> parse -> consumer concurrently and yields
+    (job,result) in the order of jobs.
+    fetch(*job) runs in a thread pool, parse(raw,*args) in a process pool.
+    At most fetchers+queue_size jobs are fetched ahead of parsing and
+    queue_size parsed ones wait for the consumer, so about
+    fetchers+2*queue_size months are held in memory at once.
+    :param list jobs:   list of argument tuples for fetch
+    :param callable fetch:  network bound stage
+    :param callable parse:  cpu bound stage, must be picklable
+    :param int fetchers:    number of fetching threads
+    :param int parsers:     number of parsing processes. Defaults to cpu count
+    :param int queue_size:  max number of pending jobs between two stages
+    :param bool return_errors:  yield (job,exception) for failed jobs and go
+                            on instead of raising
+    '''
+    ppool=Pool(parsers)
+    fpool=ThreadPool(fetchers)
+    fetched=Queue()
+    parsed=Queue(queue_size)
+    ahead=Semaphore(fetchers+queue_size)
+    def feed():
+        for job in jobs:
+            ahead.acquire()
+            fetched.put((job,fpool.apply_async(fetch,job)))
+        fetched.put(None)
+    def dispatch():
+        while True:
+            item=fetched.get()
+            if item is None: break
+            job,res=item
+            st=stats.active()
+            try:
+                if st is None: res=ppool.apply_async(parse,(res.get(),)+tuple(args))
+                else: res=_Measured(ppool.apply_async(stats.measured_call,(parse,res.get())+tuple(args)),st)
+            except Exception: res=_Failed(sys.exc_info())
+            ahead.release()
+            parsed.put((job,res))
+        parsed.put(None)
+    for target in (feed,dispatch):
+        t=Thread(target=target)
+        t.daemon=True
+        t.start()
+    try:
+        while True:
+            item=parsed.get()
+            if item is None: break
+            job,res=item
+            try: res=res.get()
+            except Exception as e:
+                if not return_errors: raise
+                res=e
+            yield job,res
+    finally:
+        fpool.terminate()
+        ppool.terminate()
+    
     
 def add_month(date,n=1):
     '''
@@ -108,81 +462,728 @@ def add_month(date,n=1):
     m=(oldm+n-1)%12+1
     return pd.datetime(year=y,month=m,day=1)
 
-def download(pair,fro, to,dest,freq='5s',update=True):
+def month_key(date):
+    '''
+    "YYYY-MM" of the histdata (EST) month containing the UTC candle date
+    '''
+    return (pd.Timestamp(date)-pd.Timedelta(EST_OFFSET)).strftime('%Y-%m')
+
+def scan_csv(dest,blocksize=2**16):
+    '''
+    Read the first and last date of a candle csv from its head and tail
+    without parsing the rest of the file.
+    @return:    (first,last) as pd.Timestamp or None if there are no candles
+    '''
+    with open(dest,'rb') as f:
+        head=f.readline()
+        if head.startswith(','): head=f.readline()
+        if not head.strip(): return None
+        f.seek(0,2)
+        f.seek(max(0,f.tell()-blocksize))
+        tail=f.read().rstrip('\n').rsplit('\n',1)[-1]
+    return pd.Timestamp(head.split(',')[0]),pd.Timestamp(tail.split(',')[0])
+
+def _missing_months(dest,fro,to):
+    '''
+    Months between fro and to not yet contained in the candle file dest.
+    Uses the manifest of dest, else the months between the first and the last
+    date of dest. Bytes after the last month of the manifest stem from an
+    interrupted run and are cut off.
+    @return:    (months,manifest,file_exists)
+    '''
+    daterange=pd.date_range(fro, to, freq='M')
+    if not os.path.exists(dest): return daterange,Manifest(dest),False
+    manifest=Manifest.load(dest)
+    if manifest is None:
+        manifest=Manifest(dest)
+        span=scan_csv(dest)
+        if span is not None:
+            for p in pd.period_range(month_key(span[0]),month_key(span[1]),freq='M'): manifest.add(str(p))
+    elif manifest.end and os.path.getsize(dest)>manifest.end:
+        with open(dest,'r+b') as f: f.truncate(manifest.end)
+    return pd.DatetimeIndex([d for d in daterange if d.strftime('%Y-%m') not in manifest]),manifest,True
+
+class CsvOutput(object):
+    '''
+    Appends candles month by month to a csv file and records each month in
+    the manifest of the file. A month is staged in "<dest>.part" and only
+    appended to the file on commit, so the file never holds part of a month
+    beyond the end recorded in the manifest.
+    '''
+    def __init__(self,dest,fro,to,update=True):
+        '''
+        :param str dest:    the csv file
+        :param bool update: only months missing in dest are wanted, else dest
+                            is overwritten
+        '''
+        self.dest=dest
+        if update: months,self.manifest,exists=_missing_months(dest,fro,to)
+        else: months,self.manifest,exists=pd.date_range(fro, to, freq='M'),Manifest(dest),False
+        self.wanted=set(months)
+        self.header=not exists
+        self.f=open(dest,'a' if exists else 'w')
+        self.month=self.part=None
+        #left over by a crashed run
+        if os.path.exists(dest+'.part'): os.remove(dest+'.part')
+
+    def begin(self,key):
+        '''
+        start writing the month key ("YYYY-MM")
+        '''
+        self.f.seek(0,2)
+        self.part=open(self.dest+'.part','w+b')
+        self.month=dict(month=key,offset=self.f.tell(),rows=0,first=None,last=None)
+
+    def write(self,df):
+        if not len(df): return
+        df.to_csv(self.part,mode='a',header=self.header)
+        self.header=False
+        m=self.month
+        m['rows']+=len(df)
+        m['first']=m['first'] or str(df.index[0])
+        m['last']=str(df.index[-1])
+
+    def commit(self):
+        '''
+        append the current month to the file, sync it and save the manifest
+        '''
+        self.part.seek(0)
+        shutil.copyfileobj(self.part,self.f,2**20)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.manifest.add(end=self.f.tell(),**self.month)
+        self.manifest.save()
+        self._discard()
+        self.month=None
+
+    def _discard(self):
+        if self.part is None: return
+        self.part.close()
+        os.remove(self.dest+'.part')
+        self.part=None
+
+    def close(self):
+        self._discard()
+        self.f.close()
+
+    @classmethod
+    def read(cls,dest): return pd.read_csv(dest,index_col=0,parse_dates=True)
+
+class PartitionedOutput(object):
+    '''
+    Writes candles into a directory dest with one file "YYYY-MM.ext" per
+    month, written to a temporary file and renamed on commit. The months
+    present are found by listing the directory. Subclasses implement
+    _save(path,df) and _load(path).
+    '''
+    ext=None
+    def __init__(self,dest,fro,to,update=True):
+        '''
+        :param str dest:    the directory
+        :param bool update: only months missing in dest are wanted, else
+                            the months in dest are removed
+        '''
+        self.dest=dest
+        if not os.path.isdir(dest): os.makedirs(dest)
+        for name in os.listdir(dest):
+            #left over by a crashed run
+            if name.endswith('.tmp') or not update and name.endswith(self.ext): os.remove(os.path.join(dest,name))
+        have=set(self.months(dest))
+        self.wanted=set(d for d in pd.date_range(fro,to,freq='M') if d.strftime('%Y-%m') not in have)
+        self.key=None
+
+    @classmethod
+    def months(cls,dest):
+        '''
+        sorted "YYYY-MM" keys of the months in dest
+        '''
+        return sorted(n[:-len(cls.ext)] for n in os.listdir(dest) if n.endswith(cls.ext))
+
+    def begin(self,key):
+        self.key=key
+        self.chunks=[]
+
+    def write(self,df):
+        if len(df): self.chunks.append(df)
+
+    def commit(self):
+        path=os.path.join(self.dest,self.key+self.ext)
+        tmp=path+'.tmp'
+        df=pd.concat(self.chunks) if self.chunks else pd.DataFrame(columns='open close high low'.split(),index=pd.DatetimeIndex([]))
+        df.index.name='date'
+        self._save(tmp,df)
+        os.rename(tmp,path)
+        self.key=self.chunks=None
+
+    def close(self): pass
+
+    @classmethod
+    def read(cls,dest):
+        '''
+        all months in dest as one DataFrame
+        '''
+        dfs=[cls._load(os.path.join(dest,m+cls.ext)) for m in cls.months(dest)]
+        return pd.concat(dfs) if dfs else pd.DataFrame(columns='open close high low'.split())
+
+class NpzOutput(PartitionedOutput):
+    '''
+    uncompressed npz files of the columns date (int64 UTC ns), open, close,
+    high and low
+    '''
+    ext='.npz'
+    @staticmethod
+    def _save(path,df):
+        with open(path,'wb') as f:
+            np.savez(f,date=df.index.values.view(np.int64),**dict((c,df[c].values) for c in df.columns))
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _load(path):
+        with np.load(path) as z:
+            return pd.DataFrame(dict((c,z[c]) for c in 'open close high low'.split()),columns='open close high low'.split(),
+                                index=pd.DatetimeIndex(from_ns(z['date']),name='date'))
+
+class ParquetOutput(PartitionedOutput):
+    '''
+    parquet files, needs pyarrow or fastparquet
+    '''
+    ext='.parquet'
+    @staticmethod
+    def _save(path,df): df.to_parquet(path)
+    @staticmethod
+    def _load(path): return pd.read_parquet(path)
+
+class HdfOutput(object):
+    '''
+    Appends candles to the table "candles" of a HDF5 file, needs PyTables.
+    Each month is recorded in the manifest of the file. Rows beyond the
+    recorded months stem from an interrupted run and are removed.
+    '''
+    key='candles'
+    def __init__(self,dest,fro,to,update=True):
+        self.dest=dest
+        daterange=pd.date_range(fro,to,freq='M')
+        exists=update and os.path.exists(dest)
+        self.store=pd.HDFStore(dest,mode='a' if exists else 'w')
+        self.manifest=Manifest.load(dest) if exists else None
+        rows=self.store.get_storer(self.key).nrows if self.key in self.store else 0
+        if self.manifest is None:
+            self.manifest=Manifest(dest)
+            if rows:
+                first,last=[self.store.select(self.key,start=i,stop=i+1).index[0] for i in (0,rows-1)]
+                for p in pd.period_range(month_key(first),month_key(last),freq='M'): self.manifest.add(str(p))
+        elif rows>self.manifest.rows:
+            self.store.remove(self.key,start=self.manifest.rows)
+        self.wanted=set(d for d in daterange if d.strftime('%Y-%m') not in self.manifest)
+        self.month=None
+
+    def begin(self,key):
+        self.month=dict(month=key,rows=0,first=None,last=None)
+
+    def write(self,df):
+        if not len(df): return
+        self.store.append(self.key,df,format='table')
+        m=self.month
+        m['rows']+=len(df)
+        m['first']=m['first'] or str(df.index[0])
+        m['last']=str(df.index[-1])
+
+    def commit(self):
+        self.store.flush(fsync=True)
+        self.manifest.add(**self.month)
+        self.manifest.save()
+        self.month=None
+
+    def close(self): self.store.close()
+
+    @classmethod
+    def read(cls,dest): return pd.read_hdf(dest,cls.key)
+
+class SqliteOutput(object):
+    '''
+    Appends candles to the table "candles" of a sqlite database (see
+    CandleStorage2) in one transaction per month and keeps a gap index of
+    it. Each committed month is recorded in the table "candles_months" in
+    the same transaction. Updating fetches the months never recorded that
+    have no candles or holes of more than max_gap seconds, not counting the
+    weekend closure of the market, and the current month again. Recorded
+    months are not fetched again, so holiday closures or outages of the
+    source do not refetch a month on every update.
+    '''
+    table='candles'
+    max_gap=3600
+    def __init__(self,dest,fro,to,update=True):
+        self.storage=CandleStorage2(name=dest,tablename=self.table,cache_size=0)
+        self.months_table=self.table+'_months'
+        self.storage.pool.write(lambda conn: conn.execute("create table if not exists {mt} (month TEXT PRIMARY KEY)".format(mt=self.months_table)))
+        if not update:
+            self.storage.clear()
+            self.storage.pool.write(lambda conn: conn.execute("delete from {mt}".format(mt=self.months_table)))
+        elif self.storage.gap_step is None and self.storage.min_step(): self.storage.add_gap_index(self.storage.min_step())
+        self.wanted=set(self.incomplete(fro,to))
+        self.key=self.chunks=None
+
+    def fetched(self):
+        '''
+        "YYYY-MM" keys of the recorded months
+        '''
+        return set(r[0] for r in self.storage.conn.execute("select month from {mt}".format(mt=self.months_table)))
+
+    def incomplete(self,fro,to):
+        '''
+        month ends of the months between fro and to not recorded or still
+        open, and not recorded months without candles or with gaps
+        '''
+        months=pd.date_range(fro,to,freq='M')
+        if not len(months): return []
+        fetched,current=self.fetched(),month_key(DT.utcnow())
+        #bounds of the histdata (EST) months in UTC ns
+        bounds=pd.date_range(months[0].strftime('%Y-%m'),periods=len(months)+1,freq='MS').asi8+EST_OFFSET
+        holes=[]
+        if self.storage.gap_step:
+            holes=[(a.value,b.value) for a,b in self.storage.gaps(pd.Timestamp(bounds[0]),pd.Timestamp(bounds[-1]))]
+        sql="select 1 from {tn} where date>=? and date<? limit 1".format(tn=self.storage.tablename)
+        return [date for date,a,b in zip(months,bounds[:-1],bounds[1:])
+                if date.strftime('%Y-%m')>=current or date.strftime('%Y-%m') not in fetched and (
+                self.storage.conn.execute(sql,(a//S,b//S)).fetchone() is None or
+                any(open_time(max(a,x),min(b,y))>self.max_gap*S for x,y in holes if x<b and y>a))]
+
+    def begin(self,key):
+        self.key=key
+        self.chunks=[]
+
+    def write(self,df):
+        if len(df): self.chunks.append(df)
+
+    def commit(self):
+        df=pd.concat(self.chunks) if self.chunks else None
+        if df is not None and self.storage.gap_step is None and len(df)>1: self.storage.add_gap_index(int(np.diff(df.index.asi8).min()//S))
+        def commit(conn):
+            if df is not None: self.storage.append(df.rename_axis('date').reset_index())
+            conn.execute("insert or replace into {mt} values (?)".format(mt=self.months_table),(self.key,))
+        self.storage.pool.write(commit)
+        self.key=self.chunks=None
+
+    def close(self): self.storage.close()
+
+    @classmethod
+    def read(cls,dest):
+        s=CandleStorage2(name=dest,tablename=cls.table,cache_size=0)
+        try: return s['1970':'2100'].set_index('date')
+        finally: s.close()
+
+FORMATS=dict(csv=CsvOutput,npz=NpzOutput,parquet=ParquetOutput,hdf=HdfOutput,sqlite=SqliteOutput)
+EXTENSIONS={'.csv':'csv','.npz':'npz','.parquet':'parquet','.pq':'parquet','.h5':'hdf','.hdf5':'hdf','.hdf':'hdf',
+            '.db':'sqlite','.sqlite':'sqlite'}
+
+def output_format(dest,fmt=None):
+    '''
+    fmt, else the format of dest by its extension, defaulting to csv
+    '''
+    return fmt or EXTENSIONS.get(os.path.splitext(dest)[1].lower(),'csv')
+
+def read_output(dest,fmt=None):
+    '''
+    Read an output written by download as DataFrame with columns open,
+    close, high and low indexed by date
+    '''
+    return FORMATS[output_format(dest,fmt)].read(dest)
+
+def _targets(dests,fro,to,update,fmt=None):
+    '''
+    Outputs of dests (see FORMATS) and the months wanted by any of them
+    '''
+    targets=[FORMATS[output_format(d,fmt)](d,fro,to,update) for d in dests]
+    return targets,pd.DatetimeIndex(sorted(set().union(*[t.wanted for t in targets])))
+
+def _write_month(targets,date,chunks):
+    '''
+    write the candle chunks of the month ending on date to the targets wanting it
+    '''
+    key=date.strftime('%Y-%m')
+    active=[(i,t) for i,t in enumerate(targets) if date in t.wanted]
+    for _,t in active: t.begin(key)
+    for dfs in chunks:
+        for i,t in active: t.write(dfs[i])
+    for _,t in active: t.commit()
+
+def _journal(dests,journal):
+    '''
+    the Journal "<first dest>.journal" if journal is set, else None
+    '''
+    if not journal: return None
+    j=Journal(dests[0]+'.journal')
+    if j.unfinished(): print "%s: resuming %d fetched months"%(j.path,len(j.unfinished()))
+    return j
+
+def download(pair,fro, to,dest,freq='5s',update=True,workers=0,parsers=None,host=HOST,cache=None,chunksize=None,tickstore=None,session=None,
+             journal=False,fmt=None):
     """
     download tickdata of "pair" from "fro" until "to" and save as file "dest"
     :param str fro:   a datetime string like YYYY-MM 
     @param to (str):    a datetime string like YYYY-MM 
-    @param dest (str):  path to destination file
-    @param freq (int):  duration of candles
+    @param dest (str):  path to destination file, or a list of paths, one for
+                        each duration in freq
+    @param freq (int):  duration of candles or a list of durations. All durations
+                        are computed from a single pass over the ticks
+    @param update (bool):   only fetch months missing in dest, see CsvOutput
+    @param fmt (str):   output format, one of FORMATS, defaults to the format
+                        of the extension of dest (csv if unknown)
+    @param workers (int):   if >0 fetch with this many threads and parse in a
+                            process pool while writing, see pipeline
+    @param parsers (int):   number of parsing processes, defaults to cpu count
+    @param host (str):  base url of histdata.com
+    @param cache (ArchiveCache):    read and save raw archives from/to this cache
+    @param chunksize (int): spool archives to disk and parse chunksize ticks at once
+    @param tickstore (TickStore):   read ticks from this columnar store, save
+                                    downloaded ticks there
+    @param session (Session):   requests.Session used for all months, defaults
+                                to a PooledSession
+    @param journal (bool):  record the state of every month in the Journal
+                            "<dest>.journal" (first dest if several). Fetched
+                            archives are kept there until their month is
+                            written, so a restart does not download them again.
+                            Off by default, the cli turns it on
     
     """
     fro=pd.to_datetime(fro)
     to=pd.to_datetime(to)
+    freqs,dests=_as_list(freq),_as_list(dest)
+    if len(freqs)!=len(dests): raise ValueError("need one destination per duration")
     
     #data is available monthly
     #so iter over all month from to
-    n_years=to.year-fro.year
-    n_months=to.month-fro.month
-    if n_months<0:
-        n_months=n_months%12+1
-        n_years-=1
-    n_months=n_years*12+n_months    
-    
-    
-    year=fro.year
-    month=fro.month
-    daterange=pd.date_range(fro, to, freq='M')
-    data=None
-    save_header=True
-    file_exists=False
-    if update:
-        try:
-            f=open(dest)
-            data=pd.read_csv(dest,memory_map=True,index_col=[0],header=None,names="open close high low".split(),
-                     parse_dates=True,
-                     skiprows=10,
-                     infer_datetime_format=True,
-                     #nrows=1000000
-                    )
-            data.index=data.index.tz_localize('UTC').tz_convert('EST').tz_localize(None)
-            
-            r1=pd.date_range(fro, data.index[0] , freq='M')
-            r2=pd.date_range(add_month(data.index[-1]),to,freq='M')
-            daterange=r1.append(r2)
-            file_exists=True
-            save_header=False
-        except IOError: pass
+    targets,daterange=_targets(dests,fro,to,update,fmt)
+    session=session or PooledSession(max(workers,1))
+    journal=_journal(dests,journal)
     
     print "downloading range:",daterange
-    f=open(dest,'a' if file_exists else 'w')
-    for date in daterange: 
-        year=date.year 
-        month=date.month
-        df=Downloader(pair, year, month,verbose=1,freq=freq).download()
-        #data=df if data is None else data.append(df)
-        print "processing %d-%02d"%(year,month)
-        df.to_csv(f,mode='a',header=save_header)
-        save_header=False
-    f.close()
-
-#from hddl.candles import CandleStorage2
-def convert_csv_sqlite(i,o,name,chunksize=4096):
-    import sqlite3
-    con=sqlite3.connect(o)
-    data=pd.read_csv(i,memory_map=True,index_col=[0],header=None,names="open close high low".split(),
-                         parse_dates=True,
-                         skiprows=10,
-                         infer_datetime_format=True,
-                         #nrows=1000000,
-                         chunksize=chunksize
-                        )
-    cs=CandleStorage2(name=data.db,tablename=name)
-    for df in data:
-        cs.append(df)
-        #df.to_sql(name,con,if_exists='append')
+    jobs=[(pair,date.year,date.month,host,cache,chunksize,tickstore,session,journal) for date in daterange]
+    if workers:
+        months=((job,[df]) for job,df in pipeline(jobs,fetch_job,parse_month,(freqs,chunksize,tickstore),fetchers=workers,parsers=parsers))
+    else:
+        months=((job,Downloader(*job[:3],verbose=1,freq=freqs,host=host,cache=cache,chunksize=chunksize,tickstore=tickstore,
+                                session=session,journal=journal).iter_download()) for job in jobs)
+    try:
+        for date,((_,year,month),chunks) in zip(daterange,((job[:3],chunks) for job,chunks in months)): 
+            #data=df if data is None else data.append(df)
+            print "processing %d-%02d"%(year,month)
+            if workers and journal: journal.set(pair,year,month,PARSED)
+            _write_month(targets,date,chunks)
+            if journal: journal.set(pair,year,month,COMMITTED)
+    finally:
+        for t in targets: t.close()
+        if journal: journal.close()
+
+def interleave(queues):
+    '''
+    Take one item of each queue in turn until all are empty, so every queue
+    makes progress at the same pace.
+    '''
+    queues=[iter(q) for q in queues]
+    while queues:
+        for q in list(queues):
+            try: yield next(q)
+            except StopIteration: queues.remove(q)
+
+def download_batch(pairs,fro,to,dest,freq='5s',update=True,workers=4,parsers=None,host=HOST,cache=None,chunksize=None,tickstore=None,
+                   session=None,rate=None,retries=3,backoff=1.,journal=False,fmt=None):
+    """
+    download several pairs at once, see download. The months of all pairs
+    are fetched by one pool of workers threads sharing one PooledSession and
+    are scheduled round robin over the pairs. Each pair is written to its
+    own files in order of months. A month failing after all retries stops
+    its pair, the other pairs go on.
+    @param pairs (list):    the currency pairs
+    @param dest (dict):     maps each pair to its destination file, or a list
+                            of them, one for each duration in freq
+    @param workers (int):   number of concurrent fetches
+    @param session (Session):   requests.Session used for all fetches, defaults
+                                to a PooledSession(workers,rate,retries=retries,backoff=backoff)
+    @param rate (float):    max requests per second of all workers
+    @param retries (int):   how often a failed request or fetch is retried
+    @param backoff (float): seconds before the first retry, doubled for each further one
+    @param journal (bool):  keep a Journal for each pair, see download
+    @return:    dict mapping the pairs that failed to their exception
+    """
+    fro=pd.to_datetime(fro)
+    to=pd.to_datetime(to)
+    freqs=_as_list(freq)
+    session=session or PooledSession(workers,rate,retries=retries,backoff=backoff)
+    targets,journals,dates,queues={},{},{},[]
+    try:
+        for pair in pairs:
+            dests=_as_list(dest[pair])
+            if len(freqs)!=len(dests): raise ValueError("need one destination per duration")
+            targets[pair],daterange=_targets(dests,fro,to,update,fmt)
+            journals[pair]=_journal(dests,journal)
+            for date in daterange: dates[pair,date.year,date.month]=date
+            queues.append([(pair,date.year,date.month,host,cache,chunksize,tickstore,session,journals[pair]) for date in daterange])
+        print "downloading %d months of %d pairs"%(len(dates),len(pairs))
+        failed={}
+        fetch=retry(fetch_job,retries,backoff,TRANSIENT)
+        for job,df in pipeline(interleave(queues),fetch,parse_month,(freqs,chunksize,tickstore),
+                               fetchers=workers,parsers=parsers,return_errors=True):
+            pair,year,month=job[:3]
+            if pair in failed: continue
+            if isinstance(df,Exception):
+                print "failed %s %d-%02d: %r"%(pair,year,month,df)
+                failed[pair]=df
+                continue
+            print "processing %s %d-%02d"%(pair,year,month)
+            j=journals[pair]
+            if j: j.set(pair,year,month,PARSED)
+            _write_month(targets[pair],dates[pair,year,month],[df])
+            if j: j.set(pair,year,month,COMMITTED)
+    finally:
+        for ts in targets.values():
+            for t in ts: t.close()
+        for j in journals.values():
+            if j: j.close()
+    return failed
+
+def read_pairs(arg):
+    '''
+    The pairs of the pair argument: separated by commas, or "@FILE" to read
+    them from FILE, separated by white space or commas, "#" starts a comment.
+    '''
+    if arg.startswith('@'):
+        with open(arg[1:]) as f: arg=' '.join(l.split('#')[0] for l in f)
+    return [p for p in re.split(r'[\s,]+',arg) if p]
+
+def output_names(pair,output,durations,batch=False,ext='.csv'):
+    '''
+    Output files of pair, see the help of --output
+    '''
+    if not output: return ["%s_%d%s"%(pair,d,ext) for d in durations]
+    if '{pair}' in output: output=output.format(pair=pair)
+    elif batch: output=os.path.join(os.path.dirname(output),"%s_%s"%(pair,os.path.basename(output)))
+    if len(durations)==1: return [output]
+    base,ext=os.path.splitext(output)
+    return ["%s_%d%s"%(base,d,ext) for d in durations]
+
+CANDLE_COLUMNS=(('date','<i8'),('open','<f8'),('close','<f8'),('high','<f8'),('low','<f8'))
+
+def imap_bounded(pool,fn,items,window):
+    '''
+    Like pool.imap(fn,items), but at most window items are submitted ahead of
+    the consumer, so a slow consumer does not pile up the results.
+    '''
+    pending=deque()
+    for item in items:
+        if len(pending)>=window: yield pending.popleft().get()
+        pending.append(pool.apply_async(fn,(item,)))
+    while pending: yield pending.popleft().get()
+
+def csv_ranges(path,blocksize=2**24):
+    '''
+    Split a candle csv into byte ranges of about blocksize bytes, each
+    ending at the end of a line. A header line is left out.
+    @return:    list of (start,end)
+    '''
+    size=os.path.getsize(path)
+    ranges=[]
+    with open(path,'rb') as f:
+        head=f.readline()
+        start=0 if head[:1].isdigit() else f.tell()
+        while start<size:
+            f.seek(start+blocksize)
+            f.readline()
+            end=min(f.tell(),size)
+            ranges.append((start,end))
+            start=end
+    return ranges
+
+def parse_csv_range(job):
+    '''
+    Parse the lines of a candle csv in a byte range, see csv_ranges.
+    Module level, so it can run inside a process pool.
+    :param tuple job:   (path,(start,end))
+    @return:    (dates as int64 UTC ns,[open,close,high,low])
+    '''
+    path,(start,end)=job
+    with open(path,'rb') as f:
+        f.seek(start)
+        raw=f.read(end-start)
+    df=pd.read_csv(BytesIO(raw),header=None,names=CandleStorage2.cols)
+    return to_ns(df.date.values),[df[c].values for c in CandleStorage2.cols[1:]]
+
+def table_name(name):
+    '''
+    a valid sqlite table name for name, eg. of a file
+    '''
+    name=re.sub(r'\W','_',name)
+    return name if re.match('[A-Za-z_]',name) else 't_'+name
+
+def convert(inputs,output,names=None,columnar=False,processes=None,blocksize=2**24,verbose=1):
+    '''
+    Convert candle csv files as written by download into tables of the
+    sqlite database output (see CandleStorage2), or, if columnar is set,
+    into directories "output/table" of column files (see ColumnWriter).
+    Every file is split into byte ranges of blocksize bytes, which are parsed
+    by a process pool while a single writer bulk loads them in order. At
+    most 2*processes ranges are parsed ahead of the writer.
+    :param list inputs: csv files
+    :param list names:  table of each input, inputs with the same name are
+                        merged into one table in the given order. Defaults to
+                        the base names of the inputs
+    :param int processes:   number of parsing processes, defaults to cpu count
+    @return:    dict mapping the tables to their number of rows
+    '''
+    names=[table_name(n) for n in names or [os.path.splitext(os.path.basename(i))[0] for i in inputs]]
+    if len(names)!=len(inputs): raise ValueError("need one name per input")
+    tables=[]
+    for name,path in zip(names,inputs):
+        if name not in tables: tables.append(name)
+    jobs=[(name,(path,r)) for t in tables for name,path in zip(names,inputs) if name==t for r in csv_ranges(path,blocksize)]
+    pool=Pool(processes)
+    parsed=imap_bounded(pool,parse_csv_range,[job for _,job in jobs],2*(processes or cpu_count()))
+    rows=dict((t,0) for t in tables)
+    t0=time.time()
+    def frames(table,n):
+        for _ in range(n):
+            date,cols=next(parsed)
+            rows[table]+=len(date)
+            if verbose:
+                total=sum(rows.values())
+                sys.stdout.write("\r%s: %d rows, %d rows/s "%(table,total,total/max(time.time()-t0,1e-6)))
+                sys.stdout.flush()
+            yield date,cols
+    try:
+        for table in tables:
+            n=sum(1 for name,_ in jobs if name==table)
+            if columnar:
+                w=ColumnWriter(os.path.join(output,table),CANDLE_COLUMNS)
+                try:
+                    for date,cols in frames(table,n): w.append([date]+cols)
+                except BaseException:
+                    w.abort()
+                    raise
+                w.close()
+            else:
+                cs=CandleStorage2(name=output,tablename=table,cache_size=0)
+                try: cs.bulk_load(pd.DataFrame(dict(zip(CandleStorage2.cols,[date//S]+cols)),columns=CandleStorage2.cols) 
+                                  for date,cols in frames(table,n))
+                finally: cs.close()
+    finally:
+        pool.terminate()
+    if verbose: print ""
+    return rows
+
+def convert_csv_sqlite(i,o,name,**kw):
+    '''
+    Convert the candle csv i into the table name of the sqlite database o, see convert
+    '''
+    return convert([i],o,[name],**kw)[table_name(name)]
+
+def _add_instrumentation(parser):
+    parser.add_argument('--stats',type=str,default=None,metavar='FILE',
+                        help='Measure time, bytes, rows and peak memory of every stage, print them at the end and save them as JSON to FILE.')
+    parser.add_argument('--profile',type=str,default=None,metavar='FILE',
+                        help='Run under cProfile and save the profile of the main thread to FILE.')
+
+def convert_main(argv):
+    parser=argparse.ArgumentParser(prog='hddl.py convert',description="""
+    Convert candle csv files written by hddl.py into tables of a sqlite
+    database (readable with hddl_utils.candles.CandleStorage2) or into a
+    directory of column files (date.i8 int64 UTC ns, open.f8, ...).
+    """)
+    parser.add_argument('inputs',nargs='+',help='candle csv files')
+    parser.add_argument('-o','--output',required=True,help='sqlite database, or directory with --columnar')
+    parser.add_argument('-n','--names',nargs='+',default=None,
+                        help='table name of each input, inputs of the same name are merged. Defaults to the base names of the inputs')
+    parser.add_argument('--columnar',action='store_true',help='write column files instead of sqlite tables')
+    parser.add_argument('-p','--processes',type=int,default=None,help='number of parsing processes. Defaults to the cpu count')
+    parser.add_argument('-b','--blocksize',type=int,default=16,help='MB of csv parsed at once. Defaults to 16')
+    _add_instrumentation(parser)
+    args=parser.parse_args(argv)
+    t=time.time()
+    rows=run_instrumented(lambda: convert(args.inputs,args.output,args.names,args.columnar,args.processes,args.blocksize*2**20),
+                          args.stats,args.profile)
+    for table,n in rows.items(): print "%s: %d rows"%(table,n)
+    print "%d rows in %.1fs"%(sum(rows.values()),time.time()-t)
+
+def ingest_main(argv):
+    parser=argparse.ArgumentParser(prog='hddl.py ingest',description="""
+    Aggregate live ticks into candles saved in the tables SYMBOL_DURATION of
+    a sqlite database, see hddl_utils.ingest. Ticks are replayed from
+    histdata tick files or received as lines "SYMBOL,YYYYMMDD HHMMSSfff,ask,bid"
+    on a tcp or udp port. Runs until the replayed files end or Ctrl-C.
+    """)
+    parser.add_argument('symbols',nargs='+',help='symbols to aggregate')
+    parser.add_argument('-o','--output',default='live.db',help='sqlite database. Defaults to live.db')
+    parser.add_argument('-d','--duration',type=int,nargs='+',default=[60],help='candle durations in seconds. Defaults to 60')
+    parser.add_argument('--replay',nargs='+',default=[],metavar='SYMBOL=FILE',help='replay histdata tick csv or zip files')
+    parser.add_argument('--speed',type=float,default=None,help='replay this many times as fast as recorded. Defaults to as fast as possible')
+    parser.add_argument('--tcp',type=int,default=None,metavar='PORT',help='receive tick lines on this tcp port')
+    parser.add_argument('--udp',type=int,default=None,metavar='PORT',help='receive tick lines on this udp port')
+    parser.add_argument('--flush',type=float,default=.5,help='seconds closed candles are collected before they are written. Defaults to 0.5')
+    _add_instrumentation(parser)
+    args=parser.parse_args(argv)
+    sources=[ReplaySource(r.split('=',1)[1],r.split('=',1)[0],args.speed) for r in args.replay]
+    if args.tcp is not None: sources.append(SocketSource(args.tcp))
+    if args.udp is not None: sources.append(SocketSource(args.udp,udp=True))
+    if not sources: parser.error('no source, use --replay, --tcp or --udp')
+    ingest=Ingest(sources,args.symbols,args.duration,args.output,flush_interval=args.flush)
+    def run():
+        ingest.start()
+        try: ingest.join()
+        except KeyboardInterrupt: ingest.stop()
+        finally: ingest.close()
+        return ingest.report()
+    for k,v in sorted(run_instrumented(run,args.stats,args.profile).items()): print "%s: %s"%(k,v)
     
+def run_instrumented(fn,stats_file=None,profile=None):
+    '''
+    Run fn(). If stats_file is given the stages are measured, printed as
+    table and saved as JSON to stats_file at the end, see hddl_utils.stats.
+    If profile is given the main thread runs under cProfile and the profile
+    is saved to this file (load it with pstats).
+    '''
+    st=stats.enable() if stats_file else None
+    prof=None
+    if profile:
+        prof=cProfile.Profile()
+        prof.enable()
+    try: return fn()
+    finally:
+        if prof is not None:
+            prof.disable()
+            prof.dump_stats(profile)
+        if st is not None:
+            stats.disable()
+            print st.table()
+            st.save(stats_file)
+
+def _size(ret,*args): return len(ret) if isinstance(ret,str) else 0
+def _rows(ret,*args): return sum(len(df) for df in ret) if isinstance(ret,list) else len(ret)
+
+stats.instrument(Downloader,'_prepare','token')
+stats.instrument(Downloader,'_download_raw','transfer',bytes=lambda ret,self: self.size)
+stats.instrument(Downloader,'_load','load',bytes=lambda ret,self: self.size)
+stats.instrument(Downloader,'_parse_data','parse',rows=_rows)
+#read_csv includes inflating the archive
+stats.instrument(pd.io.parsers.TextFileReader,'read','read_csv',rows=lambda ret,*a: len(ret))
+stats.instrument(sys.modules[__name__],'parse_dates','parse_dates',rows=lambda ret,*a: len(ret))
+stats.instrument(sys.modules[__name__],'_candles','aggregate',rows=lambda ret,ts,*a: len(ts))
+stats.instrument(sys.modules[__name__],'fetch_month','fetch',bytes=_size)
+stats.instrument(sys.modules[__name__],'parse_month','parse_month',rows=_rows)
+stats.instrument(CsvOutput,'write','csv_write',rows=lambda ret,self,df: len(df))
+stats.instrument(CsvOutput,'commit','csv_commit')
+stats.instrument(PartitionedOutput,'commit','partition_commit')
+stats.instrument(HdfOutput,'write','hdf_write',rows=lambda ret,self,df: len(df))
+stats.instrument(sys.modules[__name__],'download','download')
+stats.instrument(sys.modules[__name__],'download_batch','download_batch')
+stats.instrument(sys.modules[__name__],'convert','convert',rows=lambda ret,*a: sum(ret.values()))
+
 if __name__ == '__main__':
+    if sys.argv[1:2]==['convert']:
+        convert_main(sys.argv[2:])
+        sys.exit()
+    if sys.argv[1:2]==['ingest']:
+        ingest_main(sys.argv[2:])
+        sys.exit()
     parser = argparse.ArgumentParser(description="""
     Download historical forexdata from histdata.com. The downloaded
     tickdata may be converted into any Timeframe above one second.
@@ -190,39 +1191,78 @@ if __name__ == '__main__':
     This script relies on the Python-libraries "Pandas" and "requests" - be sure they are
     properly installed.
     
+    Use "hddl.py convert -h" to convert the csv files into sqlite or column files,
+    "hddl.py ingest -h" to aggregate live ticks.
+    
     Author: Simon Schmid (sim.schmid@gmx.net )
     """    )
     parser.add_argument('pair',type=str, 
-                help='The currencypair to download.')
+                help='The currencypair to download. Several pairs separated by commas, or @FILE to read them from FILE (one per line), are downloaded in batch mode sharing --workers connections.')
     parser.add_argument('from', type=str, 
                         help="Datestring to start from.")
     parser.add_argument('to', type=str, 
                     help="Datestring to stop.")
-    parser.add_argument('-d','--duration', type=int,
-                        help='The duration of candlesticks. Defaults to 60s',
-                        default=60)
+    parser.add_argument('-d','--duration', type=int, nargs='+',
+                        help='The duration of candlesticks. Several durations are computed from one download, each into its own file. Defaults to 60s',
+                        default=[60])
     parser.add_argument("-o",'--output', type=str,
-                        help='Output file. Defaults to "out.csv".',
+                        help='Output file. Its extension selects the format, see --format. Defaults to "PAIR_DURATION.csv". With several durations "_DURATION" is appended to its basename. "{pair}" is replaced by the pair, in batch mode "PAIR_" is prepended to the basename if it is missing.',
                         default='')
+    parser.add_argument('-f','--format', type=str, default=None, choices=sorted(FORMATS),
+                        help='Output format: csv, npz (a directory of one npz file per month), parquet (a directory of one parquet file per month, needs pyarrow), hdf (a HDF5 table, needs PyTables) or sqlite (the table candles of a sqlite database, months with gaps are fetched again). Defaults to the format of the output extension (.npz, .parquet, .h5, .db), else csv.')
     parser.add_argument('--noupdate', action='store_true',
                         help='Dont update an existing file - overwrite!.',
                         )
-    
-    #TODO: SQL-Conversion
-    #parser.add_argument('-convert_to_sql',
-    #                    help="if set all files matched will be converted into one single sqlfile out")
-    #parser.add_argument('-names',default=None,nargs='*',
-    #                    help="specify sql table name, if ommited use the basenames of found files")
+    parser.add_argument('--nojournal', action='store_true',
+                        help='Dont keep the journal "OUTPUT.journal" of fetched and written months, which lets a restart skip fetched months.')
+    parser.add_argument('-w','--workers', type=int, default=0,
+                        help='Download this many months concurrently while parsing in a process pool. Defaults to 0 (serial), 4 in batch mode.')
+    parser.add_argument('--parsers', type=int, default=None,
+                        help='Number of parsing processes used with --workers. Defaults to the cpu count.')
+    parser.add_argument('-c','--chunksize', type=int, default=None,
+                        help='Spool archives to disk and parse this many ticks at once to bound memory usage.')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Directory to cache the raw tick archives in. Changing the duration of cached months needs no download.')
+    parser.add_argument('--cache_size', type=int, default=4096,
+                        help='Max size of the cache in MB. Defaults to 4096.')
+    parser.add_argument('--tickstore', type=str, default=None,
+                        help='Directory of a columnar tick store. Ticks are saved there and read back without parsing text.')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Max requests per second to the server.')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='Retry failed requests and months this many times with exponential backoff. Defaults to 3.')
+    _add_instrumentation(parser)
     args=vars(parser.parse_args())
     
     
     #print args
     #sys.exit()
-    if not args['output']: args['output']="%s_%d.csv"%(args['pair'],args['duration'])
+    durations=args['duration']
+    pairs=read_pairs(args['pair'])
+    batch=len(pairs)>1 or args['pair'].startswith('@')
+    ext=dict(csv='.csv',npz='.npz',parquet='.parquet',hdf='.h5',sqlite='.db')[args['format'] or 'csv']
+    outputs=dict((p,output_names(p,args['output'],durations,batch,ext)) for p in pairs)
+    args['pair']=', '.join(pairs)
+    args['duration']=', '.join("%ds"%d for d in durations)
+    args['output']=', '.join(sum([outputs[p] for p in pairs],[]))
     print """
     Start downloading of {pair} from {from} to {to}.
     Target TimeFrame = {duration},
     Save to {output}
     """.format(**args)
     
-    download(args['pair'],args['from'],args['to'],args['output'],freq="%ds"%args['duration'],update=not args['noupdate'])
+    kw=dict(freq=["%ds"%d for d in durations],update=not args['noupdate'],parsers=args['parsers'],journal=not args['nojournal'],fmt=args['format'],
+            cache=ArchiveCache(args['cache'],args['cache_size']*2**20) if args['cache'] else None,
+            chunksize=args['chunksize'],
+            tickstore=TickStore(args['tickstore']) if args['tickstore'] else None)
+    if batch:
+        failed=run_instrumented(lambda: download_batch(pairs,args['from'],args['to'],outputs,workers=args['workers'] or 4,
+                                                       rate=args['rate'],retries=args['retries'],**kw),
+                                args['stats'],args['profile'])
+        if failed:
+            print "failed:",', '.join(sorted(failed))
+            sys.exit(1)
+    else:
+        run_instrumented(lambda: download(pairs[0],args['from'],args['to'],outputs[pairs[0]],workers=args['workers'],
+                                          session=PooledSession(max(args['workers'],1),args['rate'],retries=args['retries']),**kw),
+                         args['stats'],args['profile'])